@@ -1,6 +1,20 @@
+import codecs
 import email
+import gc
+import hashlib
+import locale
+import marshal
+import os
 import re
 import sys
+import tempfile
+import threading
+import types
+import weakref
+
+from array import array
+from collections import OrderedDict
+from io import BytesIO
 
 from xml.etree.ElementTree import Comment
 from xml.etree.ElementTree import ElementPath
@@ -14,6 +28,8 @@ from ._compat import htmlentitydefs
 from ._compat import HTMLParser
 from ._compat import StringIO
 from ._compat import StringTypes
+from ._compat import MappingProxyType
+from ._compat import MutableMapping
 from ._compat import bytes
 from ._compat import unichr
 from ._compat import _u
@@ -22,6 +38,8 @@ from ._compat import _raise_serialization_error
 from ._compat import _encode_entity
 from ._compat import fixtag
 
+__version__ = '2.1.0.dev0' # setup.py reads it from here
+
 AUTOCLOSE = "p", "li", "tr", "th", "td", "head", "body"
 IGNOREEND = "img", "hr", "meta", "link", "br"
 _BLANK = _b('')
@@ -39,6 +57,7 @@ _PI_START = _b('<?')
 _PI_END = _b('?>')
 _AMPER_ESCAPED = _b('&amp;')
 _LT = _b('<')
+_GT = _b('>')
 _LT_ESCAPED = _b('&lt;')
 _QUOTE_ESCAPED = _b("&quot;")
 _XML_PROLOG_BEGIN = _b('<?xml version="1.0"')
@@ -59,67 +78,426 @@ else:
 
 # replace element factory
 def Replace(text, structure=False):
-    element = _MeldElementInterface(Replace, {})
+    element = _MeldElementInterface(Replace, _NOATTRIB)
     element.text = text
     element.structure = structure
     return element
 
+# stream repeat element factory
+def StreamRepeat(template, iterable, callback):
+    element = _MeldElementInterface(StreamRepeat, _NOATTRIB)
+    # what to repeat is kept in 'structure', like Replace's render flag
+    element.structure = (template, iterable, callback)
+    return element
+
+def _streamrows(node):
+    # clone and fill in the template of a StreamRepeat node once per item
+    template, iterable, callback = node.structure
+    # the output of the node's ancestors changes from one write to the
+    # next, so they mustn't be memoized
+    while node is not None and not node._flags & _STREAMED:
+        node._flags |= _STREAMED
+        node = node.parent
+    for thing in iterable:
+        clone = helper.bfclone(template)
+        callback(clone, thing)
+        yield clone
+
 class PyHelper:
     def findmeld(self, node, name, default=None):
-        iterator = self.getiterator(node)
-        for element in iterator:
-            val = element.attrib.get(_MELD_ID)
+        for element in self._walk(node):
+            val = element._attrib.get(_MELD_ID)
             if val == name:
                 return element
         return default
 
     def clone(self, node, parent=None):
-        element = _MeldElementInterface(node.tag, node.attrib.copy())
-        element.text = node.text
-        element.tail = node.tail
-        element.structure = node.structure
+        element = self._clone(node, None)
+        if parent is not None:
+            parent._ownchildren().append(element)
+            element.parent = parent
+            self.indexadd(parent, element)
+        return element
+
+    def _clone(self, node, parent):
+        element = _MeldElementInterface(node._tag, _copyattrib(node._attrib))
+        element._text = node._text
+        element._tail = node._tail
+        if node.structure is not None:
+            element.structure = node.structure
+        element._compiled = node._compiled
+        element._rendered = node._rendered
+        element._flags = node._flags & _CLONEDFLAGS
+        element._fingerprint = node._fingerprint
         if parent is not None:
             # avoid calling self.append to reduce function call overhead
             parent._children.append(element)
             element.parent = parent
-        for child in node._children:
-            self.clone(child, element)
+        if node._flags & _SHAREDCHILDREN:
+            # the children still belong to a frozen template; so can ours
+            element._children = node._children
+            element._flags |= _SHAREDCHILDREN
+        elif node._children:
+            element._children = []
+            for child in node._children:
+                self._clone(child, element)
         return element
 
-    def _bfclone(self, nodes, parent):
+    def _bfclone(self, nodes, parent, index):
         L = []
+        # the link from each child to 'parent', made once for all of them
+        if parent._flags & _WEAKPARENT:
+            link = weakref.ref(parent)
+            weak = _WEAKPARENT
+        else:
+            link = parent
+            weak = 0
         for node in nodes:
-            element = _MeldElementInterface(node.tag, node.attrib.copy())
-            element.parent = parent
-            element.text = node.text
-            element.tail = node.tail
-            element.structure = node.structure
-            if node._children:
-                self._bfclone(node._children, element)
+            attrib = node._attrib
+            element = _MeldElementInterface(node._tag, _copyattrib(attrib))
+            element._parent = link
+            element._text = node._text
+            element._tail = node._tail
+            if node.structure is not None:
+                element.structure = node.structure
+            element._compiled = node._compiled
+            element._rendered = node._rendered
+            element._flags = (node._flags & _COVERED) | weak
+            element._fingerprint = node._fingerprint
+            meldid = attrib.get(_MELD_ID)
+            if meldid is not None:
+                index.setdefault(meldid, []).append(element)
+            if node._flags & _SHAREDCHILDREN:
+                element._children = node._children
+                element._flags |= _SHAREDCHILDREN
+            elif node._children:
+                self._bfclone(node._children, element, index)
             L.append(element)
         parent._children = L
 
     def bfclone(self, node, parent=None):
-        element = _MeldElementInterface(node.tag, node.attrib.copy())
-        element.text = node.text
-        element.tail = node.tail
-        element.structure = node.structure
-        element.parent = parent
+        paused = _pausegc()
+        try:
+            return self._bfcloneroot(node, parent)
+        finally:
+            if paused:
+                _resumegc()
+
+    def _bfcloneroot(self, node, parent):
+        element = _MeldElementInterface(node._tag, _copyattrib(node._attrib))
+        element._text = node._text
+        element._tail = node._tail
+        if node.structure is not None:
+            element.structure = node.structure
+        element._compiled = node._compiled
+        element._rendered = node._rendered
+        element._flags = node._flags & _CLONEDFLAGS
+        element._fingerprint = node._fingerprint
+        # collect the meld ids of the clone while we're visiting every
+        # node anyway, so the clone never needs to be walked to index it
+        index = {}
+        meldid = node._attrib.get(_MELD_ID)
+        if meldid is not None:
+            index[meldid] = [element]
+        if node._flags & _SHAREDCHILDREN:
+            element._children = node._children
+            element._flags |= _SHAREDCHILDREN
+        elif node._children:
+            self._bfclone(node._children, element, index)
+        element._meldindex = index
         if parent is not None:
-            parent._children.append(element)
-        if node._children:
-            self._bfclone(node._children, element)
+            parent._ownchildren().append(element)
+            element.parent = parent
+            self.indexadd(parent, element)
+        return element
+
+    # copy-on-write clones of frozen elements: the nodes on the way to
+    # each meld id are copied up front, so that the clone's meld id index
+    # can point at them; every other subtree is shared with the template
+    # until somebody visits it, and attribute dictionaries are shared
+    # until they are written to.
+
+    def cowclone(self, node, parent=None):
+        if not node._flags & _FROZEN:
+            raise ValueError('only frozen elements can be cloned '
+                             'copy-on-write')
+        index = {}
+        element = self._cowclone(node, None, index)
+        element._meldindex = index
+        if parent is not None:
+            parent._ownchildren().append(element)
+            element.parent = parent
+            self.indexadd(parent, element)
+        return element
+
+    def _cowclone(self, node, parent, index):
+        attrib = node._attrib or _NOATTRIB
+        element = _MeldElementInterface(node._tag, attrib)
+        flags = node._flags & _CLONEDFLAGS
+        if attrib:
+            flags |= _SHAREDATTRIB
+        if parent is not None:
+            if parent._flags & _WEAKPARENT:
+                element._parent = weakref.ref(parent)
+                flags |= _WEAKPARENT
+            else:
+                element._parent = parent
+                flags &= ~_WEAKPARENT
+        element._flags = flags
+        element._text = node._text
+        element._tail = node._tail
+        if node.structure is not None:
+            element.structure = node.structure
+        element._compiled = node._compiled
+        element._rendered = node._rendered
+        element._fingerprint = node._fingerprint
+        meldid = attrib.get(_MELD_ID)
+        if meldid is not None:
+            index.setdefault(meldid, []).append(element)
+        children = node._children
+        if node._flags & _MELDBELOW:
+            element._children = [self._cowclone(child, element, index)
+                                 for child in children]
+        elif children:
+            element._children = children
+            element._flags |= _SHAREDCHILDREN
         return element
 
+    def unshare(self, node):
+        """ Give a copy-on-write clone children of its own in place of
+        those it shares with its template (none of which carry a meld
+        id) """
+        if node._journal is not None and not node._flags & _LOGGEDCHILDREN:
+            self.recordchildren(node)
+        node._flags &= ~_SHAREDCHILDREN
+        index = {}
+        children = node._children = [self._cowclone(child, node, index)
+                                     for child in node._children]
+        if node._flags & _COVERED:
+            # the bytes rendered for 'node' cover its new children too
+            for child in children:
+                child._flags |= _COVERED
+
+    def freeze(self, node):
+        """ Make 'node' and its descendants read-only, noting which of
+        them have meld ids below them for the benefit of cowclone, and
+        compute their fingerprints now: the clones of a frozen tree
+        share its nodes, and fingerprinting a clone must not write to
+        them.  Nodes with a pending streamrepeat below them can't be
+        fingerprinted, and are left without one. """
+        nodes = list(self._walk(node))
+        # children before their parents
+        for element in reversed(nodes):
+            if element._fingerprint is None and _printable(element):
+                if element._journal is not None:
+                    if not element._flags & _LOGGED:
+                        self.record(element)
+                element._fingerprint = _fingerprintnode(element)
+            flags = element._flags | _FROZEN
+            for child in element._children:
+                if (child._flags & _MELDBELOW or
+                    child._attrib.get(_MELD_ID) is not None):
+                    flags |= _MELDBELOW
+                    break
+            element._flags = flags
+
+    def weakparents(self, node):
+        """ Make the elements below 'node' hold their parents through
+        weak references """
+        # children shared with a frozen template belong to it; the
+        # copies of them made by unshare follow their new parent
+        for element in self._walk(node):
+            parent = element._parent
+            if parent is not None and not element._flags & _WEAKPARENT:
+                element._parent = weakref.ref(parent)
+            element._flags |= _WEAKPARENT
+
+    def dedup(self, node):
+        """ Make the elements below 'node' share equal tags, attribute
+        names and values, whitespace text and tails, and equal attribute
+        dictionaries (other than those with a meld id); return the number
+        of bytes of duplicates dropped """
+        strings = {}
+        attribs = {} # sorted items -> _SharedAttrib
+        getsizeof = sys.getsizeof
+        saved = 0
+        for element in self._walk(node):
+            # leave alone what belongs to a frozen template or a journal
+            if element._flags & (_FROZEN | _SHAREDATTRIB):
+                continue
+            tag = element._tag
+            if isinstance(tag, StringTypes):
+                same = strings.setdefault(tag, tag)
+                if same is not tag:
+                    element._tag = same
+                    saved += getsizeof(tag)
+            for name in ('_text', '_tail'):
+                text = getattr(element, name)
+                if text and not text.strip():
+                    same = strings.setdefault(text, text)
+                    if same is not text:
+                        setattr(element, name, same)
+                        saved += getsizeof(text)
+            attrib = element._attrib
+            if not attrib or attrib.__class__ is _SharedAttrib:
+                continue
+            items = []
+            for k, v in attrib.items():
+                same = strings.setdefault(k, k)
+                if same is not k:
+                    saved += getsizeof(k)
+                    k = same
+                if k != _MELD_ID:
+                    same = strings.setdefault(v, v)
+                    if same is not v:
+                        saved += getsizeof(v)
+                        v = same
+                items.append((k, v))
+            if _MELD_ID in attrib:
+                element._attrib = dict(items)
+                continue
+            items.sort()
+            key = tuple(items)
+            shared = attribs.get(key)
+            if shared is None:
+                shared = attribs[key] = _SharedAttrib(items)
+            else:
+                saved += getsizeof(attrib)
+            element._attrib = shared
+        return saved
+
+    def uncover(self, node):
+        """ Throw away the serialized subtrees (see compile()) which
+        'node', about to change, is part of """
+        while node is not None and node._flags & _COVERED:
+            if node._journal is not None and not node._flags & _LOGGED:
+                self.record(node)
+            node._flags &= ~_COVERED
+            node._rendered = None
+            node = node.parent
+
+    # fingerprints: a hash of each element's tag, attributes, text and
+    # tail and of its children's fingerprints, computed when asked for
+    # and kept until the element or one of its descendants changes.
+    # An element only has one if all of its descendants have one too, so
+    # forgetting them can stop at the first ancestor which has none.
+
+    def fingerprint(self, node):
+        if node._fingerprint is None:
+            stack = [(node, False)]
+            pop = stack.pop
+            append = stack.append
+            while stack:
+                node, visited = pop()
+                if visited:
+                    if node._journal is not None:
+                        if not node._flags & _LOGGED:
+                            self.record(node)
+                    node._fingerprint = _fingerprintnode(node)
+                    continue
+                append((node, True))
+                for child in node._children:
+                    if child._fingerprint is None:
+                        append((child, False))
+        return node._fingerprint
+
+    def unfingerprint(self, node):
+        while node is not None and node._fingerprint is not None:
+            if node._journal is not None and not node._flags & _LOGGED:
+                self.record(node)
+            node._fingerprint = None
+            node = node.parent
+
+    # the journal of a tree (see MeldElementInterface.journal): the
+    # first time one of its elements is about to change after the
+    # journal was started or reset, the element's own state (everything
+    # but its children) or its list of children is remembered, so that
+    # reset() can put them back.  Elements added to the tree later have
+    # no journal; reset() simply takes them out again.
+
+    def record(self, node):
+        flags = node._flags
+        attrib = node._attrib
+        node._journal.entries.append(
+            (False, node, node._tag, attrib, node._text, node._tail, flags,
+             node._compiled, node._rendered, node._fingerprint))
+        if attrib is not _NOATTRIB:
+            # from now on the dictionary belongs to the journal, and
+            # the element writes to a copy of it
+            flags |= _SHAREDATTRIB
+        node._flags = flags | _LOGGED
+
+    def recordchildren(self, node):
+        flags = node._flags
+        children = node._children
+        node._journal.entries.append((True, node, children, flags))
+        if not flags & _SHAREDCHILDREN:
+            # the list belongs to the journal now, the element changes a
+            # copy of it
+            node._children = children[:]
+        node._flags = flags | _LOGGEDCHILDREN
+
+    def reset(self, journal):
+        entries = journal.entries
+        childbits = _SHAREDCHILDREN | _LOGGEDCHILDREN
+        # the parent links are put back by the setter below, which also
+        # sets the _WEAKPARENT bit to match
+        keep = childbits | _WEAKPARENT
+        for entry in reversed(entries):
+            node = entry[1]
+            if entry[0]:
+                children = entry[2]
+                for child in children:
+                    child.parent = node
+                node._children = children
+                node._flags = ((node._flags & ~childbits) |
+                               (entry[3] & _SHAREDCHILDREN))
+            else:
+                (ignored, node, node._tag, node._attrib, node._text,
+                 node._tail, flags, node._compiled, node._rendered,
+                 node._fingerprint) = entry
+                node._flags = (flags & ~keep) | (node._flags & keep)
+        del entries[:]
+        if journal.indexchanged:
+            journal.element._meldindex = _copyindex(journal.meldindex)
+            journal.indexchanged = False
+
+    def _walk(self, node):
+        # like iter, but doesn't descend into children shared with a
+        # frozen template: those are frozen already and carry no meld
+        # ids, so lookups and bookkeeping can skip them
+        stack = [node]
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            node = pop()
+            yield node
+            children = node._children
+            if children and not node._flags & _SHAREDCHILDREN:
+                extend(reversed(children))
+
     def getiterator(self, node, tag=None):
-        nodes = []
+        return list(self.iter(node, tag))
+
+    def iter(self, node, tag=None):
+        """ Lazily yield 'node' and its descendants in document order,
+        optionally only those whose tag is 'tag'.  An explicit stack is
+        used instead of recursion, so callers which stop early don't pay
+        for the rest of the tree. """
         if tag == "*":
             tag = None
-        if tag is None or node.tag == tag:
-            nodes.append(node)
-        for element in node._children:
-            nodes.extend(self.getiterator(element, tag))
-        return nodes
+        stack = [node]
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            node = pop()
+            if tag is None or node._tag == tag:
+                yield node
+            if node._flags & _SHAREDCHILDREN:
+                self.unshare(node)
+            children = node._children
+            if children:
+                extend(reversed(children))
 
     def content(self, node, text, structure=False):
         node.text = None
@@ -127,8 +505,194 @@ class PyHelper:
         replacenode.parent = node
         replacenode.text = text
         replacenode.structure = structure
+        for child in node._ownchildren():
+            child.parent = None
+            self.indexdiscard(node, child)
         node._children = [replacenode]
 
+    # the meld id index: a dictionary mapping each meld id to the list
+    # of elements carrying it, kept on the root element of each tree.
+    # It is built lazily the first time it's needed and maintained
+    # incrementally by the element mutators from then on.
+
+    def meldindex(self, node):
+        """ Return the meld id index of the tree in which 'node' lives,
+        building it if necessary """
+        while node.parent is not None:
+            node = node.parent
+        index = node._meldindex
+        if index is None:
+            index = {}
+            for element in self._walk(node):
+                meldid = element._attrib.get(_MELD_ID)
+                if meldid is not None:
+                    index.setdefault(meldid, []).append(element)
+            node._meldindex = index
+        return index
+
+    def indexadd(self, parent, element):
+        """ Register the meld ids of 'element' (which has just been seated
+        in 'parent') in the index of the tree it has joined """
+        subindex = element._meldindex
+        if subindex is not None:
+            element._meldindex = None
+        while parent.parent is not None:
+            parent = parent.parent
+        index = parent._meldindex
+        if index is None:
+            return
+        if parent._journal is not None:
+            parent._journal.indexchanged = True
+        if subindex is not None:
+            # element was the root of an indexed tree; merge its index
+            for meldid, elements in subindex.items():
+                index.setdefault(meldid, []).extend(elements)
+            return
+        for node in self._walk(element):
+            meldid = node._attrib.get(_MELD_ID)
+            if meldid is not None:
+                index.setdefault(meldid, []).append(node)
+
+    def indexdiscard(self, parent, element):
+        """ Remove the meld ids of 'element' (which has just been removed
+        from 'parent') from the index of the tree it has left """
+        while parent.parent is not None:
+            parent = parent.parent
+        index = parent._meldindex
+        if index is None:
+            return
+        if parent._journal is not None:
+            parent._journal.indexchanged = True
+        for node in self._walk(element):
+            meldid = node._attrib.get(_MELD_ID)
+            if meldid is not None:
+                _unindex(index, meldid, node)
+
+    def lookupmelds(self, node, names):
+        """ Return a dictionary mapping each meld id in 'names' to the
+        first element in the subtree of 'node' carrying it; ids which
+        can't be found are omitted.  Unambiguous ids are answered by the
+        index; whatever remains is resolved by a single walk of the
+        subtree, which stops as soon as every such id has been found. """
+        index = self.meldindex(node)
+        found = {}
+        pending = {}
+        for name in names:
+            element = _lookup(index, node, name)
+            if element is _marker:
+                pending[name] = True
+            elif element is not None:
+                found[name] = element
+        if pending:
+            for element in self._walk(node):
+                meldid = element._attrib.get(_MELD_ID)
+                if meldid in pending:
+                    found[meldid] = element
+                    del pending[meldid]
+                    if not pending:
+                        break
+        return found
+
+    def indexrename(self, node, old, new):
+        """ Move 'node' from meld id 'old' to meld id 'new' in the index
+        of the tree in which it lives """
+        root = node
+        while root.parent is not None:
+            root = root.parent
+        index = root._meldindex
+        if index is None or old == new:
+            return
+        if root._journal is not None:
+            root._journal.indexchanged = True
+        if old is not None:
+            _unindex(index, old, node)
+        if new is not None:
+            index.setdefault(new, []).append(node)
+
+def _fingerprintpart(value):
+    # length-prefixed, so that no two sequences of parts hash alike
+    if value is None:
+        return _b('-')
+    if not isinstance(value, bytes):
+        value = ('%s' % value).encode('utf-8')
+    return _b('%d:' % len(value)) + value
+
+def _printable(node):
+    # can _fingerprintnode(node) be called?
+    if node._tag is StreamRepeat:
+        return False
+    for child in node._children:
+        if child._fingerprint is None:
+            return False
+    return True
+
+def _fingerprintnode(node):
+    tag = node._tag
+    if tag is StreamRepeat:
+        raise ValueError('the output of streamrepeat cannot be '
+                         'fingerprinted')
+    if tag is Replace:
+        tag = node.structure and 'replace-structure' or 'replace'
+        tag = _b(tag)
+    elif tag is Comment:
+        tag = _b('comment')
+    else:
+        tag = _b('<') + _fingerprintpart(tag)
+    parts = [tag]
+    for name, value in sorted(node._attrib.items()):
+        parts.append(_fingerprintpart(name))
+        parts.append(_fingerprintpart(value))
+    parts.append(_fingerprintpart(node._text))
+    parts.append(_fingerprintpart(node._tail))
+    children = node._children
+    parts.append(_b('%d;' % len(children)))
+    for child in children:
+        parts.append(_b(child._fingerprint))
+    return hashlib.sha1(_BLANK.join(parts)).hexdigest()
+
+class _Journal(object):
+    """ The changes made to a journaled tree, see record() """
+    def __init__(self, element, meldindex):
+        self.element = element
+        self.entries = []
+        self.meldindex = meldindex # a copy of the index when started
+        self.indexchanged = False
+
+def _copyindex(index):
+    copy = {}
+    for meldid, elements in index.items():
+        copy[meldid] = elements[:]
+    return copy
+
+def _lookup(index, node, name):
+    # answer a meld id lookup below 'node' from the index: return the
+    # element, None if there is none, or _marker if the index can't tell
+    # (the id is carried by more than one element, e.g. after 'repeat')
+    elements = index.get(name)
+    if not elements:
+        return None
+    if len(elements) > 1:
+        return _marker
+    element = elements[0]
+    if element._attrib.get(_MELD_ID) != name:
+        return _marker
+    parent = element
+    while parent is not None:
+        if parent is node:
+            return element
+        parent = parent.parent
+    return None
+
+def _unindex(index, meldid, node):
+    elements = index.get(meldid)
+    if elements:
+        for i, element in enumerate(elements):
+            if element is node:
+                del elements[i]
+                break
+        if not elements:
+            del index[meldid]
+
 helper = PyHelper()
 
 _MELD_NS_URL  = 'http://www.plope.com/software/meld3'
@@ -143,6 +707,55 @@ _XHTML_PREFIX_LEN = len(_XHTML_PREFIX)
 
 _marker = []
 
+# default size of the byte strings produced by the iter_* output methods
+CHUNKSIZE = 1 << 16
+
+_GeneratorType = types.GeneratorType
+
+# The bulk operations (parsing, cloning whole trees, 'repeat' and
+# loading dumped templates) allocate containers by the hundred thousand,
+# none of which are garbage, and would otherwise set off collection
+# after collection of the cyclic garbage collector, each going through
+# everything allocated so far.  They pause the collector instead (unless
+# PAUSE_GC is false); it runs once afterwards.  Pauses nest, also
+# across threads: the collector is enabled again when the last one ends.
+PAUSE_GC = True
+
+_gclock = threading.Lock()
+_gcpauses = [0, False] # number of pauses going on, collector enabled
+
+def _pausegc():
+    # return whether the collector was paused, and _resumegc must be
+    # called when the bulk operation is over
+    if not PAUSE_GC:
+        return False
+    _gclock.acquire()
+    try:
+        if not _gcpauses[0]:
+            _gcpauses[1] = gc.isenabled()
+            gc.disable()
+        _gcpauses[0] += 1
+    finally:
+        _gclock.release()
+    return True
+
+def _resumegc():
+    _gclock.acquire()
+    try:
+        _gcpauses[0] -= 1
+        if not _gcpauses[0] and _gcpauses[1]:
+            gc.enable()
+    finally:
+        _gclock.release()
+
+def _gcfreeze():
+    # move everything alive (after a collection) out of the collector's
+    # sight, so that it is never gone through again (python 3.7+)
+    freeze = getattr(gc, 'freeze', None)
+    if freeze is not None:
+        gc.collect()
+        freeze()
+
 class doctype:
     # lookup table for ease of use in external code
     html_strict  = ('HTML', '-//W3C//DTD HTML 4.01//EN',
@@ -154,33 +767,267 @@ class doctype:
     xhtml        = ('html', '-//W3C//DTD XHTML 1.0 Transitional//EN',
                     'http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd')
 
-class _MeldElementInterface:
-    parent = None
-    attrib = None
-    text   = None
-    tail   = None
-    structure = None
+class _NoAttrib(dict):
+    """ The attribute dictionary shared by every element without
+    attributes.  Reading from it works like reading from an empty dict;
+    elements swap in a dict of their own before writing to it. """
+    def _readonly(self, *arg, **kw):
+        raise TypeError('shared empty attribute dictionary is read-only')
+    __setitem__ = __delitem__ = clear = pop = popitem = _readonly
+    setdefault = update = _readonly
+
+_NOATTRIB = _NoAttrib()
+
+class _SharedAttrib(dict):
+    """ An attribute dictionary shared by the elements of a tree which
+    have equal attributes, see MeldElementInterface.dedup.  Like
+    _NOATTRIB, elements swap in a copy of their own before writing to
+    it. """
+    def _readonly(self, *arg, **kw):
+        raise TypeError('shared attribute dictionary is read-only')
+    __setitem__ = __delitem__ = clear = pop = popitem = _readonly
+    setdefault = update = _readonly
+
+class _AttribView(MutableMapping):
+    """ The 'attrib' of an element which isn't frozen.  Reading through
+    it reads the element's attribute dictionary and leaves the element
+    alone; writing through it changes the element, like 'set' does, so
+    that what was precomputed from its attributes is thrown away. """
+    __slots__ = ('_element',)
+
+    def __init__(self, element):
+        self._element = element
+
+    def __getitem__(self, key):
+        return self._element._attrib[key]
+
+    def __iter__(self):
+        return iter(self._element._attrib)
+
+    def __len__(self):
+        return len(self._element._attrib)
+
+    def __contains__(self, key):
+        return key in self._element._attrib
+
+    def get(self, key, default=None):
+        return self._element._attrib.get(key, default)
+
+    def __setitem__(self, key, value):
+        self._element.set(key, value)
+
+    def __delitem__(self, key):
+        element = self._element
+        if key not in element._attrib:
+            raise KeyError(key)
+        element._changed()
+        if key == _MELD_ID:
+            helper.indexrename(element, element._attrib[key], None)
+        del element._ownattrib()[key]
+
+    def copy(self):
+        return dict(self._element._attrib)
+
+    def __repr__(self):
+        return repr(dict(self._element._attrib))
+
+# the children of every element without any, until it gets some
+_NOCHILDREN = ()
+
+# bits of an element's _flags
+_FROZEN = 1         # read-only, see freeze()
+_MELDBELOW = 2      # frozen, and some descendant has a meld id
+_SHAREDATTRIB = 4   # _attrib belongs to a frozen template or a journal
+_SHAREDCHILDREN = 8 # _children belongs to a frozen template
+_COVERED = 16       # part of a subtree serialized in one piece by compile()
+_MEMO = 32          # the writers keep its bytes, see memoize()
+_STREAMED = 64      # streamrepeat output has been written below it
+_LOGGED = 128       # its own state is in its journal
+_LOGGEDCHILDREN = 256 # its children are in its journal
+_WEAKPARENT = 512   # holds its parent weakly, see weakparents()
+
+# the bits which clones take over from the elements they're made from
+_CLONEDFLAGS = _COVERED | _WEAKPARENT
+
+def _copyattrib(attrib):
+    # clones share the empty dictionary and deduplicated ones too
+    # instead of copying them
+    if attrib and attrib.__class__ is not _SharedAttrib:
+        return attrib.copy()
+    return attrib or _NOATTRIB
+
+class _MeldElementInterface(object):
+    # slots for the state every element has: templates are kept resident
+    # and cloned often, so every byte per node adds up.  What few
+    # elements have lives in the instance dictionary, which is only
+    # allocated once something is put there, and defaults to the class
+    # attributes below; it also takes whatever attributes applications
+    # set on elements.
+    __slots__ = ('_parent', '_tag', '_attrib', '_text', '_tail',
+                 '_children',
+                 '_compiled',  # (method, encoding) -> parts, see compile()
+                 '_rendered',  # (method, encoding) -> bytes of the subtree
+                 '_flags',     # _FROZEN, _SHAREDCHILDREN etc.
+                 '_fingerprint', # see fingerprint()
+                 '__dict__',
+                 '__weakref__',
+                 )
+
+    structure = None   # set on Replace and StreamRepeat nodes
+    _meldindex = None  # meld id -> [elements], kept on tree roots only
+    _journal = None    # see journal()
 
     # overrides to reduce MRU lookups
     def __init__(self, tag, attrib):
-        self.tag = tag
-        self.attrib = attrib
-        self._children = []
+        self._parent = None
+        self._tag = tag
+        # the caller's own dictionary, which sees later changes; elements
+        # made here pass _NOATTRIB when they have no attributes
+        if attrib is None:
+            attrib = _NOATTRIB
+        self._attrib = attrib
+        self._text = None
+        self._tail = None
+        self._children = _NOCHILDREN
+        self._compiled = None
+        self._rendered = None
+        self._flags = 0
+        self._fingerprint = None
+
+    def _ownattrib(self):
+        # the attribute dictionary, made private to this element first if
+        # it's still the shared empty one, a deduplicated one or a
+        # frozen template's
+        attrib = self._attrib
+        if attrib is _NOATTRIB:
+            attrib = self._attrib = {}
+        elif self._flags & _SHAREDATTRIB:
+            attrib = self._attrib = attrib.copy()
+            self._flags &= ~_SHAREDATTRIB
+        elif attrib.__class__ is _SharedAttrib:
+            attrib = self._attrib = attrib.copy()
+        return attrib
+
+    def _childlist(self):
+        # the children, made elements of this tree first if they're still
+        # shared with a frozen template
+        if self._flags & _SHAREDCHILDREN:
+            helper.unshare(self)
+        children = self._children
+        if children is _NOCHILDREN:
+            children = self._children = []
+        return children
+
+    def _ownchildren(self):
+        # the children, about to be changed
+        flags = self._flags
+        if flags & _FROZEN:
+            raise ValueError('cannot change a frozen element')
+        if self._journal is not None and not flags & _LOGGEDCHILDREN:
+            helper.recordchildren(self)
+        if flags & _COVERED:
+            helper.uncover(self)
+        if self._fingerprint is not None:
+            helper.unfingerprint(self)
+        return self._childlist()
 
     def __repr__(self):
-        return "<MeldElement %s at %x>" % (self.tag, id(self))
+        return "<MeldElement %s at %x>" % (self._tag, id(self))
+
+    # tag, attrib, text and tail are properties so that we notice when
+    # an element changes; internally we use the underlying attributes.
+
+    def _changed(self):
+        # called before the element's own tag, attributes, text or tail
+        # change: whatever was precomputed from them is stale now
+        flags = self._flags
+        if flags & _FROZEN:
+            raise ValueError('cannot change a frozen element')
+        if self._journal is not None and not flags & _LOGGED:
+            helper.record(self)
+        if flags & _COVERED:
+            helper.uncover(self)
+        if self._compiled is not None:
+            self._compiled = None
+        if self._fingerprint is not None:
+            helper.unfingerprint(self)
+
+    def _gettag(self):
+        return self._tag
+
+    def _settag(self, tag):
+        self._changed()
+        self._tag = tag
+
+    tag = property(_gettag, _settag)
+
+    def _getattrib(self):
+        # a view, so that only writing through it counts as a change
+        if self._flags & _FROZEN:
+            return MappingProxyType(self._attrib)
+        return _AttribView(self)
+
+    def _setattrib(self, attrib):
+        self._changed()
+        if attrib is None:
+            attrib = _NOATTRIB
+        elif isinstance(attrib, _AttribView):
+            attrib = attrib.copy()
+        self._attrib = attrib
+
+    attrib = property(_getattrib, _setattrib)
+
+    def _gettext(self):
+        return self._text
+
+    def _settext(self, text):
+        self._changed()
+        self._text = text
+
+    text = property(_gettext, _settext)
+
+    def _gettail(self):
+        return self._tail
+
+    def _settail(self, tail):
+        self._changed()
+        self._tail = tail
+
+    tail = property(_gettail, _settail)
+
+    # the parent is held through a weak reference in trees whose parent
+    # links have been made weak (see weakparents()); elements seated in
+    # such a tree link to their new parent the same way
+
+    def _getparent(self):
+        parent = self._parent
+        if parent is not None and self._flags & _WEAKPARENT:
+            return parent()
+        return parent
+
+    def _setparent(self, parent):
+        if parent is None:
+            self._parent = None
+        elif parent._flags & _WEAKPARENT:
+            self._parent = weakref.ref(parent)
+            self._flags |= _WEAKPARENT
+        else:
+            self._parent = parent
+            self._flags &= ~_WEAKPARENT
+
+    parent = property(_getparent, _setparent)
 
     def __len__(self):
         return len(self._children)
 
     def __getitem__(self, index):
-        return self._children[index]
+        return self._childlist()[index]
 
     def __getslice__(self, start, stop):
-        return self._children[start:stop]
+        return self._childlist()[start:stop]
 
     def getchildren(self):
-        return self._children
+        return self._childlist()
 
     def find(self, path):
         return ElementPath.find(self, path)
@@ -192,72 +1039,96 @@ class _MeldElementInterface:
         return ElementPath.findall(self, path)
 
     def clear(self):
-        self.attrib.clear()
-        self._children = []
-        self.text = self.tail = None
+        self._changed()
+        for child in self._ownchildren():
+            child.parent = None
+            helper.indexdiscard(self, child)
+        helper.indexrename(self, self._attrib.get(_MELD_ID), None)
+        self._attrib = _NOATTRIB
+        self._children = _NOCHILDREN
+        self._text = self._tail = None
 
     def get(self, key, default=None):
-        return self.attrib.get(key, default)
+        return self._attrib.get(key, default)
 
     def set(self, key, value):
-        self.attrib[key] = value
+        self._changed()
+        if key == _MELD_ID:
+            helper.indexrename(self, self._attrib.get(_MELD_ID), value)
+        self._ownattrib()[key] = value
 
     def keys(self):
-        return list(self.attrib.keys())
+        return list(self._attrib.keys())
 
     def items(self):
-        return list(self.attrib.items())
+        return list(self._attrib.items())
 
     def getiterator(self, *ignored_args, **ignored_kw):
         # we ignore any tag= passed in to us, originally because it was too
         # painfail to support in the old C extension, now for b/w compat
         return helper.getiterator(self)
 
+    def iter(self, tag=None):
+        """ Return a lazy iterator over this element and its descendants
+        in document order.  If 'tag' is not None (or '*'), only elements
+        with that tag are produced. """
+        return helper.iter(self, tag)
+
     # overrides to support parent pointers and factories
 
     def __setitem__(self, index, element):
+        children = self._ownchildren()
         if isinstance(index, slice):
+            element = list(element)
+            for ob in children[index]:
+                ob.parent = None
+                helper.indexdiscard(self, ob)
             for e in element:
                 e.parent = self
+                helper.indexadd(self, e)
         else:
+            ob = children[index]
+            ob.parent = None
+            helper.indexdiscard(self, ob)
             element.parent = self
+            helper.indexadd(self, element)
 
-        self._children[index] = element
+        children[index] = element
 
     # TODO: Can __setslice__ be removed now?
     def __setslice__(self, start, stop, elements):
-        for element in elements:
-            element.parent = self
-        self._children[start:stop] = list(elements)
+        self.__setitem__(slice(start, stop), elements)
 
     def append(self, element):
-        self._children.append(element)
+        self._ownchildren().append(element)
         element.parent = self
+        helper.indexadd(self, element)
 
     def insert(self, index, element):
-        self._children.insert(index, element)
+        self._ownchildren().insert(index, element)
         element.parent = self
+        helper.indexadd(self, element)
 
     def __delitem__(self, index):
+        children = self._ownchildren()
         if isinstance(index, slice):
-            for ob in self._children[index]:
-                ob.parent = None
+            obs = children[index]
         else:
-            self._children[index].parent = None
+            obs = [children[index]]
+        for ob in obs:
+            ob.parent = None
+            helper.indexdiscard(self, ob)
 
-        ob = self._children[index]
-        del self._children[index]
+        del children[index]
 
     # TODO: Can __delslice__ be removed now?
     def __delslice__(self, start, stop):
-        obs = self._children[start:stop]
-        for ob in obs:
-            ob.parent = None
-        del self._children[start:stop]
+        self.__delitem__(slice(start, stop))
 
     def remove(self, element):
-        self._children.remove(element)
+        self._ownchildren().remove(element)
         element.parent = None
+        helper.indexdiscard(self, element)
 
     def makeelement(self, tag, attrib):
         return self.__class__(tag, attrib)
@@ -276,10 +1147,12 @@ class _MeldElementInterface:
         and the keyword values as text that should fill in the node
         text on which that meld id is found.  Return a list of keys
         from **kw that were not able to be found anywhere in the tree.
-        Never raises an exception. """
+        Never raises an exception.  All keys are looked up together, so
+        the tree is walked at most once however many keys are passed."""
+        found = helper.lookupmelds(self, kw)
         unfilled = []
         for k in kw:
-            node = self.findmeld(k)
+            node = found.get(k)
             if node is None:
                 unfilled.append(k)
             else:
@@ -335,9 +1208,10 @@ class _MeldElementInterface:
         """
 
         unfilled = []
+        nodes = helper.lookupmelds(self, kw)
 
         for k in kw:
-            node = self.findmeld(k)
+            node = nodes.get(k)
 
             if node is None:
                 unfilled.append(k)
@@ -354,11 +1228,11 @@ class _MeldElementInterface:
                 unfound = []
 
                 for child in node.findall('input'):
-                    input_type = child.attrib.get('type', '').lower()
+                    input_type = child.get('type', '').lower()
                     if input_type not in ('checkbox', 'radio'):
                         continue
 
-                    input_val = child.attrib.get('value', '')
+                    input_val = child.get('value', '')
 
                     if val == input_val:
                         found.append(child)
@@ -378,11 +1252,11 @@ class _MeldElementInterface:
                             pass
             else:
 
-                tag = node.tag.lower()
+                tag = node._tag.lower()
 
                 if tag == 'input':
 
-                    input_type = node.attrib.get('type', 'text').lower()
+                    input_type = node.get('type', 'text').lower()
 
                     # fill in value attrib for most input types
                     if input_type in ('hidden', 'submit', 'text',
@@ -411,7 +1285,7 @@ class _MeldElementInterface:
                     unfound = []
 
                     for option in node.findall('option'):
-                        if option.attrib.get('value', '') == val:
+                        if option.get('value', '') == val:
                             found.append(option)
                         else:
                             unfound.append(option)
@@ -432,11 +1306,17 @@ class _MeldElementInterface:
 
     def findmeld(self, name, default=None):
         """ Find a node in the tree that has a 'meld id' corresponding
-        to 'name'. Iterate over all subnodes recursively looking for a
-        node which matches.  If we can't find the node, return None."""
-        # this could be faster if we indexed all the meld nodes in the
-        # tree; we just walk the whole hierarchy now.
-        result = helper.findmeld(self, name)
+        to 'name'.  The lookup is answered from the meld id index kept
+        on the root of the tree (built at parse time and maintained by
+        the mutator methods; change meld ids with 'set' or 'attributes'
+        so the index sees them).  If we can't find the node, return
+        'default'."""
+        result = _lookup(helper.meldindex(self), self, name)
+        if result is _marker:
+            # the id is carried by more than one element (e.g. by the
+            # clones made by 'repeat'), so walk our subtree to find the
+            # first one in document order
+            result = helper.findmeld(self, name)
         if result is None:
             return default
         return result
@@ -451,10 +1331,9 @@ class _MeldElementInterface:
         'value' is not None, omit nodes on which the attribute value
         does not compare equally to 'value'. Return the found nodes in
         a list."""
-        iterator = helper.getiterator(self)
         elements = []
-        for element in iterator:
-            attribval = element.attrib.get(attrib)
+        for element in helper.iter(self):
+            attribval = element._attrib.get(attrib)
             if attribval is not None:
                 if value is None:
                     elements.append(element)
@@ -464,7 +1343,7 @@ class _MeldElementInterface:
         return elements
 
     # ZPT-alike methods
-    def repeat(self, iterable, childname=None):
+    def repeat(self, iterable, childname=None, cow=False):
         """repeats an element with values from an iterable.  If
         'childname' is not None, repeat the element on which the
         repeat is called, otherwise find the child element with a
@@ -477,25 +1356,62 @@ class _MeldElementInterface:
         children) which has already been seated in its parent element
         in the template. 'data' is a value from the passed in
         iterable.  Changing 'newelement' (typically based on values
-        from 'data') mutates the element 'in place'."""
+        from 'data') mutates the element 'in place'.  If 'cow' is true,
+        the clones are made copy-on-write from a frozen copy of the
+        element (see 'clone'), which is cheaper when only a few nodes
+        of each are changed."""
         if childname:
             element = self.findmeld(childname)
         else:
             element = self
 
         parent = element.parent
-        # creating a list is faster than yielding a generator (py 2.4)
-        L = []
-        first = True
-        for thing in iterable:
-            if first is True:
-                clone = element
-            else:
-                clone = helper.bfclone(element, parent)
-            L.append((clone, thing))
-            first = False
+        paused = _pausegc()
+        try:
+            if cow:
+                template = helper.bfclone(element)
+                helper.freeze(template)
+            # creating a list is faster than yielding a generator (py 2.4)
+            L = []
+            first = True
+            for thing in iterable:
+                if first is True:
+                    clone = element
+                elif cow:
+                    clone = helper.cowclone(template, parent)
+                else:
+                    clone = helper.bfclone(element, parent)
+                L.append((clone, thing))
+                first = False
+        finally:
+            if paused:
+                _resumegc()
         return L
 
+    def streamrepeat(self, iterable, callback, childname=None):
+        """ Like 'repeat', but for very large iterables: rather than
+        seating a clone per item in the tree right away, replace the
+        element (or the child element with the meld id 'childname')
+        with a StreamRepeat node.  When the tree is written, that node
+        clones the element for one item at a time, calls
+        'callback(clone, item)' to fill the clone in, writes it out and
+        lets it go before moving on to the next item, so memory use
+        doesn't grow with the number of items when the tree is written
+        with one of the iter_* or write_* methods.  The iterable is
+        consumed when the tree is written.  The element must have a
+        parent, otherwise a ValueError is raised."""
+        if childname:
+            element = self.findmeld(childname)
+        else:
+            element = self
+        parent = element.parent
+        if parent is None:
+            raise ValueError('cannot repeat an element which has no parent')
+        i = element.deparent()
+        node = StreamRepeat(element, iterable, callback)
+        parent._ownchildren().insert(i, node)
+        node.parent = parent
+
     def replace(self, text, structure=False):
         """ Replace this element with a Replace node in our parent with
         the text 'text' and return the index of our position in
@@ -507,7 +1423,7 @@ class _MeldElementInterface:
         if i is not None:
             # reduce function call overhead by not calliing self.insert
             node = Replace(text, structure)
-            parent._children.insert(i, node)
+            parent._ownchildren().insert(i, node)
             node.parent = parent
             return i
 
@@ -526,7 +1442,10 @@ class _MeldElementInterface:
                 raise ValueError('do not set non-stringtype as key: %s' % k)
             if not isinstance(v, StringTypes):
                 raise ValueError('do not set non-stringtype as val: %s' % v)
-            self.attrib[k] = kw[k]
+            self._changed()
+            if k == _MELD_ID:
+                helper.indexrename(self, self._attrib.get(_MELD_ID), v)
+            self._ownattrib()[k] = kw[k]
 
     # output methods
     def write_xmlstring(self, encoding=None, doctype=None, fragment=False,
@@ -561,9 +1480,26 @@ class _MeldElementInterface:
         """
         if not hasattr(file, "write"):
             file = open(file, "wb")
-        data = self.write_xmlstring(encoding, doctype, fragment, declaration,
-                                    pipeline)
-        file.write(data)
+        for chunk in self.iter_xml(encoding, doctype, fragment, declaration,
+                                   pipeline):
+            file.write(chunk)
+
+    def iter_xml(self, encoding=None, doctype=None, fragment=False,
+                 declaration=True, pipeline=False, chunksize=CHUNKSIZE):
+        """ Return an iterator over the XML serialization of this element
+        (see 'write_xml' for the arguments) which produces it as it is
+        generated, in byte strings of about 'chunksize' bytes, instead of
+        building the whole document in memory first.  The iterator can
+        be returned as-is as the body of a WSGI response.  Don't mutate
+        the tree while it is being consumed. """
+        head = []
+        if not fragment:
+            if declaration:
+                _write_declaration(head.append, encoding)
+            if doctype:
+                _write_doctype(head.append, doctype)
+        return _chunked(head, _iter_xml(self, encoding, {}, pipeline),
+                        chunksize)
 
     def write_htmlstring(self, encoding=None, doctype=doctype.html,
                          fragment=False):
@@ -600,8 +1536,24 @@ class _MeldElementInterface:
         """
         if not hasattr(file, "write"):
             file = open(file, "wb")
-        page = self.write_htmlstring(encoding, doctype, fragment)
-        file.write(page)
+        for chunk in self.iter_html(encoding, doctype, fragment):
+            file.write(chunk)
+
+    def iter_html(self, encoding=None, doctype=doctype.html, fragment=False,
+                  chunksize=CHUNKSIZE):
+        """ Return an iterator over the HTML serialization of this element
+        (see 'write_html' for the arguments) which produces it as it is
+        generated, in byte strings of about 'chunksize' bytes, instead of
+        building the whole document in memory first.  The iterator can
+        be returned as-is as the body of a WSGI response.  Don't mutate
+        the tree while it is being consumed. """
+        head = []
+        if encoding is None:
+            encoding = 'utf8'
+        if not fragment:
+            if doctype:
+                _write_doctype(head.append, doctype)
+        return _chunked(head, _iter_html(self, encoding, {}), chunksize)
 
     def write_xhtmlstring(self, encoding=None, doctype=doctype.xhtml,
                           fragment=False, declaration=False, pipeline=False):
@@ -634,16 +1586,203 @@ class _MeldElementInterface:
         """
         if not hasattr(file, "write"):
             file = open(file, "wb")
-        page = self.write_xhtmlstring(encoding, doctype, fragment, declaration,
-                                      pipeline)
-        file.write(page)
-
-    def clone(self, parent=None):
+        for chunk in self.iter_xhtml(encoding, doctype, fragment, declaration,
+                                     pipeline):
+            file.write(chunk)
+
+    def iter_xhtml(self, encoding=None, doctype=doctype.xhtml, fragment=False,
+                   declaration=False, pipeline=False, chunksize=CHUNKSIZE):
+        """ Return an iterator over the XHTML serialization of this element
+        (see 'write_xhtml' for the arguments) which produces it as it is
+        generated, in byte strings of about 'chunksize' bytes, instead of
+        building the whole document in memory first.  The iterator can
+        be returned as-is as the body of a WSGI response.  Don't mutate
+        the tree while it is being consumed. """
+        head = []
+        if not fragment:
+            if declaration:
+                _write_declaration(head.append, encoding)
+            if doctype:
+                _write_doctype(head.append, doctype)
+        return _chunked(head, _iter_xml(self, encoding, {}, pipeline, True),
+                        chunksize)
+
+    def compile(self, method='html', encoding=None):
+        """ Precompute, for this element and all of its descendants, the
+        bytes which the writers produce for each node itself (start tag
+        with its sorted and escaped attributes, text, end tag and tail),
+        so that rendering mostly consists of joining those chunks.
+
+        method      - 'html', 'xhtml' or 'xml'; the output method the
+                      chunks are computed for.
+        encoding    - the encoding which will be passed to the write
+                      method (None means that method's default).
+
+        Clones made afterwards (including those made by 'repeat') share
+        the chunks.  A node's chunks are discarded as soon as its tag,
+        attributes, text or tail change, so the mutated parts of a tree
+        (filled-in meld ids, Replace nodes and the like) are serialized
+        as usual.  Nodes whose output depends on namespace prefixes
+        allocated while writing, and 'pipeline' output, are never
+        precomputed.
+
+        In addition, subtrees without any meld ids, Replace nodes or
+        nodes which can't be precomputed (typically headers, footers,
+        navigation and the like) are serialized as a whole, and written
+        in one piece from then on.  Their nodes stay in the tree; when
+        one of them changes, the serialized subtrees it is part of are
+        thrown away. """
+        key = _renderkey(method, encoding)
+        method, encoding = key
+        xhtml = method == 'xhtml'
+        nodes = list(helper.iter(self))
+        for node in nodes:
+            if node._tag is Replace:
+                continue
+            if method == 'html':
+                if not _html_static(node):
+                    continue
+                parts = _html_parts(node, encoding, {})
+            else:
+                if not _xml_static(node, xhtml):
+                    continue
+                parts = _xml_parts(node, encoding, {}, False, xhtml, [])
+            compiled = node._compiled
+            if compiled is None:
+                compiled = node._compiled = {}
+            compiled[key] = parts
+
+        # find the subtrees which are static all the way down (children
+        # come after their parents in 'nodes'), and serialize the
+        # outermost ones
+        static = {}
+        for node in reversed(nodes):
+            compiled = node._compiled
+            if (compiled is None or key not in compiled or
+                node._attrib.get(_MELD_ID) is not None):
+                continue
+            for child in node._children:
+                if id(child) not in static:
+                    break
+            else:
+                static[id(node)] = True
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if id(node) not in static:
+                stack.extend(node._children)
+                continue
+            rendered = node._rendered
+            if rendered is None:
+                rendered = node._rendered = {}
+            rendered[key] = _render(node, method, encoding)
+            for covered in helper.iter(node):
+                covered._flags |= _COVERED
+
+    def clone(self, parent=None, cow=False):
         """ Create a clone of an element.  If parent is not None,
         append the element to the parent.  Recurse as necessary to create
-        a deep clone of the element. """
+        a deep clone of the element.
+
+        If 'cow' is true, the element must have been frozen (see
+        'freeze') and the clone is made copy-on-write: only the nodes
+        leading to elements with meld ids are copied right away; the
+        rest of the clone shares its nodes and attribute dictionaries
+        with the element, and copies them the first time they're
+        visited or changed. """
+        if cow:
+            return helper.cowclone(self, parent)
         return helper.bfclone(self, parent)
 
+    def fingerprint(self):
+        """ Return a hash (a string of hex digits) of this element's
+        tag, sorted attributes, text and tail and of the fingerprints of
+        its children.  Elements with equal fingerprints serialize the
+        same way, so fingerprints can be compared instead of subtrees
+        and used as cache keys.  Fingerprints are kept once computed and
+        thrown away when an element or one of its descendants changes,
+        so asking again for an unchanged subtree costs nothing; clones
+        start out with the fingerprints of their originals.  A subtree
+        containing a pending 'streamrepeat' raises a ValueError. """
+        return helper.fingerprint(self)
+
+    def memoize(self):
+        """ Make the writers keep the bytes they write for this element
+        and each of its descendants (per output method and encoding),
+        and write those again as long as the element is unchanged.  When
+        an element changes, its bytes and those of its ancestors are
+        thrown away, so rewriting a long-lived tree after a few changes
+        only serializes the changed elements and the elements on their
+        way up, and splices in the bytes of everything else.  Memoizing
+        trades memory for speed: each element's bytes include those of
+        its descendants. """
+        self._flags |= _MEMO
+
+    def journal(self):
+        """ Start recording the changes made to this element (which must
+        be the root of its tree) and its descendants through the element
+        API, so that 'reset' can undo them.  A worker can then fill in,
+        write and reset one resident tree for every request instead of
+        cloning a template each time.  Journaling carries on after a
+        reset.  Only the first change to each element is remembered:
+        elements added to the tree (such as the copies made by 'repeat')
+        aren't journaled, they are simply taken out again by 'reset'. """
+        if self._journal is not None:
+            return
+        if self.parent is not None:
+            raise ValueError('only the root of a tree can be journaled')
+        journal = _Journal(self, _copyindex(helper.meldindex(self)))
+        for node in helper._walk(self):
+            node._journal = journal
+
+    def reset(self):
+        """ Undo all of the changes made to this element and its
+        descendants since 'journal' was called, or since the last reset,
+        most recent first. """
+        journal = self._journal
+        if journal is None or journal.element is not self:
+            raise ValueError('%r is not journaled' % self)
+        helper.reset(journal)
+
+    def weakparents(self):
+        """ Make the parent links of this element (which must be the
+        root of its tree) and its descendants weak references, so that
+        the tree holds no reference cycles (unless it is journaled) and
+        is freed as soon as the last reference to its root goes away,
+        rather than by the cyclic garbage collector.  Elements added to
+        the tree later, clones of its elements (including those made by
+        'repeat') and the copy-on-write clones of a frozen tree with weak
+        parent links have weak parent links too.  An element of such a
+        tree only keeps its ancestors alive while something else refers
+        to the root: once the root is gone, 'parent' is None.  Return
+        this element. """
+        if self._parent is not None:
+            raise ValueError('only the root of a tree can have weak '
+                             'parent links')
+        helper.weakparents(self)
+        return self
+
+    def dedup(self):
+        """ Make this element and its descendants share one copy of
+        each tag name, attribute name and value and whitespace-only text
+        or tail which occurs more than once among them, and one
+        read-only attribute dictionary for each set of equal attributes
+        (except those with a meld id); an element copies its dictionary
+        before its attributes change.  Clones share the dictionaries
+        too.  Meant for templates kept in memory, after they have been
+        parsed and before they are frozen.  Return roughly how many
+        bytes the duplicates took. """
+        return helper.dedup(self)
+
+    def freeze(self):
+        """ Make this element and its descendants read-only: changing
+        their tag, attributes, text, tail or children raises a
+        ValueError from now on, and 'attrib' is a read-only mapping.
+        Frozen elements can be cloned copy-on-write (see 'clone'), so a
+        template which is cloned over and over should be frozen once
+        after it has been parsed (and compiled). """
+        helper.freeze(self)
+
     def deparent(self):
         """ Remove ourselves from our parent node (de-parent) and return
         the index of the parent which was deleted. """
@@ -673,26 +1812,33 @@ class _MeldElementInterface:
                                """
         srcelements = self.findmelds()
         tgtelements = other.findmelds()
-        srcids = [ x.meldid() for x in srcelements ]
-        tgtids = [ x.meldid() for x in tgtelements ]
+        srcids = {}
+        for srcelement in srcelements:
+            srcids[srcelement._attrib.get(_MELD_ID)] = True
+        tgtids = {} # meld id -> first target element carrying it
+        for tgtelement in tgtelements:
+            tgtids.setdefault(tgtelement._attrib.get(_MELD_ID), tgtelement)
 
         removed = []
         for srcelement in srcelements:
-            if srcelement.meldid() not in tgtids:
+            if srcelement._attrib.get(_MELD_ID) not in tgtids:
                 removed.append(srcelement)
 
         added = []
         for tgtelement in tgtelements:
-            if tgtelement.meldid() not in srcids:
+            if tgtelement._attrib.get(_MELD_ID) not in srcids:
                 added.append(tgtelement)
 
         moved = []
+        # lineages are compared by the keys of their tag paths (see
+        # _pathkey), shared by both trees
+        memo = {}
+        keys = {}
         for srcelement in srcelements:
-            srcid = srcelement.meldid()
-            if srcid in tgtids:
-                i = tgtids.index(srcid)
-                tgtelement = tgtelements[i]
-                if not sharedlineage(srcelement, tgtelement):
+            tgtelement = tgtids.get(srcelement._attrib.get(_MELD_ID))
+            if tgtelement is not None:
+                if (_pathkey(srcelement.parent, memo, keys) !=
+                    _pathkey(tgtelement.parent, memo, keys)):
                     moved.append(tgtelement)
 
         unreduced = {'added':added, 'removed':removed, 'moved':moved}
@@ -708,7 +1854,7 @@ class _MeldElementInterface:
                 'reduced':reduced}
 
     def meldid(self):
-        return self.attrib.get(_MELD_ID)
+        return self._attrib.get(_MELD_ID)
 
     def lineage(self):
         L = []
@@ -719,19 +1865,76 @@ class _MeldElementInterface:
         return L
 
 class MeldTreeBuilder(TreeBuilder):
+    """ Build a meld element tree from the events of a parser.  This is
+    ElementTree's TreeBuilder, except that children are linked to their
+    parent and meld ids are indexed as elements are started, so the
+    tree is complete as soon as the parser is done with it. """
     def __init__(self):
         TreeBuilder.__init__(self, element_factory=_MeldElementInterface)
         self.meldids = {}
+        self._data = [] # data collected since the last start or end
+        self._elem = [] # stack of elements still open
+        self._last = None # the element last started or ended
+        self._tail = False # whether the data is _last's tail or text
+        self._root = None
+        self.events = None # a list to collect ended meld elements in
+
+    def close(self):
+        assert len(self._elem) == 0, "missing end tags"
+        assert self._root is not None, "missing toplevel element"
+        root = self._root
+        # the ids collected while parsing become the tree's meld id index
+        root._meldindex = self.meldids
+        # let go of the tree: the parser may keep this builder alive in a
+        # reference cycle (it does on Python 2) until the cyclic garbage
+        # collector runs, and trees with weak parent links shouldn't
+        # have to wait for it
+        self.meldids = {}
+        self._root = self._last = None
+        return root
+
+    def _flush(self):
+        if self._data:
+            if self._last is not None:
+                text = "".join(self._data)
+                if self._tail:
+                    self._last._tail = text
+                else:
+                    self._last._text = text
+            self._data = []
+
+    def data(self, data):
+        self._data.append(data)
 
     def start(self, tag, attrs):
-        elem = TreeBuilder.start(self, tag, attrs)
-        for key, value in attrs.items():
-            if key == _MELD_ID:
-                if value in self.meldids:
-                    raise ValueError('Repeated meld id "%s" in source' %
-                                     value)
-                self.meldids[value] = 1
-                break
+        self._flush()
+        self._last = elem = _MeldElementInterface(tag, attrs or _NOATTRIB)
+        stack = self._elem
+        if stack:
+            parent = stack[-1]
+            children = parent._children
+            if children is _NOCHILDREN:
+                children = parent._children = []
+            children.append(elem)
+            elem._parent = parent
+        elif self._root is None:
+            self._root = elem
+        stack.append(elem)
+        self._tail = False
+        meldid = attrs.get(_MELD_ID)
+        if meldid is not None:
+            if meldid in self.meldids:
+                raise ValueError('Repeated meld id "%s" in source' %
+                                 meldid)
+            self.meldids[meldid] = [elem]
+        return elem
+
+    def end(self, tag):
+        self._flush()
+        self._last = elem = self._elem.pop()
+        self._tail = True
+        if self.events is not None and elem._attrib.get(_MELD_ID) is not None:
+            self.events.append(elem)
         return elem
 
     def comment(self, data):
@@ -867,12 +2070,13 @@ class HTMLMeldParser(HTMLParser):
         self.builder.end(Comment)
 
 def do_parse(source, parser):
-    root = et_parse(source, parser=parser).getroot()
-    iterator = root.getiterator()
-    for p in iterator:
-        for c in p:
-            c.parent = p
-    return root
+    # the builder links and indexes the tree while it's being parsed
+    paused = _pausegc()
+    try:
+        return et_parse(source, parser=parser).getroot()
+    finally:
+        if paused:
+            _resumegc()
 
 def parse_xml(source):
     """ Parse source (a filelike object) into an element tree.  If
@@ -895,6 +2099,1210 @@ def parse_htmlstring(text, encoding=None):
     source = StringIO(text)
     return parse_html(source, encoding)
 
+_META_TAG_RE = re.compile(_b(r'<meta\b[^>]*>'), re.I)
+
+class MeldFeedParser(object):
+    """ A push parser: feed it the source of an XML (or, if 'html' is
+    true, HTML) document piece by piece as it arrives, then call close()
+    to get the element tree, which is exactly what parse_xml or
+    parse_html would have returned.  'encoding' has the same meaning as
+    for parse_html: byte strings fed are decoded with it, or with the
+    charset declared by a <meta http-equiv="content-type"> tag for
+    the bytes following that tag.
+
+    If 'events' is true, each element with a meld id is also reported
+    as soon as its end tag has been parsed; read_events() returns
+    those reported since it was last called.  Such elements are
+    complete, except for their tail, and the elements following them
+    in their parent, which haven't been parsed yet. """
+    def __init__(self, html=False, encoding=None, events=False):
+        self._builder = builder = MeldTreeBuilder()
+        if events:
+            builder.events = []
+        if html:
+            self._parser = parser = HTMLMeldParser(builder, encoding)
+            # decode what we're fed the way HTMLMeldParser decodes the
+            # byte strings it's given, but incrementally: a character
+            # can be split between two pieces
+            self._encoding = parser.encoding
+            self._decoder = codecs.getincrementaldecoder(parser.encoding)()
+            self._pending = _BLANK # bytes held back, see feed
+        else:
+            self._parser = MeldParser(target=builder)
+        self._html = html
+
+    def feed(self, data):
+        if not (self._html and isinstance(data, bytes)):
+            self._parser.feed(data)
+            return
+        # a <meta> tag may declare the charset of what follows it: hand
+        # the parser everything up to the end of each one before
+        # decoding any more, and switch decoders if it changed the
+        # parser's encoding
+        data = self._pending + data
+        match = _META_TAG_RE.search(data)
+        while match is not None:
+            end = match.end()
+            self._decode(data[:end])
+            data = data[end:]
+            match = _META_TAG_RE.search(data)
+        # hold back a tag which isn't complete yet, it may be a <meta>
+        i = data.rfind(_LT)
+        if i != -1 and data.find(_GT, i) == -1:
+            self._pending = data[i:]
+            data = data[:i]
+        else:
+            self._pending = _BLANK
+        self._decode(data)
+
+    def _decode(self, data):
+        parser = self._parser
+        parser.feed(self._decoder.decode(data))
+        if parser.encoding != self._encoding:
+            # the tag just fed ends with '>', so the old decoder holds
+            # no partial character
+            self._encoding = parser.encoding
+            self._decoder = codecs.getincrementaldecoder(parser.encoding)()
+
+    def read_events(self):
+        events = self._builder.events
+        if not events:
+            return []
+        self._builder.events = []
+        return events
+
+    def close(self):
+        if self._html:
+            rest = self._decoder.decode(self._pending, True)
+            if rest:
+                self._parser.feed(rest)
+        return self._parser.close()
+
+class TemplateCache(object):
+    """ A cache of parsed templates.  Its parse_* methods take the same
+    arguments as the module-level functions of the same name (except
+    that parse_xml and parse_html take a file name rather than a file
+    object) and return a copy-on-write clone of a frozen, pristine
+    parse of the template, which is only parsed again when the file's
+    modification time or size changes.  Templates passed as strings
+    are cached by a hash of their content.  At most 'maxsize'
+    templates are kept; the least recently used ones are evicted
+    first.  On Python 3, parse_html decodes the file with the
+    'encoding' passed, else with the charset its <meta> tag declares,
+    else as a file opened in text mode would be.
+
+    If 'cachedir' is given, parsed templates are also saved in that
+    directory, named after a hash of their source, so that other
+    processes (and later runs) load them from there instead of
+    parsing them.
+
+    If 'weakparents' is true, the templates and their clones have weak
+    parent links (see MeldElementInterface.weakparents).
+
+    See 'gcfreeze' for hiding the resident templates from the cyclic
+    garbage collector once they have been loaded.
+
+    If 'dedup' is true, the repeated strings and attribute dictionaries
+    of every template parsed are shared (see
+    MeldElementInterface.dedup); 'saved' maps the name of each template
+    in the cache (its file name, or the hash of its text) to the number
+    of bytes that saved. """
+    def __init__(self, maxsize=128, cachedir=None, weakparents=False,
+                 dedup=False):
+        self.maxsize = maxsize
+        self.cachedir = cachedir
+        self.weakparents = weakparents
+        self.dedup = dedup
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict() # key -> (stamp, template, saved)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def _getsaved(self):
+        saved = {}
+        self._lock.acquire()
+        try:
+            for key, entry in self._templates.items():
+                if entry[2] is not None:
+                    saved[key[1]] = entry[2]
+        finally:
+            self._lock.release()
+        return saved
+    saved = property(_getsaved)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._templates.clear()
+        finally:
+            self._lock.release()
+
+    def gcfreeze(self):
+        """ Call once the templates have been loaded (after warming the
+        cache up, or before forking workers): run a collection, then move
+        everything alive, the resident templates included, out of the
+        cyclic garbage collector's sight with gc.freeze, so that full
+        collections don't go through them over and over.  Frozen objects
+        are only ever freed by reference counting: templates evicted
+        from the cache later go away if they have weak parent links,
+        and stay in memory otherwise.  gc.freeze needs Python 3.7 or
+        later; this does nothing on older versions. """
+        _gcfreeze()
+
+    def parse_xml(self, filename):
+        return self._get('xml', filename, None, _filestamp(filename))
+
+    def parse_html(self, filename, encoding=None):
+        return self._get('html', filename, encoding, _filestamp(filename))
+
+    def parse_xmlstring(self, text):
+        return self._get('xmlstring', _digest(text), None, None, text)
+
+    def parse_htmlstring(self, text, encoding=None):
+        return self._get('htmlstring', _digest(text), encoding, None, text)
+
+    def _get(self, kind, name, encoding, stamp, text=None):
+        key = (kind, name, encoding)
+        templates = self._templates
+        self._lock.acquire()
+        try:
+            entry = templates.pop(key, None)
+            if entry is not None and entry[0] == stamp:
+                # put it back as the most recently used
+                templates[key] = entry
+                self.hits += 1
+                template = entry[1]
+            else:
+                self.misses += 1
+                template = None
+        finally:
+            self._lock.release()
+        if template is None:
+            template = self._load(kind, name, encoding, text)
+            saved = None
+            if self.dedup:
+                saved = template.dedup()
+            if self.weakparents:
+                template.weakparents()
+            template.freeze()
+            self._lock.acquire()
+            try:
+                templates[key] = (stamp, template, saved)
+                while len(templates) > self.maxsize:
+                    templates.popitem(last=False)
+            finally:
+                self._lock.release()
+        return template.clone(cow=True)
+
+    def _load(self, kind, name, encoding, text):
+        if text is None:
+            # a file: read it once, both to hash and to parse it
+            f = open(name, 'rb')
+            try:
+                text = f.read()
+            finally:
+                f.close()
+            digest = _digest(text)
+        else:
+            digest = name
+        if self.cachedir is None:
+            return _PARSERS[kind](text, encoding)
+        filename = os.path.join(self.cachedir, _digest(
+            '%s %s %s %s %s' % (kind, encoding, digest, _DUMP_FORMAT,
+                                __version__)))
+        template = _loadfile(filename)
+        if template is None:
+            template = _PARSERS[kind](text, encoding)
+            _dumpfile(filename, template)
+        return template
+
+def _filestamp(filename):
+    st = os.stat(filename)
+    return st.st_mtime, st.st_size
+
+def _digest(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+def _parse_xmlbytes(data, encoding=None):
+    return parse_xml(BytesIO(data))
+
+# a charset declared by a <meta> tag, as <meta charset="..."> or
+# <meta http-equiv="content-type" content="text/html; charset=...">
+_META_CHARSET_RE = re.compile(
+    _b(r'<meta\s[^>]*?charset\s*=\s*["\']?\s*([-\w.:]+)'), re.I)
+
+def _parse_htmlbytes(data, encoding=None):
+    if PY3:
+        # HTMLParser wants text: decode the file with the encoding
+        # passed, else the charset the document declares, else the
+        # encoding parse_html(open(filename)) would have read it with
+        if encoding is None:
+            match = _META_CHARSET_RE.search(data)
+            if match is not None:
+                encoding = match.group(1).decode('ascii')
+                try:
+                    codecs.lookup(encoding)
+                except LookupError:
+                    encoding = None
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+        data = _u(data, encoding)
+    return parse_htmlstring(data, encoding)
+
+_PARSERS = {
+    'xml':_parse_xmlbytes,
+    'html':_parse_htmlbytes,
+    'xmlstring':lambda text, encoding: parse_xmlstring(text),
+    'htmlstring':parse_htmlstring,
+    }
+
+# Parsed trees can be dumped to (and loaded from) a compact binary
+# format: the marshalled form of nested tuples
+#
+#   (tag, attrib, text, tail, children)
+#
+# where 'tag' is None for comments, 0 or 1 for Replace nodes (1 if
+# their text is structure), 'attrib' is None when there are no
+# attributes and 'children' is a tuple of such tuples.  The tuple of a
+# tree is wrapped in a header holding _DUMP_FORMAT, the version of
+# meld3 and the version of Python (marshal's format varies between
+# versions); dumps whose header doesn't match are ignored, and so are
+# dumps which don't have this shape.  Bump _DUMP_FORMAT whenever the
+# layout of the tuples, or what the parsers produce, changes.
+
+_DUMP_FORMAT = 2
+
+def _dumps(element):
+    return marshal.dumps((_DUMP_FORMAT, __version__, sys.version,
+                          _dumpnode(element)))
+
+def _dumpnode(node):
+    tag = node._tag
+    if tag is Comment:
+        tag = None
+    elif tag is Replace:
+        tag = node.structure and 1 or 0
+    elif not isinstance(tag, StringTypes):
+        raise ValueError('cannot dump element with tag %r' % (tag,))
+    attrib = node._attrib
+    if attrib.__class__ is _SharedAttrib:
+        attrib = attrib.copy() # marshal only takes plain dicts
+    return (tag, attrib or None, node._text, node._tail,
+            tuple([_dumpnode(child) for child in node._children]))
+
+def _loads(data, weakparents=False):
+    """ Return the tree dumped in 'data', or None if 'data' wasn't
+    dumped by this version of meld3 and Python.  If 'weakparents' is
+    true, the tree has weak parent links. """
+    try:
+        format, version, pyversion, tree = marshal.loads(data)
+        if (format != _DUMP_FORMAT or version != __version__ or
+            pyversion != sys.version):
+            return None
+        index = {}
+        paused = _pausegc()
+        try:
+            root = _loadnode(tree, None, index,
+                             weakparents and _WEAKPARENT or 0)
+        finally:
+            if paused:
+                _resumegc()
+    except (EOFError, ValueError, TypeError, IndexError, AttributeError):
+        # not a dump, or a damaged one
+        return None
+    root._meldindex = index
+    return root
+
+def _loadnode(data, parent, index, weak):
+    # 'parent' is what the element's _parent holds: the parent element,
+    # or a weak reference to it if 'weak' is _WEAKPARENT
+    tag, attrib, text, tail, children = data
+    structure = None
+    if tag is None:
+        tag = Comment
+    elif tag == 0 or tag == 1:
+        structure = bool(tag)
+        tag = Replace
+    element = _MeldElementInterface(tag, attrib or _NOATTRIB)
+    element._parent = parent
+    element._flags = weak
+    element._text = text
+    element._tail = tail
+    if structure is not None:
+        element.structure = structure
+    if attrib:
+        meldid = attrib.get(_MELD_ID)
+        if meldid is not None:
+            index.setdefault(meldid, []).append(element)
+    if children:
+        if weak:
+            link = weakref.ref(element)
+        else:
+            link = element
+        element._children = [_loadnode(child, link, index, weak)
+                             for child in children]
+    return element
+
+def _loadfile(filename):
+    try:
+        f = open(filename, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    return _loads(data)
+
+def _dumpfile(filename, element):
+    # write to a temporary file which is then renamed, so that readers
+    # never see a partially written dump; failing to write one is not
+    # an error, the template just gets parsed again next time
+    try:
+        data = _dumps(element)
+    except ValueError: # too deeply nested for marshal
+        return
+    dirname = os.path.dirname(filename)
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tempname = tempfile.mkstemp(dir=dirname)
+    except (IOError, OSError):
+        return
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        _rename(tempname, filename)
+    except (IOError, OSError):
+        try:
+            os.remove(tempname)
+        except OSError:
+            pass
+
+_rename = getattr(os, 'replace', os.rename)
+
+class TemplateRegistry(object):
+    """ Templates for servers which load them in a master process and
+    then fork worker processes.  The templates added are kept as flat
+    trees only (see FlatTree): a few arrays of integers and a table of
+    strings per template, rather than an object per node.  'getflat'
+    hands out a copy-on-write clone of a template's flat tree, which
+    workers fill in and write without making an element of it; 'get'
+    builds an element tree from it every time it is called.
+
+    Call 'prefork' once all templates have been added, right before
+    forking.  It compiles the flat trees (see FlatTree.compile), so
+    that writing a clone slices the unchanged stretches out of one byte
+    string per template and only serializes the nodes the worker
+    changed, and hides everything then alive from the cyclic garbage
+    collector with gc.freeze (Python 3.7+).  Workers then only change
+    the reference counts of a few objects per template (the flat tree,
+    its arrays and byte strings, and the strings of the nodes they
+    change), rather than of an object per node, so most of the memory
+    holding the templates stays shared between the master and its
+    workers.  'get' reads every string of the template, and the trees
+    it builds are the worker's own.
+
+    If 'weakparents' is true, the trees handed out have weak parent
+    links (see MeldElementInterface.weakparents). """
+    def __init__(self, weakparents=False):
+        self.weakparents = weakparents
+        self._templates = {} # name -> FlatTree
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __contains__(self, name):
+        return name in self._templates
+
+    def add(self, name, element):
+        """ Add the tree 'element' (typically just parsed) under 'name',
+        replacing any template of that name.  Trees containing nodes
+        other than elements, comments, processing instructions and
+        Replace nodes raise a ValueError. """
+        self._templates[name] = FlatTree(element)
+
+    def get(self, name):
+        """ Return a new element tree made from the template added as
+        'name'; a KeyError is raised if there is none. """
+        return self._templates[name].totree(self.weakparents)
+
+    def getflat(self, name):
+        """ Return a clone of the flat tree of the template added as
+        'name'; a KeyError is raised if there is none. """
+        return self._templates[name].clone()
+
+    def prefork(self, methods=('html',), encoding=None):
+        """ Get ready for forking: compile every template for each of
+        'methods' ('html', 'xhtml' or 'xml') in 'encoding', run a
+        collection, then freeze everything alive with gc.freeze (if
+        there is one) """
+        for flat in self._templates.values():
+            for method in methods:
+                flat.compile(method, encoding)
+        _gcfreeze()
+
+class FragmentCache(object):
+    """ A cache of the serialized bytes of subtrees (sidebars, menus,
+    footers and the like) which are the same from one rendering to the
+    next.  'render' looks an element up by a key of the caller's choice
+    or by its fingerprint and attaches the cached bytes to it, so that
+    the writers emit them instead of serializing the subtree again.  At
+    most 'maxsize' fragments, and if 'maxbytes' is not None at most that
+    many bytes of them, are kept; the least recently used ones are
+    evicted first. """
+    def __init__(self, maxsize=1024, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._fragments = OrderedDict() # (key, method, encoding) -> bytes
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._fragments.clear()
+            self.nbytes = 0
+        finally:
+            self._lock.release()
+
+    def render(self, element, method='html', encoding=None, key=None):
+        """ Return the serialization of 'element' (including its tail)
+        for the output method 'method' ('html', 'xhtml' or 'xml') and
+        'encoding', from the cache if it's there under 'key' (or under
+        the element's fingerprint if 'key' is None), and make the
+        writers emit those bytes for 'element' until it or one of its
+        descendants changes.  A key passed by the caller is trusted to
+        identify the content of the subtree.  Subtrees whose output
+        depends on the rest of the document (namespace prefixes,
+        pending 'streamrepeat' calls) raise a ValueError. """
+        renderkey = _renderkey(method, encoding)
+        method, encoding = renderkey
+        # check the nodes still shared with a frozen template too, but
+        # only mark the others: the shared ones can't change
+        nodes = []
+        stack = [(element, False)]
+        while stack:
+            node, shared = stack.pop()
+            if not _static(node, method):
+                raise ValueError('%r cannot be rendered on its own' % node)
+            if not shared:
+                nodes.append(node)
+            shared = shared or node._flags & _SHAREDCHILDREN
+            for child in node._children:
+                stack.append((child, shared))
+        if key is None:
+            key = helper.fingerprint(element)
+        cachekey = (key, method, encoding)
+        fragments = self._fragments
+        self._lock.acquire()
+        try:
+            data = fragments.pop(cachekey, None)
+            if data is not None:
+                fragments[cachekey] = data
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+        if data is None:
+            data = _render(element, method, encoding)
+            self._lock.acquire()
+            try:
+                old = fragments.pop(cachekey, None)
+                if old is not None:
+                    self.nbytes -= len(old)
+                fragments[cachekey] = data
+                self.nbytes += len(data)
+                maxbytes = self.maxbytes
+                while fragments and (
+                    len(fragments) > self.maxsize or
+                    (maxbytes is not None and self.nbytes > maxbytes)):
+                    self.nbytes -= len(fragments.popitem(last=False)[1])
+            finally:
+                self._lock.release()
+        # the same mechanism as compile(): clones may share the
+        # dictionary of rendered subtrees, so it's replaced, not changed
+        rendered = {}
+        if element._rendered is not None:
+            rendered.update(element._rendered)
+        rendered[renderkey] = data
+        element._rendered = rendered
+        for node in nodes:
+            node._flags |= _COVERED
+        return data
+
+def _renderkey(method, encoding):
+    # the (method, encoding) pair under which the writers look for the
+    # bytes of a subtree, with the same default encodings as they use
+    if method == 'html':
+        if encoding is None:
+            encoding = 'utf8'
+    elif method in ('xml', 'xhtml'):
+        if encoding is None:
+            encoding = 'utf-8'
+    else:
+        raise ValueError('method must be one of "html", "xhtml" or '
+                         '"xml", not %r' % (method,))
+    return method, encoding
+
+def _static(node, method):
+    # can the bytes of 'node' itself be written anywhere in a document?
+    if node._tag is Replace:
+        return True
+    if method == 'html':
+        return _html_static(node)
+    return _xml_static(node, method == 'xhtml')
+
+def _render(node, method, encoding):
+    # the bytes of 'node' and its descendants as one piece
+    data = []
+    if method == 'html':
+        _write_html(data.append, node, encoding, {})
+    else:
+        _write_xml(data.append, node, encoding, {}, False,
+                   method == 'xhtml')
+    return _BLANK.join(data)
+
+class TemplatePool(object):
+    """ A pool of ready-made copies of a template, so that requests
+    don't have to wait for a clone to be made.  'acquire' hands out a
+    copy-on-write clone of 'template' and 'release' takes it back: the
+    changes made to it are undone (see 'journal') and it goes back into
+    the pool.  A template which isn't frozen is left alone: the pool
+    clones it once and freezes the clone.
+
+    The pool is filled up to 'highwater' clones; if 'background' is
+    true, a daemon thread fills it up again whenever it holds fewer than
+    'lowwater' clones, otherwise it is filled once and then relies on
+    released clones.  When it is empty, 'acquire' makes a clone itself.
+    The 'hits', 'misses', 'clones' and 'recycled' attributes count the
+    clones handed out from the pool, those made on demand, all clones
+    made, and the clones put back by 'release'. """
+    def __init__(self, template, lowwater=2, highwater=8, background=True):
+        if not 0 <= lowwater <= highwater:
+            raise ValueError('need 0 <= lowwater <= highwater')
+        if not template._flags & _FROZEN:
+            template = template.clone()
+            template.freeze()
+        self.template = template
+        self.lowwater = lowwater
+        self.highwater = highwater
+        self.hits = 0
+        self.misses = 0
+        self.clones = 0
+        self.recycled = 0
+        self._pool = []
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run,
+                                            name='meld3 template pool')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self.fill()
+
+    def __len__(self):
+        return len(self._pool)
+
+    def _clone(self):
+        element = self.template.clone(cow=True)
+        element.journal()
+        return element
+
+    def fill(self):
+        """ Clone the template until the pool holds 'highwater' clones """
+        cond = self._cond
+        while True:
+            cond.acquire()
+            try:
+                if self._closed or len(self._pool) >= self.highwater:
+                    return
+            finally:
+                cond.release()
+            # clone without holding the lock, so that acquire and
+            # release don't wait for us
+            element = self._clone()
+            cond.acquire()
+            try:
+                self._pool.append(element)
+                self.clones += 1
+            finally:
+                cond.release()
+
+    def acquire(self):
+        """ Return a clone of the template, from the pool if possible """
+        cond = self._cond
+        cond.acquire()
+        try:
+            pool = self._pool
+            if pool:
+                element = pool.pop()
+                self.hits += 1
+            else:
+                element = None
+                self.misses += 1
+            if len(pool) < self.lowwater:
+                cond.notify()
+        finally:
+            cond.release()
+        if element is None:
+            element = self._clone()
+            cond.acquire()
+            try:
+                self.clones += 1
+            finally:
+                cond.release()
+        return element
+
+    def release(self, element):
+        """ Undo the changes made to 'element', a clone handed out by
+        'acquire', and put it back into the pool unless the pool is full.
+        Clones which have been added to another tree are dropped. """
+        journal = element._journal
+        if (journal is None or journal.element is not element or
+            element.parent is not None):
+            return
+        element.reset()
+        cond = self._cond
+        cond.acquire()
+        try:
+            if not self._closed and len(self._pool) < self.highwater:
+                self._pool.append(element)
+                self.recycled += 1
+        finally:
+            cond.release()
+
+    def close(self):
+        """ Stop the background thread and empty the pool """
+        cond = self._cond
+        cond.acquire()
+        try:
+            self._closed = True
+            del self._pool[:]
+            cond.notify()
+        finally:
+            cond.release()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            self.fill()
+            cond.acquire()
+            try:
+                while not self._closed and len(self._pool) >= self.lowwater:
+                    cond.wait()
+                if self._closed:
+                    return
+            finally:
+                cond.release()
+
+# flat trees: templates as parallel arrays of integers, see FlatTree
+
+_FLAT_COMMENT = -1
+_FLAT_PI = -2
+_FLAT_REPLACE = -3
+_FLAT_STRUCTURE = -4 # a Replace node whose text is structure
+
+class _FlatNode(object):
+    # one node of a FlatTree in the shape the serializers expect: it is
+    # filled in again for each node whose output isn't cached
+    __slots__ = ('_tag', '_attrib', '_text', '_tail', 'structure')
+
+class FlatTree(object):
+    """ A compact, read-mostly copy of the tree 'element' (typically a
+    parsed template): one entry per node, in document order, in each of
+    a few parallel arrays of integers, the root being node 0.
+
+    strings      - the strings of the tree as flattened (tags,
+                   attribute names and values, texts and tails), each
+                   stored once
+    tags         - index into 'strings' of each node's tag, or one of
+                   the negative codes of comments, processing
+                   instructions and Replace nodes
+    texts, tails - id of each node's text and tail: an index into
+                   'strings', -1 for None, or -2 and below for strings
+                   set after flattening (see _stringid)
+    attrstart,   - where each node's attributes start in 'attrtable',
+    attrcount      and how many it has
+    attrtable    - string ids: name, value, name, value...
+    parent,      - index of each node's parent, first child and next
+    firstchild,    sibling, or -1 if it has none
+    nextsibling
+    meldids      - maps each meld id to the first node carrying it
+
+    The arrays are read-only; the text, tail and attributes of nodes are
+    changed with the methods below.  Cloning a flat tree copies only
+    the arrays it has changed itself, and writes nothing to it; each
+    tree copies an array the first time it changes it, but never
+    copies 'strings'.  The structure of a flat
+    tree can't be changed: turn it into an element tree with 'totree'
+    first.  The write_* methods serialize a flat tree directly; the
+    bytes of nodes which haven't been changed are kept, and shared by
+    all of the clones of the tree, so that only the changed nodes are
+    serialized again when a clone is written (see also 'compile').
+    Trees containing nodes of other kinds than elements, comments,
+    processing instructions and Replace nodes (like pending
+    'streamrepeat' output) raise a ValueError. """
+    def __init__(self, element):
+        strings = []
+        ids = {} # string -> index in strings
+        tags = []
+        texts = []
+        tails = []
+        attrstart = []
+        attrcount = []
+        attrtable = []
+        parent = []
+        firstchild = []
+        nextsibling = []
+        lastchild = []
+        meldids = {}
+
+        def stringid(value):
+            if value is None:
+                return -1
+            i = ids.get(value)
+            if i is None:
+                i = ids[value] = len(strings)
+                strings.append(value)
+            return i
+
+        stack = [(element, -1)]
+        while stack:
+            node, p = stack.pop()
+            i = len(tags)
+            tag = node._tag
+            if isinstance(tag, StringTypes):
+                tags.append(stringid(tag))
+            elif tag is Comment:
+                tags.append(_FLAT_COMMENT)
+            elif tag is ProcessingInstruction:
+                tags.append(_FLAT_PI)
+            elif tag is Replace:
+                if node.structure:
+                    tags.append(_FLAT_STRUCTURE)
+                else:
+                    tags.append(_FLAT_REPLACE)
+            else:
+                raise ValueError('cannot flatten element with tag %r' % (tag,))
+            texts.append(stringid(node._text))
+            tails.append(stringid(node._tail))
+            attrib = node._attrib
+            attrstart.append(len(attrtable))
+            attrcount.append(len(attrib))
+            for k, v in attrib.items():
+                attrtable.append(stringid(k))
+                attrtable.append(stringid(v))
+            meldid = attrib.get(_MELD_ID)
+            if meldid is not None and meldid not in meldids:
+                meldids[meldid] = i
+            parent.append(p)
+            firstchild.append(-1)
+            nextsibling.append(-1)
+            lastchild.append(-1)
+            if p != -1:
+                if lastchild[p] == -1:
+                    firstchild[p] = i
+                else:
+                    nextsibling[lastchild[p]] = i
+                lastchild[p] = i
+            # children shared with a frozen template are only read
+            children = node._children
+            if children:
+                stack.extend([(child, i) for child in reversed(children)])
+
+        self.strings = strings
+        self._ids = ids
+        self.tags = array('i', tags)
+        self.texts = array('i', texts)
+        self.tails = array('i', tails)
+        self.attrstart = array('i', attrstart)
+        self.attrcount = array('i', attrcount)
+        self.attrtable = array('i', attrtable)
+        self.parent = array('i', parent)
+        self.firstchild = array('i', firstchild)
+        self.nextsibling = array('i', nextsibling)
+        self.meldids = meldids
+        # (method, encoding) -> the output of each node as flattened (or
+        # None if not known yet), shared with all clones
+        self._parts = {}
+        # (method, encoding) -> render plan, see compile; also shared
+        self._plans = {}
+        self._changes = set() # the nodes changed since
+        self._added = [] # strings set since; id -2 is _added[0], etc.
+        # the names of the arrays (and of meldids, _changes and _added)
+        # this tree has copied, which it changes in place: the others
+        # may be shared with clones, and are copied before changing
+        self._mine = frozenset()
+
+    def __len__(self):
+        return len(self.tags)
+
+    def clone(self):
+        """ Return a copy of this flat tree.  This tree isn't written
+        to: the clone shares the arrays it hasn't changed, and gets
+        copies of those it has, which it goes on changing in place. """
+        clone = FlatTree.__new__(FlatTree)
+        clone.__dict__.update(self.__dict__)
+        clone._mine = frozenset()
+        for name in self._mine:
+            clone._own(name)
+        return clone
+
+    def _own(self, name):
+        # return the array (or dictionary, set or list) 'name', copied
+        # first unless this tree has already
+        value = getattr(self, name)
+        if name not in self._mine:
+            if isinstance(value, dict):
+                value = value.copy()
+            elif isinstance(value, set):
+                value = set(value)
+            else:
+                value = value[:]
+            setattr(self, name, value)
+            self._mine = self._mine | frozenset([name])
+        return value
+
+    def _changed(self, index):
+        # called before node 'index' changes: stop using its output
+        self._own('_changes').add(index)
+
+    def _stringid(self, value, old=-1):
+        # return the id to store in place of the id 'old' for 'value'.
+        # Strings set after flattening go to _added, one entry per slot
+        # holding one, so a slot which already has an entry overwrites
+        # it; other slots use the id of the string as flattened, if
+        # there is one, and the table of strings is never written to.
+        if old <= -2:
+            self._own('_added')[-2 - old] = value
+            return old
+        if value is None:
+            return -1
+        i = self._ids.get(value)
+        if i is None:
+            added = self._own('_added')
+            added.append(value)
+            i = -1 - len(added)
+        return i
+
+    def _string(self, i):
+        if i >= 0:
+            return self.strings[i]
+        if i == -1:
+            return None
+        return self._added[-2 - i]
+
+    def gettag(self, index):
+        """ Return the tag of node 'index', as an element would """
+        tag = self.tags[index]
+        if tag >= 0:
+            return self.strings[tag]
+        if tag == _FLAT_COMMENT:
+            return Comment
+        if tag == _FLAT_PI:
+            return ProcessingInstruction
+        return Replace
+
+    def gettext(self, index):
+        return self._string(self.texts[index])
+
+    def settext(self, index, text):
+        self._changed(index)
+        texts = self._own('texts')
+        texts[index] = self._stringid(text, texts[index])
+
+    def gettail(self, index):
+        return self._string(self.tails[index])
+
+    def settail(self, index, tail):
+        self._changed(index)
+        tails = self._own('tails')
+        tails[index] = self._stringid(tail, tails[index])
+
+    def get(self, index, key, default=None):
+        """ Return the value of the attribute 'key' of node 'index' """
+        string = self._string
+        table = self.attrtable
+        start = self.attrstart[index]
+        for i in range(start, start + 2 * self.attrcount[index], 2):
+            if string(table[i]) == key:
+                return string(table[i + 1])
+        return default
+
+    def set(self, index, key, value):
+        """ Set the attribute 'key' of node 'index' to 'value' """
+        self._changed(index)
+        string = self._string
+        table = self._own('attrtable')
+        start = self.attrstart[index]
+        count = self.attrcount[index]
+        old = None
+        for i in range(start, start + 2 * count, 2):
+            if string(table[i]) == key:
+                old = string(table[i + 1])
+                table[i + 1] = self._stringid(value, table[i + 1])
+                break
+        else:
+            # the node's attributes must be contiguous: unless they're
+            # at the end of the table already, move them there, where
+            # there's room for one more
+            if start + 2 * count != len(table):
+                table.extend(table[start:start + 2 * count])
+                self._own('attrstart')[index] = len(table) - 2 * count
+            table.append(self._stringid(key))
+            table.append(self._stringid(value))
+            self._own('attrcount')[index] = count + 1
+        if key == _MELD_ID and old != value:
+            self._movemeldid(index, old, value)
+
+    def _movemeldid(self, index, old, new):
+        # node 'index' had the meld id 'old' and now has 'new'; the ids
+        # map to the first node carrying them, and nodes are numbered in
+        # document order
+        meldids = self._own('meldids')
+        if old is not None and meldids.get(old) == index:
+            del meldids[old]
+            for i in range(index + 1, len(self.tags)):
+                if self.get(i, _MELD_ID) == old:
+                    meldids[old] = i
+                    break
+        if new is not None:
+            first = meldids.get(new)
+            if first is None or first > index:
+                meldids[new] = index
+
+    def items(self, index):
+        """ Return the attributes of node 'index' as (name, value) pairs """
+        string = self._string
+        table = self.attrtable
+        start = self.attrstart[index]
+        return [(string(table[i]), string(table[i + 1]))
+                for i in range(start, start + 2 * self.attrcount[index], 2)]
+
+    def children(self, index):
+        """ Return the indexes of the children of node 'index' """
+        L = []
+        nextsibling = self.nextsibling
+        child = self.firstchild[index]
+        while child != -1:
+            L.append(child)
+            child = nextsibling[child]
+        return L
+
+    def findmeld(self, name, default=None):
+        """ Return the index of the first node with the meld id 'name' """
+        return self.meldids.get(name, default)
+
+    def fillmelds(self, **kw):
+        """ Set the text of the nodes with the meld ids passed as
+        keywords to their values, like MeldElementInterface.fillmelds,
+        and return the keys which could not be found """
+        unfilled = []
+        for k in kw:
+            index = self.meldids.get(k)
+            if index is None:
+                unfilled.append(k)
+            else:
+                self.settext(index, kw[k])
+        return unfilled
+
+    def totree(self, weakparents=False):
+        """ Return an element tree made from this flat tree, with weak
+        parent links if 'weakparents' is true (see
+        MeldElementInterface.weakparents) """
+        paused = _pausegc()
+        try:
+            return self._totree(weakparents)
+        finally:
+            if paused:
+                _resumegc()
+
+    def _totree(self, weakparents):
+        elements = []
+        append = elements.append
+        links = {} # node -> what its children's _parent hold
+        index = {}
+        node = _FlatNode()
+        parent = self.parent
+        weak = weakparents and _WEAKPARENT or 0
+        for i in range(len(self.tags)):
+            self._fill(node, i)
+            attrib = node._attrib
+            if attrib:
+                attrib = attrib.copy()
+            else:
+                attrib = _NOATTRIB
+            element = _MeldElementInterface(node._tag, attrib)
+            element._text = node._text
+            element._tail = node._tail
+            if node.structure is not None:
+                element.structure = node.structure
+            element._flags = weak
+            p = parent[i]
+            if p != -1:
+                parentelement = elements[p]
+                children = parentelement._children
+                if children is _NOCHILDREN:
+                    children = parentelement._children = []
+                    if weak:
+                        links[p] = weakref.ref(parentelement)
+                    else:
+                        links[p] = parentelement
+                children.append(element)
+                element._parent = links[p]
+            if attrib:
+                meldid = attrib.get(_MELD_ID)
+                if meldid is not None:
+                    index.setdefault(meldid, []).append(element)
+            append(element)
+        root = elements[0]
+        root._meldindex = index
+        return root
+
+    def _fill(self, node, index):
+        strings = self.strings
+        tag = self.tags[index]
+        node.structure = None
+        if tag >= 0:
+            node._tag = strings[tag]
+        elif tag == _FLAT_COMMENT:
+            node._tag = Comment
+        elif tag == _FLAT_PI:
+            node._tag = ProcessingInstruction
+        else:
+            node._tag = Replace
+            node.structure = tag == _FLAT_STRUCTURE
+        node._text = self._string(self.texts[index])
+        node._tail = self._string(self.tails[index])
+        count = self.attrcount[index]
+        if count:
+            string = self._string
+            table = self.attrtable
+            start = self.attrstart[index]
+            attrib = {}
+            for i in range(start, start + 2 * count, 2):
+                attrib[string(table[i])] = string(table[i + 1])
+            node._attrib = attrib
+        else:
+            node._attrib = _NOATTRIB
+
+    def _nodeparts(self, key):
+        parts = self._parts.get(key)
+        if parts is None:
+            parts = self._parts[key] = [None] * len(self.tags)
+        return parts
+
+    def compile(self, method='html', encoding=None):
+        """ Serialize this flat tree once for 'method' ('html', 'xhtml'
+        or 'xml') and 'encoding' into a render plan: a single byte
+        string and arrays of where the bytes of each node start and end
+        in it.  The write_* methods of this tree and of all of its
+        clones then write the stretches between the nodes they changed
+        as slices of that string, and only serialize those nodes
+        (writes with pipeline=True don't use plans).  No plan is made
+        for trees whose bytes depend on the namespace prefixes in use,
+        nor used to write a clone whose changes make them do so.
+        Return whether a plan was made. """
+        encoding = _flat_encoding(method, encoding)
+        n = len(self.tags)
+        parent = self.parent
+        node = _FlatNode()
+        data = []
+        bounds = array('i')
+        # the numbers of the chunks written before and after the
+        # children of each node
+        chunkno = array('i', [0]) * (2 * n)
+        stack = [] # (node, chunk after its children) of open nodes
+        pos = 0
+        for i in range(n):
+            chunks = _flat_chunks(self, node, i, method, encoding)
+            if chunks is None:
+                return False
+            head, tail = chunks
+            p = parent[i]
+            while stack and stack[-1][0] != p:
+                j, chunk = stack.pop()
+                chunkno[2 * j + 1] = len(bounds)
+                bounds.append(pos)
+                data.append(chunk)
+                pos += len(chunk)
+            chunkno[2 * i] = len(bounds)
+            bounds.append(pos)
+            data.append(head)
+            pos += len(head)
+            stack.append((i, tail))
+        while stack:
+            j, chunk = stack.pop()
+            chunkno[2 * j + 1] = len(bounds)
+            bounds.append(pos)
+            data.append(chunk)
+            pos += len(chunk)
+        bounds.append(pos)
+        # the nodes changed so far are written from the tree being
+        # written rather than from the plan
+        self._plans[(method, encoding)] = (_BLANK.join(data), bounds,
+                                           chunkno, frozenset(self._changes))
+        return True
+
+    def write_xmlstring(self, encoding=None, doctype=None, fragment=False,
+                        declaration=True, pipeline=False):
+        """ Like MeldElementInterface.write_xmlstring """
+        data = []
+        write = data.append
+        if not fragment:
+            if declaration:
+                _write_declaration(write, encoding)
+            if doctype:
+                _write_doctype(write, doctype)
+        _write_flat_xml(write, self, encoding, pipeline)
+        return _BLANK.join(data)
+
+    def write_xhtmlstring(self, encoding=None, doctype=doctype.xhtml,
+                          fragment=False, declaration=False, pipeline=False):
+        """ Like MeldElementInterface.write_xhtmlstring """
+        data = []
+        write = data.append
+        if not fragment:
+            if declaration:
+                _write_declaration(write, encoding)
+            if doctype:
+                _write_doctype(write, doctype)
+        _write_flat_xml(write, self, encoding, pipeline, xhtml=True)
+        return _BLANK.join(data)
+
+    def write_htmlstring(self, encoding=None, doctype=doctype.html,
+                         fragment=False):
+        """ Like MeldElementInterface.write_htmlstring """
+        data = []
+        write = data.append
+        if encoding is None:
+            encoding = 'utf8'
+        if not fragment:
+            if doctype:
+                _write_doctype(write, doctype)
+        _write_flat_html(write, self, encoding)
+        return _BLANK.join(data)
+
 attrib_needs_escaping = re.compile(r'[&"<]').search
 cdata_needs_escaping = re.compile(r'[&<]').search
 
@@ -924,28 +3332,87 @@ def _write_html(write, node, encoding, namespaces, depth=-1, maxdepth=None):
     if encoding is None:
         encoding = 'utf-8'
 
-    tag  = node.tag
-    tail = node.tail
-    text = node.text
-    tail = node.tail
+    if maxdepth is None:
+        rendered = node._rendered
+        if rendered is not None:
+            blob = rendered.get(('html', encoding))
+            if blob is not None:
+                write(blob)
+                return
+        if node._flags & _MEMO:
+            write(_memoize(node, ('html', encoding), namespaces))
+            return
+
+    parts = None
+    compiled = node._compiled
+    if compiled is not None:
+        parts = compiled.get(('html', encoding))
+    if parts is None:
+        if node._tag is StreamRepeat:
+            if maxdepth is not None:
+                # a shortrepr mustn't consume the rows
+                write(_OMITTED_TEXT)
+                return
+            for clone in _streamrows(node):
+                _write_html(write, clone, encoding, namespaces, depth,
+                            maxdepth)
+            return
+        parts = _html_parts(node, encoding, namespaces)
+    start, end, close, tail = parts
+
+    write(start)
+
+    if end is not None:
+        children = node._children
+        for child in children:
+            if maxdepth is not None:
+                depth = depth + 1
+                if depth < maxdepth:
+                    _write_html(write, child, encoding, namespaces, depth,
+                                maxdepth)
+                elif depth == maxdepth and node._text:
+                    write(_OMITTED_TEXT)
+
+            else:
+                _write_html(write, child, encoding, namespaces, depth,
+                            maxdepth)
+
+        if close or children:
+            write(end)
+
+    if tail:
+        write(tail)
+
+def _html_parts(node, encoding, namespaces):
+    """ Serialize 'node' itself (but not its children) as HTML.  Return
+    a (start, end, close, tail) tuple: 'start' is the start tag followed
+    by the text, 'end' is the end tag (None for nodes which aren't
+    elements and so have neither children nor an end tag), 'close' is
+    true if the end tag must be written even if the node has no
+    children, and 'tail' is the tail. """
+    tag  = node._tag
+    text = node._text
+    tail = node._tail
 
     to_write = _BLANK
+    end = None
+    close = False
 
     if tag is Replace:
         if not node.structure:
             if cdata_needs_escaping(text):
                 text = _escape_cdata(text)
-        write(encode(text, encoding))
+        to_write = encode(text, encoding)
 
     elif tag is Comment:
         if cdata_needs_escaping(text):
             text = _escape_cdata(text)
-        write(encode('<!-- ' + text + ' -->', encoding))
+        to_write = encode('<!-- ' + text + ' -->', encoding)
 
     elif tag is ProcessingInstruction:
         if cdata_needs_escaping(text):
             text = _escape_cdata(text)
-        write(encode('<!-- ' + text + ' -->', encoding))
+        to_write = encode('<!-- ' + text + ' -->', encoding)
 
     else:
         xmlns_items = [] # new namespaces in this scope
@@ -962,7 +3429,7 @@ def _write_html(write, node, encoding, namespaces, depth=-1, maxdepth=None):
 
         to_write += _OPEN_TAG_START + encode(tag, encoding)
 
-        attrib = node.attrib
+        attrib = node._attrib
 
         if attrib is not None:
             if len(attrib) > 1:
@@ -995,57 +3462,110 @@ def _write_html(write, node, encoding, namespaces, depth=-1, maxdepth=None):
             else:
                 to_write += encode(text,encoding)
 
-        write(to_write)
-
-        for child in node._children:
-            if maxdepth is not None:
-                depth = depth + 1
-                if depth < maxdepth:
-                    _write_html(write, child, encoding, namespaces, depth,
-                                maxdepth)
-                elif depth == maxdepth and text:
-                    write(_OMITTED_TEXT)
-
-            else:
-                _write_html(write, child, encoding, namespaces, depth, maxdepth)
-
-        if text or node._children or tag not in _HTMLTAGS_UNBALANCED:
-            write(_CLOSE_TAG_START + encode(tag, encoding) + _CLOSE_TAG_END)
+        end = _CLOSE_TAG_START + encode(tag, encoding) + _CLOSE_TAG_END
+        close = bool(text) or tag not in _HTMLTAGS_UNBALANCED
 
     if tail:
         if cdata_needs_escaping(tail):
-            write(_escape_cdata(tail))
+            tail = _escape_cdata(tail)
         else:
-            write(encode(tail,encoding))
+            tail = encode(tail,encoding)
+
+    return to_write, end, close, tail
+
+def _html_static(node):
+    # can the HTML for 'node' itself be computed without knowing where
+    # it is in the document?  Only tags with foreign namespaces are
+    # written with a prefix that depends on the context.
+    tag = node._tag
+    if tag is Comment or tag is ProcessingInstruction:
+        return True
+    if not isinstance(tag, StringTypes):
+        return False
+    return tag[:1] != "{" or tag[:_XHTML_PREFIX_LEN] == _XHTML_PREFIX
 
 def _write_xml(write, node, encoding, namespaces, pipeline, xhtml=False):
     """ Write XML to a file """
     if encoding is None:
         encoding = 'utf-8'
-    tag = node.tag
+
+    parts = None
+    xmlns_items = None
+    if not pipeline:
+        key = (xhtml and 'xhtml' or 'xml', encoding)
+        rendered = node._rendered
+        if rendered is not None:
+            blob = rendered.get(key)
+            if blob is not None:
+                write(blob)
+                return
+        if node._flags & _MEMO:
+            write(_memoize(node, key, namespaces))
+            return
+        compiled = node._compiled
+        if compiled is not None:
+            parts = compiled.get(key)
+    if parts is None:
+        if node._tag is StreamRepeat:
+            for clone in _streamrows(node):
+                _write_xml(write, clone, encoding, namespaces, pipeline, xhtml)
+            return
+        xmlns_items = [] # new namespaces in this scope
+        parts = _xml_parts(node, encoding, namespaces, pipeline, xhtml,
+                           xmlns_items)
+    start, text, end, tail = parts
+
+    write(start)
+
+    if end is not None:
+        children = node._children
+        if text or children:
+            write(_OPEN_TAG_END)
+            if text:
+                write(text)
+            for n in children:
+                _write_xml(write, n, encoding, namespaces, pipeline, xhtml)
+            write(end)
+        else:
+            write(_SELF_CLOSE)
+        if xmlns_items:
+            for k, v in xmlns_items:
+                del namespaces[v]
+
+    if tail:
+        write(tail)
+
+def _xml_parts(node, encoding, namespaces, pipeline, xhtml, xmlns_items):
+    """ Serialize 'node' itself (but not its children) as XML.  Return a
+    (start, text, end, tail) tuple: 'start' is the start tag without its
+    closing '>', 'text' the text, 'end' the end tag (None for nodes which
+    aren't elements, whose whole serialization is in 'start'), and
+    'tail' the tail.  Namespace declarations made by the start tag are
+    appended to 'xmlns_items'. """
+    tag = node._tag
+    text = end = None
     if tag is Comment:
-        write(_COMMENT_START +
-              _escape_cdata(node.text, encoding) +
-              _COMMENT_END)
+        start = (_COMMENT_START +
+                 _escape_cdata(node._text, encoding) +
+                 _COMMENT_END)
     elif tag is ProcessingInstruction:
-        write(_PI_START +
-              _escape_cdata(node.text, encoding) +
-              _PI_END)
+        start = (_PI_START +
+                 _escape_cdata(node._text, encoding) +
+                 _PI_END)
     elif tag is Replace:
         if node.structure:
             # this may produce invalid xml
-            write(encode(node.text, encoding))
+            start = encode(node._text, encoding)
         else:
-            write(_escape_cdata(node.text, encoding))
+            start = _escape_cdata(node._text, encoding)
     else:
         if xhtml:
             if tag[:_XHTML_PREFIX_LEN] == _XHTML_PREFIX:
                 tag = tag[_XHTML_PREFIX_LEN:]
-        if node.attrib:
-            items = list(node.attrib.items())
+        if node._attrib:
+            items = list(node._attrib.items())
         else:
             items = []  # must always be sortable.
-        xmlns_items = [] # new namespaces in this scope
         try:
             if tag[:1] == "{":
                 tag, xmlns = fixtag(tag, namespaces)
@@ -1053,7 +3573,8 @@ def _write_xml(write, node, encoding, namespaces, pipeline, xhtml=False):
                     xmlns_items.append(xmlns)
         except TypeError:
             _raise_serialization_error(tag)
-        write(_OPEN_TAG_START + encode(tag, encoding))
+        data = [_OPEN_TAG_START + encode(tag, encoding)]
+        write = data.append
         if items or xmlns_items:
             items.sort() # lexical order
             for k, v in items:
@@ -1073,19 +3594,399 @@ def _write_xml(write, node, encoding, namespaces, pipeline, xhtml=False):
                 write(_encode_attrib(k, v, encoding))
             for k, v in xmlns_items:
                 write(_encode_attrib(k, v, encoding))
-        if node.text or node._children:
-            write(_OPEN_TAG_END)
-            if node.text:
-                write(_escape_cdata(node.text, encoding))
-            for n in node._children:
-                _write_xml(write, n, encoding, namespaces, pipeline, xhtml)
-            write(_CLOSE_TAG_START + encode(tag, encoding) + _CLOSE_TAG_END)
+        start = _BLANK.join(data)
+        if node._text:
+            text = _escape_cdata(node._text, encoding)
+        end = _CLOSE_TAG_START + encode(tag, encoding) + _CLOSE_TAG_END
+    if node._tail:
+        tail = _escape_cdata(node._tail, encoding)
+    else:
+        tail = None
+    return start, text, end, tail
+
+def _xml_static(node, xhtml):
+    # can the XML for 'node' itself be computed without knowing where it
+    # is in the document?  Not if it needs namespace prefixes, which are
+    # allocated as the document is written.
+    tag = node._tag
+    if tag is Comment or tag is ProcessingInstruction:
+        return True
+    if not isinstance(tag, StringTypes):
+        return False
+    if xhtml and tag[:_XHTML_PREFIX_LEN] == _XHTML_PREFIX:
+        tag = tag[_XHTML_PREFIX_LEN:]
+    if tag[:1] == "{":
+        return False
+    if node._attrib:
+        for k in node._attrib:
+            if not isinstance(k, StringTypes):
+                return False
+            if k[:1] == "{" and k != _MELD_ID:
+                return False
+    return True
+
+def _flat_encoding(method, encoding):
+    # the encoding FlatTree's write_*string methods use by default
+    if encoding is None:
+        if method == 'html':
+            return 'utf8'
+        return 'utf-8'
+    return encoding
+
+def _flat_chunks(flat, node, i, method, encoding):
+    # the bytes written for node 'i' of 'flat' before and after its
+    # children, or None if they depend on the namespace prefixes in use
+    flat._fill(node, i)
+    haschildren = flat.firstchild[i] != -1
+    if method == 'html':
+        if node._tag is not Replace and not _html_static(node):
+            return None
+        start, end, close, tail = _html_parts(node, encoding, {})
+        if end is not None and (close or haschildren):
+            return start, end + (tail or _BLANK)
+        return start, tail or _BLANK
+    xhtml = method == 'xhtml'
+    if node._tag is not Replace and not _xml_static(node, xhtml):
+        return None
+    start, text, end, tail = _xml_parts(node, encoding, {}, False, xhtml,
+                                        [])
+    if end is None:
+        return start, tail or _BLANK
+    if text or haschildren:
+        return (start + _OPEN_TAG_END + (text or _BLANK),
+                end + (tail or _BLANK))
+    return start + _SELF_CLOSE, tail or _BLANK
+
+def _write_flat_plan(write, flat, plan, method, encoding):
+    # write 'flat' from its render plan (see FlatTree.compile), or
+    # return False without writing anything if it can't be
+    data, bounds, chunkno, changed = plan
+    changes = flat._changes
+    if changed:
+        changes = changes | changed
+    node = _FlatNode()
+    chunks = {} # chunk number -> the bytes to write instead
+    for i in changes:
+        nodechunks = _flat_chunks(flat, node, i, method, encoding)
+        if nodechunks is None:
+            return False
+        chunks[chunkno[2 * i]], chunks[chunkno[2 * i + 1]] = nodechunks
+    pos = 0
+    for k in sorted(chunks):
+        start = bounds[k]
+        if start > pos:
+            write(data[pos:start])
+        write(chunks[k])
+        pos = bounds[k + 1]
+    write(data[pos:])
+    return True
+
+def _write_flat_html(write, flat, encoding):
+    """ Write the FlatTree 'flat' as HTML, like _write_html: from its
+    render plan if it has one, else walk its nodes in document order,
+    keeping the parts of their ancestors on a stack.  The parts of
+    unchanged nodes which don't depend on the namespace prefixes in use
+    are cached. """
+    plan = flat._plans.get(('html', encoding))
+    if plan is not None:
+        if _write_flat_plan(write, flat, plan, 'html', encoding):
+            return
+    nodeparts = flat._nodeparts(('html', encoding))
+    changes = flat._changes
+    parent = flat.parent
+    firstchild = flat.firstchild
+    nextsibling = flat.nextsibling
+    namespaces = {}
+    node = _FlatNode()
+    stack = []
+    i = 0
+    while True:
+        if i in changes:
+            flat._fill(node, i)
+            parts = _html_parts(node, encoding, namespaces)
         else:
-            write(_SELF_CLOSE)
-        for k, v in xmlns_items:
-            del namespaces[v]
-    if node.tail:
-        write(_escape_cdata(node.tail, encoding))
+            parts = nodeparts[i]
+            if parts is None:
+                flat._fill(node, i)
+                parts = _html_parts(node, encoding, namespaces)
+                if _html_static(node):
+                    nodeparts[i] = parts
+        start, end, close, tail = parts
+        write(start)
+        if end is not None:
+            child = firstchild[i]
+            if child != -1:
+                stack.append(parts)
+                i = child
+                continue
+            if close:
+                write(end)
+        if tail:
+            write(tail)
+        # done with node i: go on with its next sibling, or the next
+        # sibling of the closest ancestor which has one
+        while nextsibling[i] == -1:
+            if not stack:
+                return
+            start, end, close, tail = stack.pop()
+            write(end)
+            if tail:
+                write(tail)
+            i = parent[i]
+        i = nextsibling[i]
+
+def _write_flat_xml(write, flat, encoding, pipeline, xhtml=False):
+    """ Write the FlatTree 'flat' as XML, like _write_xml """
+    if encoding is None:
+        encoding = 'utf-8'
+    nodeparts = None
+    if not pipeline:
+        method = xhtml and 'xhtml' or 'xml'
+        plan = flat._plans.get((method, encoding))
+        if plan is not None:
+            if _write_flat_plan(write, flat, plan, method, encoding):
+                return
+        nodeparts = flat._nodeparts((method, encoding))
+    changes = flat._changes
+    parent = flat.parent
+    firstchild = flat.firstchild
+    nextsibling = flat.nextsibling
+    namespaces = {}
+    node = _FlatNode()
+    stack = []
+    i = 0
+    while True:
+        parts = None
+        xmlns_items = None
+        cache = nodeparts is not None and i not in changes
+        if cache:
+            parts = nodeparts[i]
+        if parts is None:
+            flat._fill(node, i)
+            xmlns_items = [] # new namespaces in this scope
+            parts = _xml_parts(node, encoding, namespaces, pipeline, xhtml,
+                               xmlns_items)
+            if cache and _xml_static(node, xhtml):
+                nodeparts[i] = parts
+        start, text, end, tail = parts
+        write(start)
+        if end is not None:
+            child = firstchild[i]
+            if text or child != -1:
+                write(_OPEN_TAG_END)
+                if text:
+                    write(text)
+                if child != -1:
+                    stack.append((end, tail, xmlns_items))
+                    i = child
+                    continue
+                write(end)
+            else:
+                write(_SELF_CLOSE)
+            if xmlns_items:
+                for k, v in xmlns_items:
+                    del namespaces[v]
+        if tail:
+            write(tail)
+        while nextsibling[i] == -1:
+            if not stack:
+                return
+            end, tail, xmlns_items = stack.pop()
+            write(end)
+            if xmlns_items:
+                for k, v in xmlns_items:
+                    del namespaces[v]
+            if tail:
+                write(tail)
+            i = parent[i]
+        i = nextsibling[i]
+
+def _iter_html(node, encoding, namespaces):
+    """ Generate the HTML serialization of 'node' piece by piece; the
+    same output as _write_html, but walking the tree with an explicit
+    stack so that the generator can be suspended anywhere. """
+    if encoding is None:
+        encoding = 'utf-8'
+    key = ('html', encoding)
+    # the stack holds the nodes still to be written and, below each
+    # node's children, the bytes to emit once they have been written;
+    # StreamRepeat nodes are replaced by a generator of their rows
+    stack = [node]
+    pop = stack.pop
+    push = stack.append
+    extend = stack.extend
+    while stack:
+        node = pop()
+        cls = node.__class__
+        if cls is bytes:
+            yield node
+            continue
+        if cls is _GeneratorType:
+            for row in node:
+                push(node)
+                push(row)
+                break
+            continue
+        rendered = node._rendered
+        if rendered is not None:
+            blob = rendered.get(key)
+            if blob is not None:
+                yield blob
+                continue
+        if node._flags & (_MEMO | _STREAMED) == _MEMO:
+            yield _memoize(node, key, namespaces)
+            continue
+        parts = None
+        compiled = node._compiled
+        if compiled is not None:
+            parts = compiled.get(key)
+        if parts is None:
+            if node._tag is StreamRepeat:
+                push(_streamrows(node))
+                continue
+            parts = _html_parts(node, encoding, namespaces)
+        start, end, close, tail = parts
+        yield start
+        if tail:
+            push(tail)
+        if end is not None:
+            children = node._children
+            if close or children:
+                push(end)
+            if children:
+                extend(reversed(children))
+
+def _iter_xml(node, encoding, namespaces, pipeline, xhtml=False):
+    """ Generate the XML serialization of 'node' piece by piece; the
+    same output as _write_xml, but walking the tree with an explicit
+    stack so that the generator can be suspended anywhere. """
+    if encoding is None:
+        encoding = 'utf-8'
+    key = (xhtml and 'xhtml' or 'xml', encoding)
+    # the stack holds the nodes still to be written and, below each
+    # node's children, the bytes to emit once they have been written and
+    # the namespace declarations which go out of scope with the node;
+    # StreamRepeat nodes are replaced by a generator of their rows
+    stack = [node]
+    pop = stack.pop
+    push = stack.append
+    extend = stack.extend
+    while stack:
+        node = pop()
+        cls = node.__class__
+        if cls is bytes:
+            yield node
+            continue
+        if cls is list:
+            for k, v in node:
+                del namespaces[v]
+            continue
+        if cls is _GeneratorType:
+            for row in node:
+                push(node)
+                push(row)
+                break
+            continue
+        parts = None
+        xmlns_items = None
+        if not pipeline:
+            rendered = node._rendered
+            if rendered is not None:
+                blob = rendered.get(key)
+                if blob is not None:
+                    yield blob
+                    continue
+            if node._flags & (_MEMO | _STREAMED) == _MEMO:
+                yield _memoize(node, key, namespaces)
+                continue
+            compiled = node._compiled
+            if compiled is not None:
+                parts = compiled.get(key)
+        if parts is None:
+            if node._tag is StreamRepeat:
+                push(_streamrows(node))
+                continue
+            xmlns_items = []
+            parts = _xml_parts(node, encoding, namespaces, pipeline, xhtml,
+                               xmlns_items)
+        start, text, end, tail = parts
+        yield start
+        if tail:
+            push(tail)
+        if end is not None:
+            if xmlns_items:
+                push(xmlns_items)
+            children = node._children
+            if text or children:
+                yield _OPEN_TAG_END
+                if text:
+                    yield text
+                push(end)
+                if children:
+                    extend(reversed(children))
+            else:
+                yield _SELF_CLOSE
+
+def _memoize(node, key, namespaces):
+    # write a node marked by memoize() and keep the bytes for the next
+    # time.  Its children are marked in turn, so each of them keeps its
+    # own bytes too: when a node changes, only the nodes on its way up
+    # to the memoized one are written again.
+    children = node._children
+    for child in children:
+        if not child._flags & _FROZEN:
+            child._flags |= _MEMO
+    data = []
+    method, encoding = key
+    node._flags &= ~_MEMO
+    try:
+        if method == 'html':
+            _write_html(data.append, node, encoding, namespaces)
+        else:
+            _write_xml(data.append, node, encoding, namespaces, False,
+                       method == 'xhtml')
+    finally:
+        node._flags |= _MEMO
+    blob = _BLANK.join(data)
+    # the bytes can only be used again wherever the node ends up if they
+    # don't depend on the namespace prefixes allocated so far, which
+    # means that neither the node nor its descendants may need any
+    flags = node._flags
+    if flags & (_FROZEN | _STREAMED) or not _static(node, method):
+        return blob
+    for child in children:
+        rendered = child._rendered
+        if rendered is not None and key in rendered:
+            continue
+        if (child._children or not child._flags & _COVERED or
+            not _static(child, method)):
+            return blob
+    # like the subtrees serialized by compile(), the node is covered by
+    # its bytes (and by those of its memoized ancestors), which are
+    # thrown away when it changes; childless nodes are cheap to write
+    # and aren't worth keeping bytes for
+    if children:
+        rendered = node._rendered
+        if rendered is None:
+            rendered = node._rendered = {}
+        rendered[key] = blob
+    node._flags = flags | _COVERED
+    return blob
+
+def _chunked(head, pieces, chunksize):
+    # regroup the byte strings in 'head' followed by those generated by
+    # 'pieces' into strings of at least 'chunksize' bytes (except the last)
+    data = list(head)
+    size = sum([len(x) for x in data])
+    for piece in pieces:
+        data.append(piece)
+        size += len(piece)
+        if size >= chunksize:
+            yield _BLANK.join(data)
+            data = []
+            size = 0
+    if data:
+        yield _BLANK.join(data)
 
 def _encode_attrib(k, v, encoding):
     return _BLANK.join((_SPACE,
@@ -1197,47 +4098,242 @@ def prefeed(data, doctype=doctype.xhtml):
     return data
 
 def sharedlineage(srcelement, tgtelement):
+    # do the ancestors of both elements have the same tags?
     srcparent = srcelement.parent
     tgtparent = tgtelement.parent
-    srcparenttag = getattr(srcparent, 'tag', None)
-    tgtparenttag = getattr(tgtparent, 'tag', None)
-    if srcparenttag != tgtparenttag:
-        return False
-    elif tgtparenttag is None and srcparenttag is None:
-        return True
-    elif tgtparent and srcparent:
-        return sharedlineage(srcparent, tgtparent)
-    return False
+    while srcparent is not None and tgtparent is not None:
+        if srcparent._tag != tgtparent._tag:
+            return False
+        srcparent = srcparent.parent
+        tgtparent = tgtparent.parent
+    return srcparent is None and tgtparent is None
+
+def _pathkey(node, memo, keys):
+    # return a key standing for the tags on the path from the root of the
+    # tree down to 'node' (None if 'node' is None): equal paths get equal
+    # keys as long as 'keys' is shared.  'memo' maps id(node) to its key,
+    # so ancestors shared by many elements are only visited once.
+    chain = []
+    while node is not None:
+        key = memo.get(id(node))
+        if key is not None:
+            break
+        chain.append(node)
+        node = node.parent
+    else:
+        key = None
+    for node in reversed(chain):
+        key = keys.setdefault((key, node._tag), len(keys))
+        memo[id(node)] = key
+    return key
 
 def diffreduce(elements):
     # each element in 'elements' should all have non-None meldids, and should
     # be preordered in depth-first traversal order
     reduced = []
+    seen = {}
     for element in elements:
         parent = element.parent
-        if parent is None:
-            reduced.append(element)
-            continue
-        if parent in reduced:
+        if parent is not None and id(parent) in seen:
             continue
         reduced.append(element)
+        seen[id(element)] = True
     return reduced
 
 def intersection(S1, S2):
+    ids = {}
+    for element in S2:
+        ids[id(element)] = True
     L = []
     for element in S1:
-        if element in S2:
+        if id(element) in ids:
             L.append(element)
     return L
 
+# patches: the changes turning one tree into another as a list of
+# operations, each a tuple of the name of the operation, the address of
+# the node it applies to and its arguments:
+#
+#   ('set-text', meldid, path, text)
+#   ('set-tail', meldid, path, tail)
+#   ('set-attr', meldid, path, name, value)
+#   ('remove-attr', meldid, path, name)
+#   ('replace-subtree', meldid, path, subtree)
+#   ('insert', meldid, path, index, subtree)
+#   ('remove', meldid, path)
+#
+# A node is addressed by the meld id of the nearest element (itself or
+# an ancestor) whose meld id is unique, None meaning the root of the
+# tree, and the path of child indexes leading from that element to the
+# node.  Subtrees are the nested tuples of _dumpnode.  Patches only
+# contain tuples, lists, dictionaries, strings, integers and None, so
+# they can be sent as JSON, for instance.
+
+def make_patch(source, target):
+    """ Return a patch (a list of operations) which turns a copy of the
+    tree 'source' into the tree 'target' when passed to apply_patch.
+    Elements carrying the same meld id in both trees (at most once in
+    each) are compared with each other; changes to their tag or to the
+    child elements of other elements are expressed by replacing the
+    smallest subtree containing them. """
+    srccounts = _meldcounts(source)
+    tgtcounts = _meldcounts(target)
+    unique = {}
+    for counts, other in ((srccounts, tgtcounts), (tgtcounts, srccounts)):
+        for meldid, count in counts.items():
+            if meldid is not None and count == 1 and other.get(meldid, 1) == 1:
+                unique[meldid] = True
+    removals = []
+    ops = []
+    _patchnode(source, target, None, (), unique, removals, ops)
+    # elements moved elsewhere are removed from their old place first, so
+    # that no meld id is ever carried by two elements while patching
+    return removals + ops
+
+def _meldcounts(element):
+    counts = {}
+    for node in melditerator(element):
+        meldid = node._attrib.get(_MELD_ID)
+        counts[meldid] = counts.get(meldid, 0) + 1
+    return counts
+
+def _patchnode(src, tgt, meldid, path, unique, removals, ops):
+    if src._tag != tgt._tag or src.structure != tgt.structure:
+        ops.append(('replace-subtree', meldid, path, _dumpnode(tgt)))
+        return
+    srcattrib = src._attrib
+    tgtattrib = tgt._attrib
+    if srcattrib != tgtattrib:
+        for name in sorted(tgtattrib.keys()):
+            value = tgtattrib[name]
+            if srcattrib.get(name) != value:
+                ops.append(('set-attr', meldid, path, name, value))
+        for name in sorted(srcattrib.keys()):
+            if name not in tgtattrib:
+                ops.append(('remove-attr', meldid, path, name))
+    if src._text != tgt._text:
+        ops.append(('set-text', meldid, path, tgt._text))
+    if src._tail != tgt._tail:
+        ops.append(('set-tail', meldid, path, tgt._tail))
+
+    srcchildren = src._children
+    tgtchildren = tgt._children
+    srckeys = [child._attrib.get(_MELD_ID) for child in srcchildren]
+    tgtkeys = [child._attrib.get(_MELD_ID) for child in tgtchildren]
+    if srckeys != tgtkeys:
+        keyed = True
+        for key in srckeys + tgtkeys:
+            if key not in unique:
+                keyed = False
+                break
+        if keyed:
+            _patchkeyed(src, tgt, meldid, path, unique, removals, ops)
+            return
+        if len(srckeys) != len(tgtkeys):
+            ops.append(('replace-subtree', meldid, path, _dumpnode(tgt)))
+            return
+    for i in range(len(srcchildren)):
+        srcchild = srcchildren[i]
+        tgtchild = tgtchildren[i]
+        key = srckeys[i]
+        if key == tgtkeys[i] and key in unique:
+            _patchnode(srcchild, tgtchild, key, (), unique, removals, ops)
+        elif key in unique or tgtkeys[i] in unique:
+            # an element with a unique meld id which lives elsewhere in
+            # the other tree: addressed by its position, since its id
+            # may be carried by two elements at this point
+            ops.append(('replace-subtree', meldid, path + (i,),
+                        _dumpnode(tgtchild)))
+        else:
+            _patchnode(srcchild, tgtchild, meldid, path + (i,), unique,
+                       removals, ops)
+
+def _patchkeyed(src, tgt, meldid, path, unique, removals, ops):
+    # the children on both sides all have unique meld ids: remove those
+    # which aren't children of 'tgt', patch the others in place if they
+    # are still in the same order and insert the new ones
+    tgtchildren = {}
+    for child in tgt._children:
+        tgtchildren[child._attrib.get(_MELD_ID)] = child
+    kept = []
+    for child in src._children:
+        key = child._attrib.get(_MELD_ID)
+        if key in tgtchildren:
+            kept.append(child)
+        else:
+            removals.append(('remove', key, ()))
+    srcorder = [child._attrib.get(_MELD_ID) for child in kept]
+    srcchildren = {}
+    for child in kept:
+        srcchildren[child._attrib.get(_MELD_ID)] = child
+    tgtorder = [child._attrib.get(_MELD_ID) for child in tgt._children
+                if child._attrib.get(_MELD_ID) in srcchildren]
+    if srcorder != tgtorder:
+        for key in srcorder:
+            removals.append(('remove', key, ()))
+        srcchildren = {}
+    for i, child in enumerate(tgt._children):
+        key = child._attrib.get(_MELD_ID)
+        srcchild = srcchildren.get(key)
+        if srcchild is None:
+            ops.append(('insert', meldid, path, i, _dumpnode(child)))
+        else:
+            _patchnode(srcchild, child, key, (), unique, removals, ops)
+
+def apply_patch(element, patch):
+    """ Apply the operations of 'patch' (made by make_patch) to the tree
+    'element' and return it; if the patch replaces the root of the tree,
+    the new root is returned instead. """
+    root = element
+    for op in patch:
+        name = op[0]
+        node = _patchaddress(root, op[1], op[2])
+        if name == 'set-text':
+            node.text = op[3]
+        elif name == 'set-tail':
+            node.tail = op[3]
+        elif name == 'set-attr':
+            node.set(op[3], op[4])
+        elif name == 'remove-attr':
+            # which takes the element out of the meld id index if need be
+            del node.attrib[op[3]]
+        elif name == 'replace-subtree':
+            new = _patchsubtree(op[3], node._flags & _WEAKPARENT)
+            parent = node.parent
+            if parent is not None:
+                parent[node.parentindex()] = new
+            if node is root:
+                root = new
+        elif name == 'insert':
+            node.insert(op[3],
+                        _patchsubtree(op[4], node._flags & _WEAKPARENT))
+        elif name == 'remove':
+            node.deparent()
+        else:
+            raise ValueError('unknown patch operation %r' % (name,))
+    return root
+
+def _patchaddress(root, meldid, path):
+    if meldid is None:
+        node = root
+    else:
+        node = root.findmeld(meldid)
+        if node is None:
+            raise ValueError('no element with meld id %r to patch' % meldid)
+    for i in path:
+        node = node[i]
+    return node
+
+def _patchsubtree(data, weak):
+    # the new subtree links to its parents like the tree it goes into
+    index = {}
+    element = _loadnode(data, None, index, weak)
+    element._meldindex = index
+    return element
+
 def melditerator(element, meldid=None, _MELD_ID=_MELD_ID):
-    nodeid = element.attrib.get(_MELD_ID)
-    if nodeid is not None:
-        if meldid is None or nodeid == meldid:
-            yield element
-    for child in element._children:
-        for el2 in melditerator(child, meldid):
-            nodeid = el2.attrib.get(_MELD_ID)
-            if nodeid is not None:
-                if meldid is None or nodeid == meldid:
-                    yield el2
+    for el in helper.iter(element):
+        nodeid = el._attrib.get(_MELD_ID)
+        if nodeid is not None:
+            if meldid is None or nodeid == meldid:
+                yield el
@@ -51,6 +51,16 @@ try:
 except ImportError: # Python 3.x
     StringTypes = (str,)
 
+try:
+    from collections.abc import MutableMapping
+except ImportError: # Python 2.x
+    from collections import MutableMapping
+
+try:
+    from types import MappingProxyType
+except ImportError: # Python < 3.3
+    MappingProxyType = dict
+
 #-----------------------------------------------------------------------------
 # Begin fork from Python 2.6.8 stdlib:
 #       - xml.elementtree.ElementTree._raise_serialization_error
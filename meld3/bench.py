@@ -0,0 +1,569 @@
+""" Benchmarks for meld3.  Run them all with
+
+  python -m meld3.bench
+
+or only some of them by passing their names on the command line. """
+import gc
+import os
+import sys
+import time
+
+from xml.etree.ElementTree import Comment
+from xml.etree.ElementTree import TreeBuilder
+
+from . import _MELD_ID
+from . import _MELD_NS_URL
+from . import _MeldElementInterface
+from . import _gcfreeze
+from . import FlatTree
+from . import FragmentCache
+from . import MeldParser
+from . import TemplatePool
+from . import TemplateRegistry
+from . import parse_htmlstring
+from . import parse_xmlstring
+
+def timeit(func, *args):
+    """ Return the best of three wall clock times of func(*args) """
+    best = None
+    for i in range(3):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, old, new, format='%8.4fs'):
+    if new > 0:
+        speedup = '%6.2fx' % (old / new)
+    else:
+        speedup = '%7s' % '-'
+    format = '%-40s ' + format + ' ' + format + ' %s\n'
+    sys.stdout.write(format % (name, old, new, speedup))
+
+def makedocument(rows):
+    """ Return an XML document with 'rows' rows of a table in it, each
+    of which has a couple of cells, one of them with a meld id """
+    L = ['<html xmlns:meld="%s"><body><table meld:id="table">' %
+         _MELD_NS_URL]
+    for i in range(rows):
+        L.append('<tr class="row"><td meld:id="name%d">name %d</td>'
+                 '<td><b>static</b> text</td></tr>' % (i, i))
+    L.append('</table></body></html>')
+    return ''.join(L)
+
+# parsing
+
+class _TwoPassBuilder(TreeBuilder):
+    # the tree builder used up to meld3 2.0.1: ElementTree's, making meld
+    # elements, whose parent pointers do_parse set in a second pass
+    def __init__(self):
+        TreeBuilder.__init__(self, element_factory=_MeldElementInterface)
+
+    def comment(self, data):
+        self.start(Comment, {})
+        self.data(data)
+        self.end(Comment)
+
+def twopass_parse_xmlstring(text):
+    parser = MeldParser(target=_TwoPassBuilder())
+    parser.feed(text)
+    root = parser.close()
+    for p in root.getiterator():
+        for c in p:
+            c.parent = p
+    return root
+
+def bench_parse(rows=20000):
+    text = makedocument(rows)
+    report('parse_xmlstring, %d rows (%d bytes)' % (rows, len(text)),
+           timeit(twopass_parse_xmlstring, text),
+           timeit(parse_xmlstring, text))
+
+# diffmeld
+
+def quadratic_diffmeld(source, target):
+    # diffmeld as of meld3 2.0.1, which looked meld ids up in lists
+    from . import diffreduce
+    srcelements = source.findmelds()
+    tgtelements = target.findmelds()
+    srcids = [ x.meldid() for x in srcelements ]
+    tgtids = [ x.meldid() for x in tgtelements ]
+    removed = []
+    for srcelement in srcelements:
+        if srcelement.meldid() not in tgtids:
+            removed.append(srcelement)
+    added = []
+    for tgtelement in tgtelements:
+        if tgtelement.meldid() not in srcids:
+            added.append(tgtelement)
+    moved = []
+    for srcelement in srcelements:
+        srcid = srcelement.meldid()
+        if srcid in tgtids:
+            i = tgtids.index(srcid)
+            tgtelement = tgtelements[i]
+            if not recursive_sharedlineage(srcelement, tgtelement):
+                moved.append(tgtelement)
+    return {'unreduced':{'added':added, 'removed':removed, 'moved':moved},
+            'reduced':{'moved':quadratic_diffreduce(moved),
+                       'added':quadratic_diffreduce(added),
+                       'removed':quadratic_diffreduce(removed)}}
+
+def recursive_sharedlineage(srcelement, tgtelement):
+    srcparent = srcelement.parent
+    tgtparent = tgtelement.parent
+    srcparenttag = getattr(srcparent, 'tag', None)
+    tgtparenttag = getattr(tgtparent, 'tag', None)
+    if srcparenttag != tgtparenttag:
+        return False
+    elif tgtparenttag is None and srcparenttag is None:
+        return True
+    elif tgtparent and srcparent:
+        return recursive_sharedlineage(srcparent, tgtparent)
+    return False
+
+def quadratic_diffreduce(elements):
+    reduced = []
+    for element in elements:
+        parent = element.parent
+        if parent is None:
+            reduced.append(element)
+            continue
+        if parent in reduced:
+            continue
+        reduced.append(element)
+    return reduced
+
+def bench_diffmeld(ids=10000):
+    # a tenth of the rows are dropped, a tenth added and a tenth moved
+    # into another table
+    rows = ids
+    source = parse_xmlstring(makedocument(rows))
+    target = parse_xmlstring(makedocument(rows))
+    table = target.findmeld('table')
+    other = target.makeelement('div', {})
+    table.parent.append(other)
+    for i in range(0, rows, 10):
+        target.findmeld('name%d' % i).deparent()
+        target.findmeld('name%d' % (i + 1)).set(_MELD_ID, 'new%d' % i)
+        moved = target.findmeld('name%d' % (i + 2)).parent
+        moved.deparent()
+        other.append(moved)
+    old = quadratic_diffmeld(source, target)
+    new = source.diffmeld(target)
+    for kind in old:
+        for change in old[kind]:
+            assert old[kind][change] == new[kind][change], (kind, change)
+    report('diffmeld, %d meld ids' % len(source.findmelds()),
+           timeit(quadratic_diffmeld, source, target),
+           timeit(source.diffmeld, target))
+
+# fragment cache
+
+def makepage(links):
+    """ Return an HTML page with a navigation menu of 'links' links, a
+    couple of which have meld ids, and a content area """
+    L = ['<html><head><title meld:id="title">title</title></head><body>'
+         '<div meld:id="menu"><ul>']
+    for i in range(links):
+        L.append('<li class="item"><a href="/section/%d">section <b>%d</b>'
+                 '</a></li>' % (i, i))
+    L.append('<li meld:id="tenant">tenant</li></ul>'
+             '<p meld:id="footer">footer</p></div>'
+             '<div meld:id="content">content</div></body></html>')
+    return ''.join(L)
+
+def bench_fragments(links=2000, renders=20):
+    # the menu is filled in with the same per-tenant data on every
+    # request; with the cache, only its fingerprint is recomputed
+    template = parse_htmlstring(makepage(links))
+    template.fingerprint()
+    template.freeze()
+    fragments = FragmentCache()
+    def render(cached):
+        for i in range(renders):
+            root = template.clone(cow=True)
+            root.findmeld('tenant').text = 'tenant 42'
+            root.findmeld('footer').text = 'footer for tenant 42'
+            root.findmeld('content').text = 'request %d' % i
+            if cached:
+                fragments.render(root.findmeld('menu'))
+            data = root.write_htmlstring()
+        return data
+    assert render(False) == render(True)
+    report('render with a %d link menu, x%d' % (links, renders),
+           timeit(render, False),
+           timeit(render, True))
+
+# memoized writes
+
+def bench_memoize(rows=5000, refreshes=20):
+    # a dashboard: a few cells change between renders
+    def refresh(root, memoize):
+        if memoize:
+            root.memoize()
+        for i in range(refreshes):
+            for j in range(3):
+                cell = root.findmeld('name%d' % ((i * 7 + j * 1000) % rows))
+                cell.text = 'refresh %d' % i
+            data = root.write_htmlstring()
+        return data
+    plain = parse_xmlstring(makedocument(rows))
+    memoized = parse_xmlstring(makedocument(rows))
+    assert refresh(plain, False) == refresh(memoized, True)
+    report('%d refreshes of %d rows' % (refreshes, rows),
+           timeit(refresh, plain, False),
+           timeit(refresh, memoized, True))
+
+# journaled trees
+
+def bench_journal(rows=5000, requests=20):
+    # fill in a few cells and render, starting from the same template
+    template = parse_xmlstring(makedocument(rows))
+    def fill(root, i):
+        for j in range(10):
+            root.findmeld('name%d' % (i * 10 + j)).text = 'request %d' % i
+        return root.write_xmlstring()
+    def cloning():
+        for i in range(requests):
+            data = fill(template.clone(), i)
+        return data
+    resident = parse_xmlstring(makedocument(rows))
+    resident.journal()
+    def resetting():
+        for i in range(requests):
+            data = fill(resident, i)
+            resident.reset()
+        return data
+    assert cloning() == resetting()
+    report('fill and render %d rows, x%d' % (rows, requests),
+           timeit(cloning),
+           timeit(resetting))
+
+# template pools
+
+def bench_pool(rows=2000, requests=200):
+    # the time spent getting a fresh copy of a template on the request
+    # path: a full clone, or a clone from a pool which is refilled by
+    # putting released clones back
+    template = parse_xmlstring(makedocument(rows))
+    pool = TemplatePool(template.clone(), background=False)
+    def cloning():
+        for i in range(requests):
+            root = template.clone()
+            root.findmeld('name%d' % i).text = 'request'
+    def pooled():
+        for i in range(requests):
+            root = pool.acquire()
+            root.findmeld('name%d' % i).text = 'request'
+            pool.release(root)
+    report('get a %d row template, x%d' % (rows, requests),
+           timeit(cloning),
+           timeit(pooled))
+    pool.close()
+
+# weak parent links
+
+class GCTimer(object):
+    """ Add up the time spent in the cyclic garbage collector """
+    def __init__(self):
+        self.collections = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self._start = None
+
+    def __call__(self, phase, info):
+        if phase == 'start':
+            self._start = time.time()
+        elif self._start is not None:
+            elapsed = time.time() - self._start
+            self.collections += 1
+            self.total += elapsed
+            self.longest = max(self.longest, elapsed)
+            self._start = None
+
+def bench_weakparents(renders=100000, resident=20000):
+    # a server rendering a small page over and over, with a large tree
+    # (the rest of its long-lived objects) resident, which every full
+    # collection has to go through
+    if not hasattr(gc, 'callbacks'): # pragma: no cover (python 2)
+        sys.stdout.write('weakparents: needs gc.callbacks\n')
+        return
+    residents = parse_xmlstring(makedocument(resident))
+    def serve(template):
+        timer = GCTimer()
+        gc.collect()
+        gc.callbacks.append(timer)
+        try:
+            for i in range(renders):
+                root = template.clone(cow=True)
+                root.findmeld('title').text = 'request %d' % i
+                root.findmeld('content').text = 'content'
+                root.write_htmlstring()
+        finally:
+            gc.callbacks.remove(timer)
+        return timer
+    strong = parse_htmlstring(makepage(20))
+    strong.freeze()
+    weak = parse_htmlstring(makepage(20)).weakparents()
+    weak.freeze()
+    old = serve(strong)
+    new = serve(weak)
+    report('gc pauses, %d renders (%d, %d)' % (
+        renders, old.collections, new.collections), old.total, new.total)
+    report('longest gc pause', old.longest, new.longest)
+    del residents
+
+# pausing the garbage collector
+
+def bench_gcpause(rows=50000):
+    # the bulk operations with and without pausing the collector, then
+    # a full collection with a resident template, before and after
+    # gc.freeze
+    import meld3
+    text = makedocument(rows)
+    template = parse_xmlstring(text)
+    def bulk(pause, func, *args):
+        meld3.PAUSE_GC = pause
+        try:
+            return timeit(func, *args)
+        finally:
+            meld3.PAUSE_GC = True
+    def repeat():
+        root = parse_xmlstring(makedocument(1))
+        for clone, i in root.findmeld('name0').parent.repeat(range(rows)):
+            pass
+    for name, func, args in (
+        ('parse_xmlstring', parse_xmlstring, (text,)),
+        ('clone', template.clone, ()),
+        ('repeat', repeat, ())):
+        report('%s, %d rows' % (name, rows),
+               bulk(False, func, *args), bulk(True, func, *args))
+    if hasattr(gc, 'freeze'):
+        collect = timeit(gc.collect)
+        _gcfreeze()
+        try:
+            report('full collection, %d rows resident' % rows,
+                   collect, timeit(gc.collect))
+        finally:
+            gc.unfreeze()
+
+# pre-fork servers
+
+def private_memory(pid='self'):
+    """ Return the number of bytes of memory private to process 'pid'
+    (clean and dirty pages which aren't shared with any other process),
+    or None if /proc/<pid>/smaps_rollup (Linux 4.14+) can't be read.
+    In a forked worker, this is the memory it doesn't share with its
+    master. """
+    try:
+        f = open('/proc/%s/smaps_rollup' % pid)
+    except (IOError, OSError):
+        return None
+    try:
+        total = 0
+        for line in f:
+            if line.startswith('Private_'):
+                total += int(line.split()[1]) * 1024
+        return total
+    finally:
+        f.close()
+
+def _inworkers(workers, serve):
+    # fork 'workers' processes running serve() and return their private
+    # memory once it has returned
+    pipes = []
+    for i in range(workers):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0: # pragma: no cover (child)
+            try:
+                os.close(r)
+                serve()
+                gc.collect()
+                os.write(w, str(private_memory()).encode('ascii'))
+            finally:
+                os._exit(0)
+        os.close(w)
+        pipes.append((pid, r))
+    sizes = []
+    for pid, r in pipes:
+        sizes.append(int(os.read(r, 100)))
+        os.close(r)
+        os.waitpid(pid, 0)
+    return sizes
+
+def bench_prefork(workers=4, links=5000, renders=10):
+    # workers rendering a page with a big menu, cloned from a compiled,
+    # frozen template, or taken from a TemplateRegistry loaded in the
+    # master, as a flat tree or as an element tree built from it
+    if private_memory() is None or not hasattr(os, 'fork'):
+        sys.stdout.write('prefork: needs fork and smaps_rollup\n')
+        return
+    text = makepage(links)
+    def render(root, i):
+        root.findmeld('content').text = 'request %d' % i
+        return root.write_htmlstring()
+    template = parse_htmlstring(text)
+    template.compile('html')
+    template.freeze()
+    def cloning():
+        for i in range(renders):
+            render(template.clone(cow=True), i)
+    registry = TemplateRegistry(weakparents=True)
+    registry.add('page', parse_htmlstring(text))
+    def renderflat(i):
+        flat = registry.getflat('page')
+        flat.settext(flat.findmeld('content'), 'request %d' % i)
+        return flat.write_htmlstring()
+    def flat():
+        for i in range(renders):
+            renderflat(i)
+    def built():
+        for i in range(renders):
+            render(registry.get('page'), i)
+    registry.prefork()
+    try:
+        assert render(template.clone(cow=True), 0) == renderflat(0)
+        assert render(registry.get('page'), 0) == renderflat(0)
+        report('render a %d link page, x%d, flat' % (links, renders),
+               timeit(cloning), timeit(flat))
+        report('render a %d link page, x%d, get' % (links, renders),
+               timeit(cloning), timeit(built))
+        # what a worker makes private just by running, to leave out
+        idle = sum(_inworkers(workers, lambda: None))
+        old = sum(_inworkers(workers, cloning)) - idle
+        new = sum(_inworkers(workers, flat)) - idle
+        newbuilt = sum(_inworkers(workers, built)) - idle
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+    megabyte = 1024.0 * 1024 * workers
+    report('private memory per worker, flat',
+           old / megabyte, new / megabyte, '%7.1fMB')
+    report('private memory per worker, get',
+           old / megabyte, newbuilt / megabyte, '%7.1fMB')
+
+# flat trees
+
+def bench_flat(rows=10000, renders=5):
+    # a template of 40000 nodes, compiled, rendered with a cell filled
+    # in as an element tree and as a flat tree
+    template = parse_xmlstring(makedocument(rows))
+    template.compile('html')
+    flat = FlatTree(template)
+    def elements():
+        for i in range(renders):
+            root = template.clone()
+            root.findmeld('name%d' % i).text = 'request %d' % i
+            data = root.write_htmlstring()
+        return data
+    def flattened():
+        for i in range(renders):
+            root = flat.clone()
+            root.settext(root.findmeld('name%d' % i), 'request %d' % i)
+            data = root.write_htmlstring()
+        return data
+    assert elements() == flattened()
+    nodes = len(flat)
+    report('clone, fill in, render %d nodes, x%d' % (nodes, renders),
+           timeit(elements), timeit(flattened))
+    def clone(tree):
+        for i in range(renders):
+            tree.clone()
+    report('clone %d nodes, x%d' % (nodes, renders),
+           timeit(clone, template), timeit(clone, flat))
+    def walk():
+        return [element.tag for element in template.iter()]
+    def flatwalk():
+        return [flat.gettag(i) for i in range(len(flat))]
+    assert walk() == flatwalk()
+    report('walk %d nodes' % nodes, timeit(walk), timeit(flatwalk))
+    try:
+        import tracemalloc
+    except ImportError: # pragma: no cover (python 2)
+        return
+    def size(make):
+        tracemalloc.start()
+        try:
+            tree = make()
+            gc.collect() # the element tree a flat tree was made from
+            return tracemalloc.get_traced_memory()[0] / (1024.0 * 1024)
+        finally:
+            tracemalloc.stop()
+    report('memory of %d nodes' % nodes,
+           size(lambda: parse_xmlstring(makedocument(rows))),
+           size(lambda: FlatTree(parse_xmlstring(makedocument(rows)))),
+           '%7.1fMB')
+
+# deduplication
+
+def bench_dedup(links=5000, clones=10):
+    # a template with the same markup over and over, kept in memory and
+    # cloned for requests, with and without sharing its repeats
+    try:
+        import tracemalloc
+    except ImportError: # pragma: no cover (python 2)
+        sys.stdout.write('dedup: needs tracemalloc\n')
+        return
+    text = makepage(links).replace('<li', '\n    <li')
+    def size(dedup):
+        tracemalloc.start()
+        try:
+            template = parse_htmlstring(text)
+            saved = 0
+            if dedup:
+                saved = template.dedup()
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            roots = [template.clone() for i in range(clones)]
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        return saved, before, after
+    ignored, old, oldclones = size(False)
+    saved, new, newclones = size(True)
+    megabyte = 1024.0 * 1024
+    report('memory of a %d link template' % links,
+           old / megabyte, new / megabyte, '%7.1fMB')
+    # what dedup says it saved, against what it did
+    report('saved: reported, measured',
+           saved / megabyte, (old - new) / megabyte, '%7.1fMB')
+    report('memory of %d clones' % clones,
+           (oldclones - old) / megabyte, (newclones - new) / megabyte,
+           '%7.1fMB')
+    template = parse_htmlstring(text)
+    shared = parse_htmlstring(text)
+    shared.dedup()
+    assert template.write_htmlstring() == shared.write_htmlstring()
+    def render(root):
+        for i in range(clones):
+            root.clone().write_htmlstring()
+    report('clone and render, x%d' % clones,
+           timeit(render, template), timeit(render, shared))
+
+BENCHMARKS = {
+    'dedup':bench_dedup,
+    'diffmeld':bench_diffmeld,
+    'flat':bench_flat,
+    'gcpause':bench_gcpause,
+    'fragments':bench_fragments,
+    'journal':bench_journal,
+    'memoize':bench_memoize,
+    'pool':bench_pool,
+    'prefork':bench_prefork,
+    'parse':bench_parse,
+    'weakparents':bench_weakparents,
+    }
+
+def main(argv=sys.argv):
+    names = argv[1:] or sorted(BENCHMARKS.keys())
+    sys.stdout.write('%-40s %9s %9s %7s\n' % ('benchmark', 'old', 'new',
+                                             'speedup'))
+    for name in names:
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
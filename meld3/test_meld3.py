@@ -367,6 +367,35 @@ class MeldAPITests(unittest.TestCase):
         self.assertEqual(desc.text, 'foo')
         self.assertEqual(unfilled, ['jammyjam'])
 
+    def test_fillmelds_after_repeat(self):
+        root = self._makeElement(_SIMPLE_XML)
+        root.findmeld('item').repeat([1, 2])
+        unfilled = root.fillmelds(name='first', description='desc',
+                                  list='l', nope='x')
+        self.assertEqual(unfilled, ['nope'])
+        items = root.findmeld('list')
+        self.assertEqual(items[0][0].text, 'first')
+        self.assertEqual(items[0][1].text, 'desc')
+        self.assertEqual(items[1][0].text, 'Name')
+        self.assertEqual(items[1][1].text, 'Description')
+
+    def test_fillmelds_walks_at_most_once(self):
+        from . import helper
+        root = self._makeElement(_SIMPLE_XML)
+        root.findmeld('item').repeat([1, 2])
+        walks = []
+        walk = helper._walk
+        def counting(node, *arg, **kw):
+            walks.append(1)
+            return walk(node, *arg, **kw)
+        helper._walk = counting
+        try:
+            unfilled = root.fillmelds(name='a', description='b', list='c')
+        finally:
+            del helper._walk
+        self.assertEqual(unfilled, [])
+        self.assertEqual(len(walks), 1)
+
     def test_fillmeldhtmlform(self):
         data = [
             {'honorific':'Mr.', 'firstname':'Chris', 'middlename':'Phillips',
@@ -422,6 +451,72 @@ class MeldAPITests(unittest.TestCase):
         self.assertEqual(favoritecolor[2].attrib['checked'], 'checked')
         self.assertEqual(favoritecolor[1].attrib.get('checked'), None)
 
+    def test_streamrepeat(self):
+        from . import _BLANK
+        root = self._makeElement(_SIMPLE_XML)
+        data = [{'name':'Jeff Buckley', 'description':'ethereal'},
+                {'name':'Slipknot', 'description':'heavy & loud'}]
+        expected = root.clone()
+        for element, d in expected.findmeld('item').repeat(data):
+            element.fillmelds(**d)
+        def fill(element, d):
+            element.fillmelds(**d)
+        root.findmeld('list').streamrepeat(data, fill, 'item')
+        self.assertEqual(root.findmeld('item'), None)
+        self.assertEqual(root.write_xmlstring(), expected.write_xmlstring())
+        self.assertEqual(root.write_htmlstring(), expected.write_htmlstring())
+        self.assertEqual(root.write_xhtmlstring(),
+                         expected.write_xhtmlstring())
+        self.assertEqual(_BLANK.join(root.iter_html(chunksize=1)),
+                         expected.write_htmlstring())
+        self.assertEqual(_BLANK.join(root.iter_xml(chunksize=1)),
+                         expected.write_xmlstring())
+
+    def test_streamrepeat_shortrepr(self):
+        from . import _OMITTED_TEXT
+        root = self._makeElement(_SIMPLE_XML)
+        data = iter([{'name':'Jeff Buckley'}])
+        expected = root.clone()
+        for element, d in expected.findmeld('item').repeat(data):
+            element.fillmelds(**d)
+        data = iter([{'name':'Jeff Buckley'}])
+        def fill(element, d):
+            element.fillmelds(**d)
+        listing = root.findmeld('list')
+        listing.streamrepeat(data, fill, 'item')
+        self.assertTrue(_OMITTED_TEXT in listing.shortrepr())
+        # the rows are still there to be written
+        self.assertEqual(root.write_xmlstring(), expected.write_xmlstring())
+
+    def test_streamrepeat_empty(self):
+        from ._compat import _b
+        root = self._makeElement(_SIMPLE_XML)
+        root.findmeld('item').streamrepeat([], None)
+        self.assertEqual(root.findmeld('list').write_xmlstring(fragment=True),
+                         _b('<list>\n    </list>\n'))
+
+    def test_streamrepeat_noparent(self):
+        root = self._makeElement(_SIMPLE_XML)
+        self.assertRaises(ValueError, root.streamrepeat, [], None)
+
+    def test_streamrepeat_rows_are_let_go(self):
+        from . import _BLANK
+        from ._compat import _b
+        import gc
+        import weakref
+        root = self._makeElement(_SIMPLE_XML)
+        refs = []
+        alive = []
+        def fill(element, i):
+            gc.collect()
+            alive.append(len([r for r in refs if r() is not None]))
+            refs.append(weakref.ref(element))
+            element.findmeld('name').text = str(i)
+        root.findmeld('item').streamrepeat(range(50), fill)
+        out = _BLANK.join(root.iter_xml(chunksize=1))
+        self.assertTrue(_b('<name>49</name>') in out)
+        self.assertTrue(max(alive) <= 2)
+
     def test_replace_removes_all_elements(self):
         from . import Replace
         root = self._makeElement(_SIMPLE_XML)
@@ -592,6 +687,92 @@ class MeldElementInterfaceTests(unittest.TestCase):
         el.append(span)
         self.assertEqual(el.findmeld('thea'), a)
 
+    def test_findmeld_outside_subtree(self):
+        from . import _MELD_ID
+        el = self._makeOne('div', {_MELD_ID:'thediv'})
+        span = self._makeOne('span', {_MELD_ID:'thespan'})
+        a = self._makeOne('a', {_MELD_ID:'thea'})
+        el.append(span)
+        el.append(a)
+        self.assertEqual(span.findmeld('thea'), None)
+        self.assertEqual(span.findmeld('thea', 'foo'), 'foo')
+        self.assertEqual(a.findmeld('thea'), a)
+
+    def test_findmeld_uses_index(self):
+        from . import parse_xmlstring
+        from . import helper
+        root = parse_xmlstring(_SIMPLE_XML)
+        def iter(*arg, **kw):
+            raise AssertionError('tree walked')
+        helper.iter = iter
+        try:
+            self.assertEqual(root.findmeld('name').tag, 'name')
+            self.assertEqual(root.findmeld('item').findmeld('name').text,
+                             'Name')
+            self.assertEqual(root.findmeld('unknown'), None)
+        finally:
+            del helper.iter
+
+    def test_index_append_remove(self):
+        from . import _MELD_ID
+        root = self._makeOne('root', {})
+        self.assertEqual(root.findmeld('a'), None)
+        a = self._makeOne('a', {_MELD_ID:'a'})
+        b = self._makeOne('b', {_MELD_ID:'b'})
+        a.append(b)
+        root.append(a)
+        self.assertEqual(root.findmeld('a'), a)
+        self.assertEqual(root.findmeld('b'), b)
+        root.remove(a)
+        self.assertEqual(root.findmeld('a'), None)
+        self.assertEqual(root.findmeld('b'), None)
+        self.assertEqual(a.findmeld('b'), b)
+        root.insert(0, a)
+        self.assertEqual(root.findmeld('b'), b)
+        del root[0]
+        self.assertEqual(root.findmeld('b'), None)
+        root[0:0] = [a]
+        self.assertEqual(root.findmeld('b'), b)
+        c = self._makeOne('c', {_MELD_ID:'c'})
+        root[0] = c
+        self.assertEqual(root.findmeld('a'), None)
+        self.assertEqual(root.findmeld('c'), c)
+        root.clear()
+        self.assertEqual(root.findmeld('c'), None)
+
+    def test_index_set_and_attributes(self):
+        from . import _MELD_ID
+        root = self._makeOne('root', {})
+        a = self._makeOne('a', {_MELD_ID:'a'})
+        root.append(a)
+        self.assertEqual(root.findmeld('a'), a)
+        a.set(_MELD_ID, 'b')
+        self.assertEqual(root.findmeld('a'), None)
+        self.assertEqual(root.findmeld('b'), a)
+        a.attributes(**{_MELD_ID:'c'})
+        self.assertEqual(root.findmeld('b'), None)
+        self.assertEqual(root.findmeld('c'), a)
+
+    def test_index_clone_repeat_replace_content(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        clone = root.clone()
+        self.assertEqual(clone.findmeld('name').parent.parent.parent, clone)
+        item = clone.findmeld('item')
+        rows = item.repeat([1, 2, 3])
+        self.assertEqual(len(clone.findmeld('list')), 3)
+        for element, data in rows:
+            self.assertEqual(element.findmeld('name').parent, element)
+        self.assertEqual(clone.findmeld('name'), item.findmeld('name'))
+        rows[1][0].findmeld('name').replace('hello')
+        self.assertEqual(len(clone.findmeld('list')), 3)
+        self.assertEqual(rows[1][0].findmeld('name'), None)
+        clone.findmeld('list').content('gone')
+        self.assertEqual(clone.findmeld('item'), None)
+        self.assertEqual(clone.findmeld('name'), None)
+        # the source tree is unaffected
+        self.assertEqual(root.findmeld('name').text, 'Name')
+
     def test_ctor(self):
         iface = self._makeOne('div', {'id':'thediv'})
         self.assertEqual(iface.parent, None)
@@ -640,6 +821,36 @@ class MeldElementInterfaceTests(unittest.TestCase):
         self.assertEqual(it[2], span2)
         self.assertEqual(it[3], span3)
 
+    def test_iter(self):
+        div = self._makeOne('div', {'id':'thediv'})
+        span = self._makeOne('span', {})
+        span2 = self._makeOne('span', {'id':'2'})
+        span3 = self._makeOne('span3', {'id':'3'})
+        p = self._makeOne('p', {})
+        div.append(span)
+        span.append(span2)
+        span2.append(span3)
+        div.append(p)
+        self.assertEqual(list(div.iter()), [div, span, span2, span3, p])
+        self.assertEqual(list(div.iter('*')), [div, span, span2, span3, p])
+        self.assertEqual(list(div.iter('span')), [span, span2])
+        self.assertEqual(list(span.iter()), [span, span2, span3])
+
+    def test_iter_is_lazy(self):
+        div = self._makeOne('div', {})
+        span = self._makeOne('span', {})
+        div.append(span)
+        it = div.iter()
+        self.assertEqual(next(it), div)
+        # children are only looked at when the iterator gets to them
+        div.append(self._makeOne('p', {}))
+        self.assertEqual([x.tag for x in it], ['span', 'p'])
+
+    def test_findall_descendants(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        self.assertEqual([x.tag for x in root.findall('.//name')], ['name'])
+
     def test_append(self):
         div = self._makeOne('div', {'id':'thediv'})
         span = self._makeOne('span', {})
@@ -706,6 +917,554 @@ class MeldElementInterfaceTests(unittest.TestCase):
         self.assertNotEqual(id(div[0][0]), id(div2[0][0]))
         self.assertNotEqual(id(div[0][0][0]), id(div2[0][0][0]))
 
+    def test_instance_attributes(self):
+        from . import parse_xmlstring
+        div = self._makeOne('div', {'id':'thediv'})
+        # the instance dictionary is only made when something goes in it
+        self.assertEqual(div.__dict__, {})
+        div.foo = 1
+        self.assertEqual(div.foo, 1)
+        self.assertEqual(div.structure, None)
+        root = parse_xmlstring(_SIMPLE_XML)
+        self.assertEqual(list(root.__dict__.keys()), ['_meldindex'])
+        self.assertEqual(root.findmeld('name').__dict__, {})
+
+    def test_attrib_passed_in_kept(self):
+        attrib = {}
+        span = self._makeOne('span', attrib)
+        attrib['id'] = '1'
+        self.assertEqual(span.get('id'), '1')
+        span.set('class', 'x')
+        self.assertEqual(attrib, {'id':'1', 'class':'x'})
+        other = {}
+        span.attrib = other
+        other['id'] = '2'
+        self.assertEqual(span.items(), [('id', '2')])
+
+    def test_empty_attrib_shared(self):
+        from . import _NOATTRIB
+        from . import parse_xmlstring
+        root = parse_xmlstring('<root><span/><span/></root>')
+        span, span2 = root
+        self.assertTrue(span._attrib is _NOATTRIB)
+        self.assertTrue(span2._attrib is _NOATTRIB)
+        self.assertTrue(self._makeOne('span', None)._attrib is _NOATTRIB)
+        self.assertEqual(span.get('id'), None)
+        self.assertEqual(span.items(), [])
+        self.assertRaises(TypeError, _NOATTRIB.__setitem__, 'id', '1')
+        self.assertEqual(_NOATTRIB, {})
+
+    def test_empty_attrib_made_private_on_write(self):
+        from . import _NOATTRIB
+        span = self._makeOne('span', None)
+        span2 = self._makeOne('span', None)
+        span.set('id', '1')
+        self.assertEqual(span.attrib, {'id':'1'})
+        span2.attrib['class'] = 'x'
+        self.assertEqual(span2.attrib, {'class':'x'})
+        self.assertEqual(_NOATTRIB, {})
+        span.clear()
+        self.assertTrue(span._attrib is _NOATTRIB)
+        span.attributes(id='2')
+        self.assertEqual(span.attrib, {'id':'2'})
+
+    def test_clone_shares_empty_attrib(self):
+        from . import _NOATTRIB
+        from . import helper
+        div = self._makeOne('div', {'id':'thediv'})
+        span = self._makeOne('span', {})
+        div.append(span)
+        for div2 in (div.clone(), helper.bfclone(div)):
+            self.assertTrue(div2[0]._attrib is _NOATTRIB)
+            self.assertFalse(div2._attrib is div._attrib)
+            self.assertEqual(div2.attrib, {'id':'thediv'})
+
+    def test_freeze(self):
+        from . import _MELD_ID
+        div = self._makeOne('div', {'id':'thediv'})
+        span = self._makeOne('span', {_MELD_ID:'span'})
+        div.append(span)
+        div.freeze()
+        self.assertRaises(ValueError, setattr, span, 'text', 'abc')
+        self.assertRaises(ValueError, setattr, div, 'tag', 'p')
+        self.assertRaises(ValueError, span.set, 'class', 'x')
+        self.assertRaises(ValueError, div.attributes, id='x')
+        self.assertRaises(ValueError, div.append, self._makeOne('p', {}))
+        self.assertRaises(ValueError, div.remove, span)
+        self.assertRaises(ValueError, span.deparent)
+        self.assertRaises(ValueError, div.clear)
+        self.assertRaises(ValueError, div.content, 'abc')
+        self.assertRaises(ValueError, span.replace, 'abc')
+        self.assertEqual(div.attrib, {'id':'thediv'})
+        attrib = div.attrib
+        try:
+            attrib['id'] = 'x'
+        except TypeError: # a copy on Python < 3.3
+            pass
+        self.assertEqual(div.get('id'), 'thediv')
+        self.assertEqual(div.findmeld('span'), span)
+        self.assertEqual(div[0], span)
+
+    def test_clone_cow_requires_frozen(self):
+        div = self._makeOne('div', {'id':'thediv'})
+        self.assertRaises(ValueError, div.clone, cow=True)
+
+    def test_clone_cow_shares_static_subtrees(self):
+        from . import _MELD_ID
+        div = self._makeOne('div', {'id':'thediv'})
+        static = self._makeOne('p', {'class':'static'})
+        static.append(self._makeOne('b', {}))
+        ul = self._makeOne('ul', {})
+        li = self._makeOne('li', {_MELD_ID:'li'})
+        div.append(static)
+        div.append(ul)
+        ul.append(li)
+        div.freeze()
+        clone = div.clone(cow=True)
+        # the way to the meld id is copied, the static paragraph isn't
+        self.assertTrue(clone._children[0]._children is static._children)
+        self.assertFalse(clone._children[1] is ul)
+        self.assertFalse(clone.findmeld('li') is li)
+        self.assertEqual(clone.findmeld('li').parent.parent, clone)
+        self.assertTrue(clone._attrib is div._attrib)
+        self.assertEqual(clone.write_xmlstring(), div.write_xmlstring())
+
+    def test_clone_cow_copies_on_write(self):
+        from . import _MELD_ID
+        from ._compat import _b
+        div = self._makeOne('div', {'id':'thediv'})
+        static = self._makeOne('p', {'class':'static'})
+        b = self._makeOne('b', {})
+        static.append(b)
+        span = self._makeOne('span', {_MELD_ID:'span'})
+        div.append(static)
+        div.append(span)
+        div.freeze()
+        clone = div.clone(cow=True)
+        clone.set('id', 'other')
+        clone.findmeld('span').text = 'hello'
+        b2 = clone[0][0]
+        self.assertFalse(b2 is b)
+        self.assertEqual(b2.parent, clone[0])
+        b2.text = 'bold'
+        b2.append(self._makeOne('i', {}))
+        clone[0].attrib['class'] = 'changed'
+        self.assertEqual(div.get('id'), 'thediv')
+        self.assertEqual(span.text, None)
+        self.assertEqual(b.text, None)
+        self.assertEqual(len(b), 0)
+        self.assertEqual(static.get('class'), 'static')
+        self.assertEqual(clone.write_xmlstring(),
+                         _b('<?xml version="1.0"?>\n'
+                            '<div id="other"><p class="changed"><b>bold<i />'
+                            '</b></p><span>hello</span></div>'))
+
+    def test_clone_of_cow_clone(self):
+        div = self._makeOne('div', {})
+        static = self._makeOne('p', {})
+        static.append(self._makeOne('b', {}))
+        div.append(static)
+        div.freeze()
+        clone = div.clone(cow=True)
+        clone2 = clone.clone()
+        self.assertTrue(clone2[0][0].parent is clone2[0])
+        self.assertEqual(clone2.write_xmlstring(), div.write_xmlstring())
+        clone.freeze()
+        clone3 = clone.clone(cow=True)
+        self.assertEqual(clone3.write_xmlstring(), div.write_xmlstring())
+
+    def test_repeat_cow(self):
+        from . import _MELD_ID
+        def build():
+            root = self._makeOne('root', {})
+            item = self._makeOne('item', {_MELD_ID:'item'})
+            item.append(self._makeOne('static', {'a':'1'}))
+            item.append(self._makeOne('name', {_MELD_ID:'name'}))
+            root.append(item)
+            return root
+        data = ['Jeff Buckley', 'Slipknot', 'Low']
+        expected = build()
+        for element, d in expected.repeat(data, 'item'):
+            element.findmeld('name').text = d
+        root = build()
+        for element, d in root.repeat(data, 'item', cow=True):
+            element.findmeld('name').text = d
+        self.assertEqual(len(root), 3)
+        self.assertEqual(root.write_xmlstring(), expected.write_xmlstring())
+        self.assertEqual(len(root.findmelds()), 6)
+
+    def test_fingerprint(self):
+        from . import _MELD_ID
+        def build():
+            root = self._makeOne('root', {})
+            item = self._makeOne('item', {_MELD_ID:'item', 'a':'1'})
+            item.text = 'text'
+            root.append(item)
+            root.append(self._makeOne('other', {}))
+            return root
+        root = build()
+        other = build()
+        self.assertEqual(len(root.fingerprint()), 40)
+        self.assertEqual(root.fingerprint(), other.fingerprint())
+        self.assertEqual(root[0].fingerprint(), other[0].fingerprint())
+        self.assertNotEqual(root[0].fingerprint(), root[1].fingerprint())
+        # attribute order doesn't matter
+        self.assertEqual(self._makeOne('a', {'x':'1', 'y':'2'}).fingerprint(),
+                         self._makeOne('a', {'y':'2', 'x':'1'}).fingerprint())
+        # where the text ends and the tail starts does
+        a = self._makeOne('a', {})
+        a.text = 'xy'
+        b = self._makeOne('a', {})
+        b.text = 'x'
+        b.tail = 'y'
+        self.assertNotEqual(a.fingerprint(), b.fingerprint())
+
+    def test_fingerprint_invalidated_upward(self):
+        from . import _MELD_ID
+        root = self._makeOne('root', {})
+        item = self._makeOne('item', {_MELD_ID:'item'})
+        root.append(item)
+        sibling = self._makeOne('sibling', {})
+        root.append(sibling)
+        before = root.fingerprint()
+        siblingbefore = sibling.fingerprint()
+        self.assertTrue(root._fingerprint is not None)
+        item.text = 'changed'
+        self.assertEqual(item._fingerprint, None)
+        self.assertEqual(root._fingerprint, None)
+        self.assertEqual(sibling._fingerprint, siblingbefore)
+        changed = root.fingerprint()
+        self.assertNotEqual(changed, before)
+        item.text = None
+        self.assertEqual(root.fingerprint(), before)
+        item.append(self._makeOne('child', {}))
+        self.assertNotEqual(root.fingerprint(), before)
+        del item[0]
+        self.assertEqual(root.fingerprint(), before)
+        item.set('a', '1')
+        self.assertNotEqual(root.fingerprint(), before)
+
+    def test_fingerprint_clones(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        fingerprint = root.fingerprint()
+        clone = root.clone()
+        self.assertEqual(clone._fingerprint, fingerprint)
+        root.freeze()
+        cow = root.clone(cow=True)
+        self.assertEqual(cow.fingerprint(), fingerprint)
+        cow.findmeld('name').text = 'changed'
+        self.assertNotEqual(cow.fingerprint(), fingerprint)
+        self.assertEqual(root.fingerprint(), fingerprint)
+        self.assertEqual(clone.fingerprint(), fingerprint)
+
+    def test_fingerprint_cow_clone_doesnt_write_template(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        root.freeze()
+        # freeze computed them all
+        fingerprints = [e._fingerprint for e in root.iter()]
+        self.assertFalse(None in fingerprints)
+        self.assertEqual(root.fingerprint(), fingerprints[0])
+        cow = root.clone(cow=True)
+        cow.findmeld('name').text = 'changed'
+        cow.fingerprint()
+        self.assertEqual([e._fingerprint for e in root.iter()], fingerprints)
+
+    def test_freeze_streamrepeat_not_fingerprinted(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        root.findmeld('name').streamrepeat([], None)
+        root.freeze()
+        self.assertEqual(root._fingerprint, None)
+        self.assertEqual(root.findmeld('item')._fingerprint, None)
+        self.assertNotEqual(root.findmeld('description')._fingerprint, None)
+        self.assertRaises(ValueError, root.fingerprint)
+
+    def test_fingerprint_replace_and_streamrepeat(self):
+        a = self._makeOne('a', {})
+        a.content('<b/>')
+        b = self._makeOne('a', {})
+        b.content('<b/>', structure=True)
+        self.assertNotEqual(a.fingerprint(), b.fingerprint())
+        c = self._makeOne('c', {})
+        c.append(self._makeOne('row', {}))
+        c[0].streamrepeat([1, 2], lambda element, item: None)
+        self.assertRaises(ValueError, c.fingerprint)
+
+    def test_journal_reset(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        expected = root.write_xmlstring()
+        root.journal()
+        listnode = root.findmeld('list')
+        children = listnode._children
+        for rnd in range(3):
+            for item, data in root.findmeld('item').repeat(['a', 'b']):
+                item.findmeld('name').text = data
+                item.findmeld('description').attributes(x=data)
+                item.set('class', 'row')
+            root.findmeld('list').attrib['q'] = '1'
+            root.findmeld('list').tail = None
+            self.assertEqual(len(root.findmeld('list')), 2)
+            self.assertNotEqual(root.write_xmlstring(), expected)
+            root.reset()
+            self.assertEqual(root.write_xmlstring(), expected)
+            self.assertTrue(listnode._children is children)
+            self.assertEqual(len(root.findmelds()), 4)
+            self.assertEqual(root.findmeld('name').parent.meldid(), 'item')
+            self.assertEqual(root.findmeld('list').get('q'), None)
+
+    def test_journal_reset_replace_and_content(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        expected = root.write_xmlstring()
+        root.journal()
+        root.findmeld('item').content('<b/>', structure=True)
+        self.assertEqual(root.findmeld('name'), None)
+        root.findmeld('list').replace('gone')
+        root.reset()
+        self.assertEqual(root.write_xmlstring(), expected)
+        self.assertEqual(root.findmeld('name').text, 'Name')
+
+    def test_journal_reset_moved_element(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        expected = root.write_xmlstring()
+        root.journal()
+        name = root.findmeld('name')
+        name.deparent()
+        other = self._makeOne('other', {})
+        other.append(name)
+        name.text = 'moved'
+        name.set('a', '1')
+        root.reset()
+        self.assertEqual(root.write_xmlstring(), expected)
+        self.assertTrue(name.parent is root.findmeld('item'))
+
+    def test_journal_reset_copy_on_write_clone(self):
+        from . import parse_xmlstring
+        template = parse_xmlstring(
+            '<root xmlns:meld="http://www.plope.com/software/meld3">'
+            '<head><title>title</title></head><body meld:id="body"/></root>')
+        template.freeze()
+        root = template.clone(cow=True)
+        expected = root.write_xmlstring()
+        root.journal()
+        # visiting every element gives the clone children of its own
+        for element in root.iter():
+            element.set('visited', '1')
+        self.assertFalse(root[0]._children is template[0]._children)
+        root.reset()
+        self.assertEqual(root.write_xmlstring(), expected)
+        self.assertTrue(root[0]._children is template[0]._children)
+
+    def test_journal_reset_derived_state(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        root.compile('xml')
+        root.memoize()
+        expected = root.write_xmlstring()
+        fingerprint = root.fingerprint()
+        root.journal()
+        root.findmeld('name').text = 'changed'
+        self.assertNotEqual(root.write_xmlstring(), expected)
+        self.assertNotEqual(root.fingerprint(), fingerprint)
+        root.reset()
+        self.assertEqual(root.fingerprint(), fingerprint)
+        self.assertEqual(root.write_xmlstring(), expected)
+        self.assertNotEqual(root.findmeld('name')._compiled, None)
+
+    def test_journal_errors(self):
+        root = self._makeOne('root', {})
+        child = self._makeOne('child', {})
+        root.append(child)
+        self.assertRaises(ValueError, child.journal)
+        self.assertRaises(ValueError, root.reset)
+        root.journal()
+        self.assertRaises(ValueError, child.reset)
+
+    def test_weakparents(self):
+        from . import parse_xmlstring
+        from . import _WEAKPARENT
+        strong = parse_xmlstring(_SIMPLE_XML)
+        root = parse_xmlstring(_SIMPLE_XML)
+        self.assertTrue(root.weakparents() is root)
+        for element in root.iter():
+            self.assertTrue(element._flags & _WEAKPARENT)
+        name = root.findmeld('name')
+        self.assertEqual([e.tag for e in name.lineage()],
+                         ['name', 'item', 'list', 'root'])
+        self.assertEqual(name.parentindex(), 0)
+        for tree in (strong, root):
+            item = tree.findmeld('item')
+            for clone, i in item.repeat(range(3)):
+                clone.findmeld('name').text = str(i)
+            for clone, i in item.repeat(range(2), cow=True):
+                clone.findmeld('description').text = str(i)
+            tree.findmeld('list').append(self._makeOne('extra', {}))
+            tree.findmeld('description').replace('replaced')
+        self.assertEqual(root.write_xmlstring(), strong.write_xmlstring())
+        for element in root.iter():
+            self.assertTrue(element._flags & _WEAKPARENT)
+            for child in element:
+                self.assertTrue(child.parent is element)
+        extra = root.findmeld('list')[-1]
+        self.assertEqual(extra.deparent(), 4)
+        self.assertEqual(extra.parent, None)
+        source = parse_xmlstring(_SIMPLE_XML).weakparents()
+        target = parse_xmlstring(_SIMPLE_XML).weakparents()
+        name = target.findmeld('name')
+        name.deparent()
+        target.findmeld('list').append(name)
+        diff = source.diffmeld(target)
+        self.assertEqual(diff['unreduced']['moved'], [name])
+        self.assertEqual(diff['reduced']['moved'], [name])
+
+    def test_weakparents_free_trees_without_gc(self):
+        import gc
+        import weakref
+        from . import parse_xmlstring
+        template = parse_xmlstring(_SIMPLE_XML).weakparents()
+        template.freeze()
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for cow in (False, True):
+                root = template.clone(cow=cow)
+                for clone, i in root.findmeld('item').repeat(range(3)):
+                    clone.findmeld('name').text = str(i)
+                root.findmeld('name').content('<b/>', structure=True)
+                list(root.iter())
+                # not a list comprehension, whose variable outlives it
+                # on Python 2
+                refs = list(map(weakref.ref, root.iter()))
+                del root, clone
+                self.assertEqual([r for r in refs if r() is not None], [])
+        finally:
+            if enabled:
+                gc.enable()
+
+    def test_weakparents_parent_outlived(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML).weakparents()
+        name = root.findmeld('name')
+        del root
+        self.assertEqual(name.parent, None)
+        self.assertEqual(name.lineage(), [name])
+
+    def test_weakparents_journal_reset(self):
+        from . import parse_xmlstring
+        from . import _WEAKPARENT
+        root = parse_xmlstring(_SIMPLE_XML).weakparents()
+        expected = root.write_xmlstring()
+        root.journal()
+        name = root.findmeld('name')
+        name.deparent()
+        other = self._makeOne('other', {})
+        other.append(name)
+        self.assertFalse(name._flags & _WEAKPARENT)
+        name.text = 'moved'
+        root.reset()
+        self.assertEqual(root.write_xmlstring(), expected)
+        self.assertTrue(name.parent is root.findmeld('item'))
+        self.assertTrue(name._flags & _WEAKPARENT)
+
+    def test_weakparents_errors(self):
+        root = self._makeOne('root', {})
+        child = self._makeOne('child', {})
+        root.append(child)
+        self.assertRaises(ValueError, child.weakparents)
+
+    def test_dedup(self):
+        from . import parse_htmlstring
+        from . import _dumps
+        from . import _loads
+        html = ('<table>\n  <tr meld:id="row">\n    <td class="x">1</td>'
+                '\n    <td class="x">2</td>\n    <td class="x">3</td>'
+                '\n  </tr>\n</table>')
+        root = parse_htmlstring(html)
+        expected = root.write_htmlstring()
+        saved = root.dedup()
+        self.assertTrue(saved > 0)
+        self.assertEqual(root.write_htmlstring(), expected)
+        row = root.findmeld('row')
+        td1, td2, td3 = row
+        self.assertTrue(td1.tag is td2.tag is td3.tag)
+        self.assertTrue(td1.tail is td2.tail)
+        self.assertTrue(td1._attrib is td2._attrib is td3._attrib)
+        self.assertRaises(TypeError, td1._attrib.__setitem__, 'class', 'y')
+        # clones share the dictionaries too
+        clone = row.clone()
+        self.assertTrue(clone[0]._attrib is td1._attrib)
+        # changing one element's attributes leaves the others alone
+        td2.set('class', 'y')
+        td3.attrib['id'] = 'z'
+        self.assertEqual(td1.attrib, {'class':'x'})
+        self.assertEqual(td2.attrib, {'class':'y'})
+        self.assertEqual(td3.attrib, {'class':'x', 'id':'z'})
+        self.assertEqual(clone[1].attrib, {'class':'x'})
+        self.assertEqual(_loads(_dumps(root)).write_htmlstring(),
+                         root.write_htmlstring())
+        # nothing left to share the second time around
+        self.assertEqual(root.dedup(), 0)
+
+    def test_dedup_meld_ids(self):
+        from . import parse_xmlstring
+        from . import _MELD_ID
+        root = parse_xmlstring(_SIMPLE_XML)
+        root.dedup()
+        name = root.findmeld('name')
+        name.set(_MELD_ID, 'renamed')
+        self.assertTrue(root.findmeld('renamed') is name)
+        self.assertEqual(root.findmeld('name'), None)
+
+    def test_memory_per_node(self):
+        try:
+            import tracemalloc
+        except ImportError: # pragma: no cover (python 2)
+            return
+        from . import parse_xmlstring
+        from . import helper
+
+        class DictElement(object):
+            # the element layout before slots: an instance dictionary
+            # and an attribute dictionary for every node
+            def __init__(self, tag, attrib):
+                self.tag = tag
+                self.attrib = attrib
+                self.text = self.tail = self.parent = self.structure = None
+                self._children = []
+
+        def dictclone(node, parent=None):
+            element = DictElement(node.tag, dict(node.attrib))
+            element.text = node.text
+            element.tail = node.tail
+            element.parent = parent
+            for child in node:
+                element._children.append(dictclone(child, element))
+            return element
+
+        rows = ''.join(['<tr><td>%s</td><td><b>x</b></td></tr>' % i
+                        for i in range(500)])
+        root = parse_xmlstring('<table meld:id="t" '
+                               'xmlns:meld="%s">%s</table>' % (
+                                   'http://www.plope.com/software/meld3',
+                                   rows))
+
+        def measure(clone):
+            tracemalloc.start()
+            try:
+                clones = [clone(root) for i in range(5)]
+                size = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            return size
+
+        slotted = measure(helper.bfclone)
+        classic = measure(dictclone)
+        self.assertTrue(slotted < classic * 0.75, (slotted, classic))
+
     def test_deparent_noparent(self):
         div = self._makeOne('div', {})
         self.assertEqual(div.parent, None)
@@ -1097,6 +1856,124 @@ class MeldElementInterfaceTests(unittest.TestCase):
 
 
 
+class PatchTests(unittest.TestCase):
+    def _parse(self, xml):
+        from . import parse_xmlstring
+        return parse_xmlstring(xml)
+
+    def _roundtrip(self, source, target):
+        import json
+        from . import make_patch
+        from . import apply_patch
+        patch = make_patch(source, target)
+        for p in (patch, json.loads(json.dumps(patch))):
+            patched = apply_patch(source.clone(), p)
+            self.assertEqual(patched.write_xmlstring(),
+                             target.write_xmlstring())
+        return patch
+
+    def test_no_changes(self):
+        root = self._parse(_SIMPLE_XML)
+        self.assertEqual(self._roundtrip(root, root.clone()), [])
+
+    def test_text_and_attributes(self):
+        from . import _MELD_ID
+        root = self._parse(_SIMPLE_XML)
+        target = root.clone()
+        target.findmeld('name').text = 'changed'
+        target.findmeld('description').tail = None
+        target.findmeld('item').attributes(a='1')
+        target.findmeld('list')[0].set('b', '2')
+        root.findmeld('list').set('c', '3')
+        patch = self._roundtrip(root, target)
+        self.assertEqual(patch, [
+            ('remove-attr', 'list', (), 'c'),
+            ('set-attr', 'item', (), 'a', '1'),
+            ('set-attr', 'item', (), 'b', '2'),
+            ('set-text', 'name', (), 'changed'),
+            ('set-tail', 'description', (), None),
+            ])
+
+    def test_weakparents(self):
+        from . import make_patch
+        from . import apply_patch
+        from . import _WEAKPARENT
+        root = self._parse(_SIMPLE_XML)
+        target = root.clone()
+        target.findmeld('item').append(self._parse('<new><a/></new>'))
+        target.findmeld('description').content('<b/>', structure=True)
+        source = root.clone().weakparents()
+        patched = apply_patch(source, make_patch(root, target))
+        self.assertEqual(patched.write_xmlstring(), target.write_xmlstring())
+        for element in patched.iter():
+            self.assertTrue(element._flags & _WEAKPARENT)
+            for child in element:
+                self.assertTrue(child.parent is element)
+
+    def test_repeated_rows(self):
+        root = self._parse(_SIMPLE_XML)
+        for item, data in root.findmeld('item').repeat(['a', 'b', 'c']):
+            item.findmeld('name').text = data
+        target = root.clone()
+        names = [item.findmeld('name') for item in target.findmeld('list')]
+        names[1].text = 'B'
+        patch = self._roundtrip(root, target)
+        # repeated meld ids are addressed by position
+        self.assertEqual(patch, [('set-text', 'list', (1, 0), 'B')])
+        target.findmeld('list')[2].deparent()
+        patch = self._roundtrip(root, target)
+        self.assertEqual([op[0] for op in patch], ['replace-subtree'])
+        self.assertEqual(patch[0][1:3], ('list', ()))
+
+    def test_keyed_children(self):
+        from . import _MeldElementInterface
+        from . import _MELD_ID
+        root = self._parse(_SIMPLE_XML)
+        target = root.clone()
+        item = target.findmeld('item')
+        item.remove(target.findmeld('description'))
+        new = _MeldElementInterface('new', {_MELD_ID:'new'})
+        new.text = 'new'
+        item.insert(0, new)
+        patch = self._roundtrip(root, target)
+        self.assertEqual([op[0] for op in patch], ['remove', 'insert'])
+        self.assertEqual(patch[0], ('remove', 'description', ()))
+        self.assertEqual(patch[1][1:4], ('item', (), 0))
+
+    def test_replace_root(self):
+        root = self._parse(_SIMPLE_XML)
+        target = root.clone()
+        target.tag = 'other'
+        patch = self._roundtrip(root, target)
+        self.assertEqual(patch[0][:3], ('replace-subtree', None, ()))
+
+    def test_replace_nodes(self):
+        root = self._parse(_SIMPLE_XML)
+        target = root.clone()
+        target.findmeld('name').content('<b>x</b>', structure=True)
+        target.findmeld('description').replace('y')
+        self._roundtrip(root, target)
+
+    def test_apply_patch_index(self):
+        from . import make_patch
+        from . import apply_patch
+        from . import _MeldElementInterface
+        from . import _MELD_ID
+        root = self._parse(_SIMPLE_XML)
+        target = root.clone()
+        new = _MeldElementInterface('new', {_MELD_ID:'new'})
+        target.findmeld('item').append(new)
+        patched = apply_patch(root.clone(), make_patch(root, target))
+        self.assertEqual(patched.findmeld('new').parent.meldid(), 'item')
+
+    def test_apply_patch_bad_operation(self):
+        from . import apply_patch
+        root = self._parse(_SIMPLE_XML)
+        self.assertRaises(ValueError, apply_patch, root,
+                          [('frobnicate', None, ())])
+        self.assertRaises(ValueError, apply_patch, root,
+                          [('set-text', 'nonesuch', (), 'x')])
+
 class ParserTests(unittest.TestCase):
     def _parse(self, *args):
         from . import parse_xmlstring
@@ -1108,6 +1985,52 @@ class ParserTests(unittest.TestCase):
         root = parse_htmlstring(*args)
         return root
 
+    def test_builder_links_elements_as_they_start(self):
+        from . import MeldTreeBuilder
+        from . import _MELD_ID
+        builder = MeldTreeBuilder()
+        root = builder.start('root', {})
+        builder.data('text')
+        child = builder.start('child', {_MELD_ID:'child'})
+        self.assertEqual(child.parent, root)
+        self.assertEqual(root[0], child)
+        builder.data('childtext')
+        builder.end('child')
+        builder.data('tail')
+        builder.end('root')
+        self.assertEqual(builder.close(), root)
+        # the builder lets go of the tree
+        self.assertEqual((builder._root, builder._last), (None, None))
+        self.assertEqual(builder.meldids, {})
+        self.assertEqual(root.text, 'text')
+        self.assertEqual(child.text, 'childtext')
+        self.assertEqual(child.tail, 'tail')
+        self.assertEqual(root._meldindex, {'child':[child]})
+
+    def test_builder_is_a_treebuilder(self):
+        from xml.etree.ElementTree import TreeBuilder
+        from . import MeldTreeBuilder
+        from . import MeldParser
+        from . import do_parse
+        from ._compat import StringIO
+        self.assertTrue(isinstance(MeldTreeBuilder(), TreeBuilder))
+        class CountingBuilder(MeldTreeBuilder):
+            started = 0
+            def start(self, tag, attrs):
+                self.started += 1
+                return MeldTreeBuilder.start(self, tag, attrs)
+        builder = CountingBuilder()
+        root = do_parse(StringIO(_SIMPLE_XML), MeldParser(target=builder))
+        self.assertEqual(builder.started, 5)
+        self.assertEqual(root.findmeld('name').parent.tag, 'item')
+
+    def test_builder_repeated_meldid(self):
+        from . import MeldTreeBuilder
+        from . import _MELD_ID
+        builder = MeldTreeBuilder()
+        builder.start('root', {_MELD_ID:'a'})
+        self.assertRaises(ValueError, builder.start, 'child', {_MELD_ID:'a'})
+
     def test_parse_simple_xml(self):
         from . import _MELD_ID
         root = self._parse(_SIMPLE_XML)
@@ -1277,6 +2200,967 @@ class ParserTests(unittest.TestCase):
                     '<body meld:id="repeat"/></html>' % meld_ns)
         self.assertRaises(ValueError, self._parse_html, repeated)
 
+class MeldFeedParserTests(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from . import MeldFeedParser
+        return MeldFeedParser(*arg, **kw)
+
+    def _feed(self, parser, text, size=7):
+        for i in range(0, len(text), size):
+            parser.feed(text[i:i+size])
+
+    def test_xml(self):
+        from . import parse_xmlstring
+        from ._compat import _b
+        parser = self._makeOne()
+        self._feed(parser, _b(_SIMPLE_XML))
+        root = parser.close()
+        expected = parse_xmlstring(_SIMPLE_XML)
+        self.assertEqual(root.write_xmlstring(), expected.write_xmlstring())
+        self.assertEqual(root.findmeld('name').parent.parent.parent, root)
+        self.assertEqual(parser.read_events(), [])
+
+    def test_xml_events(self):
+        from ._compat import _b
+        parser = self._makeOne(events=True)
+        text = _b(_SIMPLE_XML)
+        half = text.index(_b('</item>'))
+        self._feed(parser, text[:half])
+        events = [e.meldid() for e in parser.read_events()]
+        self.assertEqual(events, ['name', 'description'])
+        self.assertEqual(parser.read_events(), [])
+        self._feed(parser, text[half:])
+        root = parser.close()
+        events = parser.read_events()
+        self.assertEqual([e.meldid() for e in events], ['item', 'list'])
+        self.assertEqual(events[0], root.findmeld('item'))
+
+    def test_html(self):
+        from . import parse_htmlstring
+        from ._compat import _u
+        text = _u('<html><head><meta http-equiv="content-type" '
+                  'content="text/html; charset=UTF-8"></head><body>'
+                  '<p meld:id="p">caf\xe9</p></body></html>', 'latin1')
+        parser = self._makeOne(html=True, encoding='utf-8', events=True)
+        self._feed(parser, text.encode('utf-8'), size=3)
+        root = parser.close()
+        self.assertEqual(root.findmeld('p').text, _u('caf\xe9', 'latin1'))
+        self.assertEqual([e.meldid() for e in parser.read_events()], ['p'])
+        expected = parse_htmlstring(text, 'utf-8')
+        self.assertEqual(root.write_htmlstring(), expected.write_htmlstring())
+
+    def test_html_meta_charset(self):
+        from ._compat import _u
+        cafe = _u('caf\xe9', 'latin1')
+        for charset in ('utf-8', 'iso-8859-1'):
+            text = (_u('<html><head><title>%s</title>'
+                       '<meta http-equiv="content-type" '
+                       'content="text/html; charset=%s"></head><body>'
+                       '<p meld:id="p" title="%s">%s</p></body></html>') %
+                    (cafe, charset, cafe, cafe)).encode(charset)
+            for size in (1, 3, 7, len(text)):
+                for encoding in (None, charset):
+                    parser = self._makeOne(html=True, encoding=encoding)
+                    self._feed(parser, text, size=size)
+                    root = parser.close()
+                    p = root.findmeld('p')
+                    self.assertEqual(p.text, cafe)
+                    self.assertEqual(p.get('title'), cafe)
+                    # decoded as declared only after the <meta> tag
+                    title = root.find('head/title').text
+                    self.assertEqual(title,
+                                     cafe.encode(charset).decode(
+                                         encoding or 'iso-8859-1'))
+
+    def test_repeated_meldid(self):
+        from ._compat import _b
+        parser = self._makeOne()
+        self.assertRaises(ValueError, parser.feed, _b(
+            '<root xmlns:meld="http://www.plope.com/software/meld3">'
+            '<a meld:id="a"/><b meld:id="a"/></root>'))
+
+class TemplateCacheTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _makeOne(self, *arg, **kw):
+        from . import TemplateCache
+        return TemplateCache(*arg, **kw)
+
+    def _write(self, name, text):
+        import os
+        filename = os.path.join(self.tempdir, name)
+        f = open(filename, 'w')
+        f.write(text)
+        f.close()
+        return filename
+
+    def test_parse_xml_hands_out_clones(self):
+        filename = self._write('simple.xml', _SIMPLE_XML)
+        cache = self._makeOne()
+        root = cache.parse_xml(filename)
+        root.findmeld('name').text = 'changed'
+        root2 = cache.parse_xml(filename)
+        self.assertFalse(root is root2)
+        self.assertEqual(root2.findmeld('name').text, 'Name')
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_parse_xml_reparses_changed_file(self):
+        import os
+        filename = self._write('simple.xml', _SIMPLE_XML)
+        cache = self._makeOne()
+        cache.parse_xml(filename)
+        self._write('simple.xml', _SIMPLE_XML.replace('Name', 'Other'))
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 10))
+        root = cache.parse_xml(filename)
+        self.assertEqual(root.findmeld('name').text, 'Other')
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_parse_html(self):
+        filename = self._write('simple.html', _SIMPLE_XHTML)
+        cache = self._makeOne()
+        root = cache.parse_html(filename)
+        self.assertEqual(root.findmeld('body').tag, 'body')
+        cache.parse_html(filename)
+        self.assertEqual(cache.hits, 1)
+
+    def test_parse_html_non_ascii(self):
+        import os
+        from ._compat import PY3
+        from ._compat import _b
+        from ._compat import _u
+        cafe = _u('caf\xe9', 'latin-1')
+        for charset, meta in (
+            ('utf-8', '<meta http-equiv="content-type" '
+                      'content="text/html; charset=utf-8">'),
+            ('iso-8859-1', '<meta charset="iso-8859-1">')):
+            filename = os.path.join(self.tempdir, charset + '.html')
+            f = open(filename, 'wb')
+            f.write(_b('<html><head>' + meta + '</head><body>') +
+                    _b('<p meld:id="p">') + cafe.encode(charset) +
+                    _b('</p></body></html>'))
+            f.close()
+            root = self._makeOne().parse_html(filename)
+            self.assertEqual(root.findmeld('p').text, cafe)
+        if PY3:
+            # without a charset, like a file opened in text mode
+            filename = os.path.join(self.tempdir, 'plain.html')
+            f = open(filename, 'w')
+            f.write(_u('<p meld:id="p">') + cafe + _u('</p>'))
+            f.close()
+            root = self._makeOne().parse_html(filename)
+            self.assertEqual(root.findmeld('p').text, cafe)
+
+    def test_parse_strings(self):
+        cache = self._makeOne()
+        root = cache.parse_xmlstring(_SIMPLE_XML)
+        root2 = cache.parse_xmlstring(_SIMPLE_XML)
+        self.assertFalse(root is root2)
+        self.assertEqual(root.write_xmlstring(), root2.write_xmlstring())
+        cache.parse_htmlstring(_SIMPLE_XHTML)
+        cache.parse_htmlstring(_SIMPLE_XHTML)
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hits, 2)
+
+    def test_lru_eviction(self):
+        cache = self._makeOne(maxsize=2)
+        one = '<one/>'
+        two = '<two/>'
+        three = '<three/>'
+        cache.parse_xmlstring(one)
+        cache.parse_xmlstring(two)
+        cache.parse_xmlstring(one) # most recently used now
+        cache.parse_xmlstring(three) # evicts two
+        self.assertEqual(len(cache), 2)
+        cache.parse_xmlstring(one)
+        self.assertEqual(cache.misses, 3)
+        cache.parse_xmlstring(two)
+        self.assertEqual(cache.misses, 4)
+
+    def test_clear(self):
+        cache = self._makeOne()
+        cache.parse_xmlstring('<one/>')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_cachedir(self):
+        import os
+        from . import _PARSERS
+        cachedir = os.path.join(self.tempdir, 'cache')
+        filename = self._write('simple.xml', _SIMPLE_XML)
+        cache = self._makeOne(cachedir=cachedir)
+        root = cache.parse_xml(filename)
+        root2 = cache.parse_xmlstring(_SIMPLE_XML)
+        self.assertEqual(len(os.listdir(cachedir)), 2)
+        def fail(*arg):
+            raise AssertionError('parsed')
+        saved = _PARSERS.copy()
+        _PARSERS.update({'xml':fail, 'xmlstring':fail})
+        try:
+            cache = self._makeOne(cachedir=cachedir)
+            loaded = cache.parse_xml(filename)
+            loaded2 = cache.parse_xmlstring(_SIMPLE_XML)
+        finally:
+            _PARSERS.update(saved)
+        self.assertEqual(loaded.write_xmlstring(), root.write_xmlstring())
+        self.assertEqual(loaded2.write_xmlstring(), root2.write_xmlstring())
+        self.assertEqual(loaded.findmeld('name').parent.tag, 'item')
+
+    def test_cachedir_ignores_bad_dumps(self):
+        import os
+        cachedir = os.path.join(self.tempdir, 'cache')
+        cache = self._makeOne(cachedir=cachedir)
+        cache.parse_xmlstring(_SIMPLE_XML)
+        name = os.listdir(cachedir)[0]
+        for data in (b'garbage', self._baddump(('root', None, None))):
+            f = open(os.path.join(cachedir, name), 'wb')
+            f.write(data)
+            f.close()
+            cache = self._makeOne(cachedir=cachedir)
+            root = cache.parse_xmlstring(_SIMPLE_XML)
+            self.assertEqual(root.findmeld('name').text, 'Name')
+
+    def test_cachedir_key_has_version(self):
+        import os
+        from . import _digest
+        from . import _DUMP_FORMAT
+        from . import __version__
+        cachedir = os.path.join(self.tempdir, 'cache')
+        cache = self._makeOne(cachedir=cachedir)
+        cache.parse_xmlstring(_SIMPLE_XML)
+        self.assertEqual(os.listdir(cachedir), [_digest(
+            'xmlstring None %s %s %s' % (_digest(_SIMPLE_XML), _DUMP_FORMAT,
+                                         __version__))])
+
+    def _baddump(self, tree, version=None):
+        import marshal
+        from . import _DUMP_FORMAT
+        from . import __version__
+        return marshal.dumps((_DUMP_FORMAT, version or __version__,
+                              sys.version, tree))
+
+    def test_weakparents(self):
+        import gc
+        import weakref
+        from . import _WEAKPARENT
+        cache = self._makeOne(weakparents=True)
+        root = cache.parse_xmlstring(_SIMPLE_XML)
+        self.assertTrue(root._flags & _WEAKPARENT)
+        name = root.findmeld('name')
+        self.assertTrue(name._flags & _WEAKPARENT)
+        self.assertTrue(name.parent.parent.parent is root)
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            ref = weakref.ref(root)
+            del root, name
+            self.assertEqual(ref(), None)
+        finally:
+            if enabled:
+                gc.enable()
+
+    def test_gcfreeze(self):
+        import gc
+        if not hasattr(gc, 'freeze'): # pragma: no cover (python < 3.7)
+            return
+        cache = self._makeOne(weakparents=True)
+        try:
+            cache.parse_xmlstring(_SIMPLE_XML)
+            # parsing alone leaves the collector alone
+            self.assertEqual(gc.get_freeze_count(), 0)
+            cache.gcfreeze()
+            self.assertTrue(gc.get_freeze_count() > 0)
+            template = cache._templates.popitem()[1][1]
+            # the collector doesn't see it any more
+            for ob in gc.get_objects():
+                self.assertFalse(ob is template)
+        finally:
+            gc.unfreeze()
+
+    def test_dedup(self):
+        from . import _SharedAttrib
+        from . import parse_xmlstring
+        text = '<table>%s</table>' % ('<tr class="row"><td/></tr>' * 10)
+        cache = self._makeOne(dedup=True)
+        rows = cache.parse_xmlstring(text)
+        self.assertEqual(list(cache.saved.values()),
+                         [parse_xmlstring(text).dedup()])
+        # the template was frozen after it was deduplicated
+        self.assertEqual(rows.dedup(), 0)
+        self.assertTrue(rows[0]._attrib.__class__ is _SharedAttrib)
+        self.assertTrue(rows[0]._attrib is rows[1]._attrib)
+
+    def test_dedup_saved_pruned(self):
+        cache = self._makeOne(maxsize=2, dedup=True)
+        texts = ['<a>%s</a>' % ('<b class="x"/>' * n) for n in (2, 3, 4)]
+        for text in texts:
+            cache.parse_xmlstring(text)
+        self.assertEqual(len(cache.saved), 2)
+        cache.clear()
+        self.assertEqual(cache.saved, {})
+        cache = self._makeOne(maxsize=2)
+        cache.parse_xmlstring(texts[0])
+        self.assertEqual(cache.saved, {})
+
+    def test_dumps_loads(self):
+        import marshal
+        from . import _dumps
+        from . import _loads
+        from . import parse_htmlstring
+        root = parse_htmlstring(_COMPLEX_XHTML)
+        loaded = _loads(_dumps(root))
+        self.assertEqual(loaded.write_htmlstring(), root.write_htmlstring())
+        self.assertEqual(sorted(loaded._meldindex.keys()),
+                         sorted([e.meldid() for e in root.findmelds()]))
+        for element in loaded.findmelds():
+            self.assertTrue(loaded._meldindex[element.meldid()] == [element])
+        self.assertEqual(_loads(marshal.dumps((0, 'x', None))), None)
+        self.assertEqual(_loads(b'garbage'), None)
+        self.assertEqual(_loads(b''), None)
+        # dumps of another version of meld3
+        dump = self._baddump(('root', None, None, None, ()))
+        self.assertNotEqual(_loads(dump), None)
+        self.assertEqual(_loads(self._baddump(('root', None, None, None, ()),
+                                              '0.0')), None)
+        # dumps with the right header but the wrong shape
+        for tree in (('root',),
+                     ('root', None, None, None, 5),
+                     ('root', ['x'], None, None, ()),
+                     ('root', None, None, None, (('child',),)),
+                     None):
+            self.assertEqual(_loads(self._baddump(tree)), None)
+
+class TemplateRegistryTests(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from . import TemplateRegistry
+        return TemplateRegistry(*arg, **kw)
+
+    def test_add_get(self):
+        from . import parse_xmlstring
+        registry = self._makeOne()
+        registry.add('simple', parse_xmlstring(_SIMPLE_XML))
+        self.assertEqual(len(registry), 1)
+        self.assertTrue('simple' in registry)
+        self.assertFalse('other' in registry)
+        root = registry.get('simple')
+        expected = parse_xmlstring(_SIMPLE_XML).write_xmlstring()
+        self.assertEqual(root.write_xmlstring(), expected)
+        root.findmeld('name').text = 'changed'
+        root2 = registry.get('simple')
+        self.assertFalse(root is root2)
+        self.assertEqual(root2.write_xmlstring(), expected)
+        self.assertTrue(root2.findmeld('name').parent.parent.parent is root2)
+        self.assertRaises(KeyError, registry.get, 'other')
+
+    def test_add_undumpable(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        root.findmeld('item').streamrepeat([], lambda e, x: None)
+        registry = self._makeOne()
+        self.assertRaises(ValueError, registry.add, 'simple', root)
+        self.assertEqual(len(registry), 0)
+
+    def test_weakparents(self):
+        import gc
+        import weakref
+        from . import parse_xmlstring
+        from . import _WEAKPARENT
+        registry = self._makeOne(weakparents=True)
+        registry.add('simple', parse_xmlstring(_SIMPLE_XML))
+        root = registry.get('simple')
+        for element in root.iter():
+            self.assertTrue(element._flags & _WEAKPARENT)
+            for child in element:
+                self.assertTrue(child.parent is element)
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            ref = weakref.ref(root.findmeld('name'))
+            del root
+            self.assertEqual(ref(), None)
+        finally:
+            if enabled:
+                gc.enable()
+
+    def test_prefork(self):
+        import gc
+        from . import parse_xmlstring
+        registry = self._makeOne()
+        registry.add('simple', parse_xmlstring(_SIMPLE_XML))
+        registry.prefork(methods=('html', 'xml'))
+        if hasattr(gc, 'freeze'):
+            try:
+                self.assertTrue(gc.get_freeze_count() > 0)
+            finally:
+                gc.unfreeze()
+        self.assertEqual(registry.get('simple').findmeld('name').text,
+                         'Name')
+        self.assertEqual(sorted(registry._templates['simple']._plans),
+                         [('html', 'utf8'), ('xml', 'utf-8')])
+
+    def test_getflat_doesnt_write_template(self):
+        from . import parse_xmlstring
+        registry = self._makeOne()
+        registry.add('simple', parse_xmlstring(_SIMPLE_XML))
+        registry.prefork()
+        template = registry._templates['simple']
+        state = template.__dict__.copy()
+        flat = registry.getflat('simple')
+        flat.settext(flat.findmeld('name'), 'changed')
+        flat.set(flat.findmeld('name'), 'meld:id', 'other')
+        flat.write_htmlstring()
+        self.assertEqual(template.__dict__, state)
+        self.assertEqual(template._parts, {})
+
+    def test_getflat(self):
+        from . import parse_xmlstring
+        registry = self._makeOne()
+        registry.add('simple', parse_xmlstring(_SIMPLE_XML))
+        expected = parse_xmlstring(_SIMPLE_XML)
+        flat = registry.getflat('simple')
+        self.assertEqual(flat.write_xmlstring(), expected.write_xmlstring())
+        flat.settext(flat.findmeld('name'), 'changed')
+        expected.findmeld('name').text = 'changed'
+        self.assertEqual(flat.write_xmlstring(), expected.write_xmlstring())
+        # the registry's copy is left alone
+        flat = registry.getflat('simple')
+        self.assertEqual(flat.gettext(flat.findmeld('name')), 'Name')
+        self.assertRaises(KeyError, registry.getflat, 'other')
+
+_FRAGMENT_HTML = """<html>
+<body>
+<div meld:id="sidebar"><ul><li><b>one</b></li><li meld:id="two">two</li></ul></div>
+<p meld:id="content">content</p>
+</body>
+</html>"""
+
+class FragmentCacheTests(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from . import FragmentCache
+        return FragmentCache(*arg, **kw)
+
+    def _parse(self):
+        from . import parse_htmlstring
+        return parse_htmlstring(_FRAGMENT_HTML)
+
+    def test_render_by_fingerprint(self):
+        cache = self._makeOne()
+        root = self._parse()
+        expected = root.write_htmlstring()
+        sidebar = root.findmeld('sidebar')
+        data = cache.render(sidebar)
+        self.assertEqual(data, sidebar.write_htmlstring(fragment=True))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(cache.nbytes, len(data))
+        # the writers emit the cached bytes
+        self.assertEqual(sidebar._rendered[('html', 'utf8')], data)
+        self.assertEqual(root.write_htmlstring(), expected)
+        other = self._parse()
+        self.assertEqual(cache.render(other.findmeld('sidebar')), data)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 1)
+
+    def test_render_then_change(self):
+        from ._compat import _b
+        cache = self._makeOne()
+        root = self._parse()
+        sidebar = root.findmeld('sidebar')
+        cache.render(sidebar)
+        root.findmeld('two').text = 'changed'
+        self.assertEqual(sidebar._rendered, None)
+        self.assertTrue(_b('<li>changed</li>') in root.write_htmlstring())
+
+    def test_render_cow_clone(self):
+        from ._compat import _b
+        cache = self._makeOne()
+        template = self._parse()
+        template.freeze()
+        root = template.clone(cow=True)
+        ul = root.findmeld('sidebar')
+        cache.render(ul)
+        # the children of the first list item are still shared with the
+        # template until they are visited
+        for b in ul.iter('b'):
+            b.text = 'changed'
+        self.assertTrue(_b('<li><b>changed</b></li>') in
+                        root.write_htmlstring())
+
+    def test_render_user_key(self):
+        cache = self._makeOne()
+        root = self._parse()
+        data = cache.render(root.findmeld('sidebar'), key='sidebar')
+        other = self._parse()
+        sidebar = other.findmeld('sidebar')
+        sidebar.findmeld('two').text = 'other'
+        # the caller vouches that equal keys mean equal content
+        self.assertEqual(cache.render(sidebar, key='sidebar'), data)
+        self.assertEqual(other.write_htmlstring(), root.write_htmlstring())
+
+    def test_render_methods_and_encodings(self):
+        cache = self._makeOne()
+        root = self._parse()
+        sidebar = root.findmeld('sidebar')
+        html = cache.render(sidebar)
+        xhtml = cache.render(sidebar, 'xhtml')
+        latin1 = cache.render(sidebar, 'html', 'latin-1')
+        self.assertEqual(xhtml, sidebar.write_xhtmlstring(fragment=True))
+        self.assertEqual(latin1, html)
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(sorted(sidebar._rendered.keys()),
+                         [('html', 'latin-1'), ('html', 'utf8'),
+                          ('xhtml', 'utf-8')])
+        self.assertRaises(ValueError, cache.render, sidebar, 'text')
+
+    def test_eviction(self):
+        cache = self._makeOne(maxsize=2)
+        root = self._parse()
+        cache.render(root.findmeld('sidebar'))
+        cache.render(root.findmeld('content'))
+        cache.render(root.findmeld('sidebar'))
+        cache.render(root.findmeld('two'))
+        self.assertEqual(len(cache), 2)
+        cache.render(root.findmeld('sidebar'))
+        self.assertEqual(cache.hits, 2)
+        cache.render(root.findmeld('content'))
+        self.assertEqual(cache.misses, 4)
+
+    def test_eviction_by_size(self):
+        cache = self._makeOne(maxbytes=55)
+        root = self._parse()
+        content = cache.render(root.findmeld('content'))
+        cache.render(root.findmeld('two'))
+        self.assertEqual(len(cache), 2)
+        cache.render(root.findmeld('sidebar'))
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.nbytes <= 55)
+        # a fragment bigger than the cache is rendered, but not kept
+        cache.render(root[0])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+        cache.clear()
+        self.assertEqual(cache.render(root.findmeld('content')), content)
+
+    def test_unrenderable(self):
+        from . import _MeldElementInterface
+        cache = self._makeOne()
+        root = self._parse()
+        sidebar = root.findmeld('sidebar')
+        sidebar.append(_MeldElementInterface('{http://foo/bar}baz', {}))
+        self.assertRaises(ValueError, cache.render, sidebar)
+        content = root.findmeld('content')
+        content.append(_MeldElementInterface('b', {}))
+        content[0].streamrepeat([1], lambda element, item: None)
+        self.assertRaises(ValueError, cache.render, content, key='content')
+        self.assertEqual(len(cache), 0)
+
+class TemplatePoolTests(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from . import TemplatePool
+        from . import parse_xmlstring
+        pool = TemplatePool(parse_xmlstring(_SIMPLE_XML), *arg, **kw)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_bad_watermarks(self):
+        self.assertRaises(ValueError, self._makeOne, 3, 2)
+        self.assertRaises(ValueError, self._makeOne, -1, 2)
+
+    def test_template_left_alone(self):
+        from . import TemplatePool
+        from . import parse_xmlstring
+        from . import _FROZEN
+        template = parse_xmlstring(_SIMPLE_XML)
+        pool = TemplatePool(template, background=False)
+        self.addCleanup(pool.close)
+        self.assertFalse(template._flags & _FROZEN)
+        self.assertFalse(pool.template is template)
+        self.assertTrue(pool.template._flags & _FROZEN)
+        template.findmeld('name').text = 'changed'
+        self.assertEqual(pool.acquire().findmeld('name').text, 'Name')
+        template.freeze()
+        pool = TemplatePool(template, background=False)
+        self.addCleanup(pool.close)
+        self.assertTrue(pool.template is template)
+
+    def test_acquire_and_release(self):
+        pool = self._makeOne(1, 2, background=False)
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.clones, 2)
+        expected = pool.template.write_xmlstring()
+        roots = [pool.acquire() for i in range(3)]
+        self.assertEqual((pool.hits, pool.misses, pool.clones), (2, 1, 3))
+        self.assertEqual(len(pool), 0)
+        for root in roots:
+            for item, data in root.findmeld('item').repeat(['a', 'b']):
+                item.findmeld('name').text = data
+            self.assertNotEqual(root.write_xmlstring(), expected)
+            pool.release(root)
+        # the pool is full after two of them
+        self.assertEqual(pool.recycled, 2)
+        self.assertEqual(len(pool), 2)
+        root = pool.acquire()
+        self.assertTrue(root is roots[1])
+        self.assertEqual(root.write_xmlstring(), expected)
+        self.assertEqual(pool.clones, 3)
+
+    def test_release_foreign_element(self):
+        from . import parse_xmlstring
+        pool = self._makeOne(0, 1, background=False)
+        pool.acquire()
+        pool.release(parse_xmlstring(_SIMPLE_XML))
+        root = pool.acquire()
+        parent = parse_xmlstring(_SIMPLE_XML)
+        parent.append(root)
+        pool.release(root)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.recycled, 0)
+
+    def test_background_refill(self):
+        import time
+        pool = self._makeOne(2, 4)
+        def wait(size):
+            deadline = time.time() + 10
+            while len(pool) < size and time.time() < deadline:
+                time.sleep(0.001)
+        wait(4)
+        self.assertEqual(len(pool), 4)
+        roots = [pool.acquire() for i in range(3)]
+        wait(4)
+        self.assertEqual(len(pool), 4)
+        self.assertEqual(pool.clones, 7)
+        self.assertEqual(pool.hits, 3)
+        pool.close()
+        self.assertEqual(len(pool), 0)
+        pool.release(roots[0])
+        self.assertEqual(len(pool), 0)
+        self.assertNotEqual(pool.acquire(), None)
+
+    def test_threads(self):
+        import threading
+        pool = self._makeOne(2, 4)
+        expected = pool.template.write_xmlstring()
+        errors = []
+        def work(n):
+            for i in range(50):
+                root = pool.acquire()
+                if root.write_xmlstring() != expected:
+                    errors.append(root)
+                root.findmeld('name').text = str(n)
+                pool.release(root)
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(pool.hits + pool.misses, 200)
+
+class FlatTreeTests(unittest.TestCase):
+    def _makeOne(self, element):
+        from . import FlatTree
+        return FlatTree(element)
+
+    def test_arrays(self):
+        from . import parse_xmlstring
+        from . import _MELD_ID
+        root = parse_xmlstring(
+            '<a xmlns:meld="http://www.plope.com/software/meld3">'
+            '<b meld:id="b">x</b><b>x</b><!-- c --></a>')
+        flat = self._makeOne(root)
+        self.assertEqual(len(flat), 4)
+        self.assertEqual([flat.gettag(i) for i in range(3)], ['a', 'b', 'b'])
+        self.assertEqual(flat.strings.count('b'), 1)
+        self.assertEqual(flat.strings.count('x'), 1)
+        self.assertEqual(flat.texts[1], flat.texts[2])
+        self.assertEqual(list(flat.tags[1:]), [flat.tags[1], flat.tags[1], -1])
+        self.assertEqual(list(flat.parent), [-1, 0, 0, 0])
+        self.assertEqual(list(flat.firstchild), [1, -1, -1, -1])
+        self.assertEqual(list(flat.nextsibling), [-1, 2, 3, -1])
+        self.assertEqual(flat.children(0), [1, 2, 3])
+        self.assertEqual(flat.meldids, {'b':1})
+        self.assertEqual(flat.findmeld('b'), 1)
+        self.assertEqual(flat.findmeld('c', 'nope'), 'nope')
+        self.assertEqual(flat.gettext(3), ' c ')
+        self.assertEqual(flat.gettail(1), None)
+        self.assertEqual(flat.items(1), [(_MELD_ID, 'b')])
+
+    def test_write_matches_tree(self):
+        from . import parse_htmlstring
+        from . import parse_xmlstring
+        for root in (parse_xmlstring(_COMPLEX_XHTML),
+                     parse_htmlstring(_COMPLEX_XHTML)):
+            root.findmeld('td1').content('<b>&</b>', structure=True)
+            root.findmeld('td2').replace('<escaped>')
+            flat = self._makeOne(root)
+            for i in range(2): # the second time from cached bytes
+                self.assertEqual(flat.write_htmlstring(),
+                                 root.write_htmlstring())
+                self.assertEqual(flat.write_xhtmlstring(pipeline=True),
+                                 root.write_xhtmlstring(pipeline=True))
+                self.assertEqual(flat.write_xmlstring(encoding='latin-1'),
+                                 root.write_xmlstring(encoding='latin-1'))
+
+    def test_clone_copies_on_write(self):
+        from . import parse_xmlstring
+        flat = self._makeOne(parse_xmlstring(_SIMPLE_XML))
+        expected = flat.write_xmlstring()
+        clone = flat.clone()
+        self.assertTrue(clone.texts is flat.texts)
+        name = clone.findmeld('name')
+        self.assertEqual(clone.fillmelds(name='changed', nope='x'), ['nope'])
+        self.assertFalse(clone.texts is flat.texts)
+        self.assertTrue(clone.tags is flat.tags)
+        self.assertEqual(clone.gettext(name), 'changed')
+        self.assertEqual(flat.gettext(name), 'Name')
+        self.assertEqual(flat.write_xmlstring(), expected)
+        self.assertNotEqual(clone.write_xmlstring(), expected)
+        clone.settail(name, None)
+        flat.settext(name, 'also changed')
+        self.assertEqual(clone.gettext(name), 'changed')
+        self.assertEqual(flat.gettail(name), '\n       ')
+        self.assertEqual(clone.gettail(name), None)
+
+    def test_set(self):
+        from . import parse_xmlstring
+        from . import _MELD_ID
+        root = parse_xmlstring(_SIMPLE_XML)
+        flat = self._makeOne(root)
+        item = flat.findmeld('item')
+        flat.set(item, 'class', 'x')
+        flat.set(item, 'class', 'y')
+        flat.set(flat.findmeld('name'), _MELD_ID, 'title')
+        self.assertEqual(flat.get(item, 'class'), 'y')
+        self.assertEqual(flat.get(item, 'nope', 'default'), 'default')
+        self.assertEqual(flat.findmeld('name'), None)
+        self.assertEqual(flat.findmeld('title'), item + 1)
+        root.findmeld('item').set('class', 'y')
+        root.findmeld('name').set(_MELD_ID, 'title')
+        self.assertEqual(flat.write_xmlstring(pipeline=True),
+                         root.write_xmlstring(pipeline=True))
+
+    def test_set_repeatedly_doesnt_grow(self):
+        from . import parse_xmlstring
+        flat = self._makeOne(parse_xmlstring(_SIMPLE_XML)).clone()
+        item = flat.findmeld('item')
+        name = flat.findmeld('name')
+        strings = flat.strings[:]
+        for n in range(3):
+            flat.settext(name, str(n))
+            flat.settext(item, 'Name')
+            flat.settail(name, None)
+            flat.set(item, 'class', str(n))
+            flat.set(item, 'id', str(n))
+        sizes = len(flat._added), len(flat.attrtable)
+        for n in range(100):
+            flat.settext(name, str(n))
+            flat.set(item, 'class', str(n))
+            flat.set(item, 'id', 'Name')
+        self.assertEqual((len(flat._added), len(flat.attrtable)), sizes)
+        self.assertEqual(flat.strings, strings)
+        self.assertEqual(flat.gettext(name), '99')
+        self.assertEqual(flat.gettext(item), 'Name')
+        self.assertEqual(flat.get(item, 'class'), '99')
+        self.assertEqual(flat.get(item, 'id'), 'Name')
+        self.assertEqual(flat.gettail(name), None)
+
+    def test_set_duplicate_meld_ids(self):
+        from . import parse_xmlstring
+        from . import _MELD_ID
+        root = parse_xmlstring('<a><b/><b/><c/></a>')
+        for element, meldid in zip(root, 'bbc'):
+            element.set(_MELD_ID, meldid)
+        flat = self._makeOne(root)
+        clone = flat.clone()
+        clone.set(1, _MELD_ID, 'x')
+        self.assertEqual(clone.findmeld('b'), 2)
+        self.assertEqual(clone.findmeld('x'), 1)
+        clone.set(3, _MELD_ID, 'b')
+        self.assertEqual(clone.findmeld('b'), 2)
+        self.assertEqual(clone.findmeld('c'), None)
+        clone.set(0, _MELD_ID, 'b')
+        self.assertEqual(clone.findmeld('b'), 0)
+        self.assertEqual(flat.meldids, {'b':1, 'c':3})
+
+    def test_totree(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        flat = self._makeOne(root)
+        flat.settext(flat.findmeld('name'), 'changed')
+        tree = flat.totree()
+        root.findmeld('name').text = 'changed'
+        self.assertEqual(tree.write_xmlstring(), root.write_xmlstring())
+        name = tree.findmeld('name')
+        self.assertEqual(tree._meldindex['name'], [name])
+        self.assertEqual([e.tag for e in name.lineage()],
+                         ['name', 'item', 'list', 'root'])
+
+    def test_compile(self):
+        from . import parse_htmlstring
+        from . import parse_xmlstring
+        # the XML has an attribute with a namespace prefix
+        for root, compiled in ((parse_xmlstring(_COMPLEX_XHTML), False),
+                               (parse_htmlstring(_COMPLEX_XHTML), True)):
+            root.findmeld('td1').content('<b>&</b>', structure=True)
+            flat = self._makeOne(root)
+            before = flat.clone()
+            self.assertTrue(flat.compile())
+            self.assertEqual(flat.compile('xml', 'latin-1'), compiled)
+            self.assertEqual(flat.compile('xhtml', 'latin-1'), compiled)
+            clone = flat.clone()
+            for tree in (flat, before, clone):
+                self.assertEqual(tree.write_htmlstring(),
+                                 root.write_htmlstring())
+            # only the changed nodes are serialized again
+            td1 = clone.findmeld('td1')
+            clone.settext(td1, '<i>')
+            clone.set(td1, 'class', 'x')
+            before.settail(before.findmeld('td2'), 'tail')
+            expected = root.clone()
+            expected.findmeld('td1').text = '<i>'
+            expected.findmeld('td1').set('class', 'x')
+            self.assertEqual(clone.write_htmlstring(),
+                             expected.write_htmlstring())
+            self.assertEqual(clone.write_xhtmlstring(encoding='latin-1'),
+                             expected.write_xhtmlstring(encoding='latin-1'))
+            self.assertEqual(clone.write_xmlstring(encoding='latin-1'),
+                             expected.write_xmlstring(encoding='latin-1'))
+            expected = root.clone()
+            expected.findmeld('td2').tail = 'tail'
+            self.assertEqual(before.write_htmlstring(),
+                             expected.write_htmlstring())
+            self.assertFalse(('html', 'utf8') in flat._parts)
+
+    def test_compile_changed_tree(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        flat = self._makeOne(root)
+        clone = flat.clone()
+        flat.settext(flat.findmeld('name'), 'changed')
+        self.assertTrue(flat.compile('xml'))
+        # the clone's name is written from the clone, not from the plan
+        self.assertEqual(clone.write_xmlstring(), root.write_xmlstring())
+        root.findmeld('name').text = 'changed'
+        self.assertEqual(flat.write_xmlstring(), root.write_xmlstring())
+
+    def test_compile_namespaces(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        flat = self._makeOne(root)
+        self.assertTrue(flat.compile('xml'))
+        # a namespaced attribute needs a prefix: written by walking
+        flat.set(flat.findmeld('name'), '{http://foo/bar}x', 'y')
+        root.findmeld('name').set('{http://foo/bar}x', 'y')
+        self.assertEqual(flat.write_xmlstring(), root.write_xmlstring())
+        root = parse_xmlstring('<a xmlns="http://foo/bar"><b/></a>')
+        self.assertFalse(self._makeOne(root).compile('xml'))
+
+    def test_copy_on_write_clone(self):
+        from . import parse_xmlstring
+        template = parse_xmlstring(_SIMPLE_XML)
+        template.freeze()
+        root = template.clone(cow=True)
+        flat = self._makeOne(root)
+        self.assertEqual(flat.write_xmlstring(), template.write_xmlstring())
+
+    def test_unflattenable(self):
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        root.findmeld('item').streamrepeat([], lambda e, x: None)
+        self.assertRaises(ValueError, self._makeOne, root)
+
+class GCPauseTests(unittest.TestCase):
+    def setUp(self):
+        import gc
+        self.enabled = gc.isenabled()
+        gc.enable()
+
+    def tearDown(self):
+        import gc
+        from . import _gcpauses
+        self.assertEqual(_gcpauses[0], 0)
+        if self.enabled:
+            gc.enable()
+        else: # pragma: no cover
+            gc.disable()
+
+    def _items(self, seen, count=3):
+        import gc
+        for i in range(count):
+            seen.append(gc.isenabled())
+            yield i
+
+    def test_repeat_pauses_gc(self):
+        import gc
+        from . import parse_xmlstring
+        root = parse_xmlstring(_SIMPLE_XML)
+        for cow in (False, True):
+            seen = []
+            root.findmeld('item').repeat(self._items(seen), cow=cow)
+            self.assertEqual(seen, [False, False, False])
+            self.assertTrue(gc.isenabled())
+
+    def test_parse_pauses_gc(self):
+        import gc
+        from . import parse_xml
+        seen = []
+        class Source(object):
+            def __init__(self):
+                self.data = [_SIMPLE_XML]
+            def read(self, size=-1):
+                seen.append(gc.isenabled())
+                return self.data and self.data.pop() or ''
+        root = parse_xml(Source())
+        self.assertEqual(root.findmeld('name').text, 'Name')
+        self.assertTrue(seen)
+        self.assertFalse(True in seen)
+        self.assertTrue(gc.isenabled())
+
+    def test_pauses_nest(self):
+        import gc
+        from . import _pausegc
+        from . import _resumegc
+        from . import parse_xmlstring
+        self.assertTrue(_pausegc())
+        try:
+            root = parse_xmlstring(_SIMPLE_XML)
+            root.clone()
+            self.assertFalse(gc.isenabled())
+        finally:
+            _resumegc()
+        self.assertTrue(gc.isenabled())
+
+    def test_collector_left_disabled(self):
+        import gc
+        from . import parse_xmlstring
+        gc.disable()
+        root = parse_xmlstring(_SIMPLE_XML)
+        root.clone()
+        self.assertFalse(gc.isenabled())
+
+    def test_pause_gc_false(self):
+        import gc
+        from . import parse_xmlstring
+        module = sys.modules[parse_xmlstring.__module__]
+        root = parse_xmlstring(_SIMPLE_XML)
+        pause = module.PAUSE_GC
+        module.PAUSE_GC = False
+        try:
+            seen = []
+            root.findmeld('item').repeat(self._items(seen))
+            self.assertEqual(seen, [True, True, True])
+        finally:
+            module.PAUSE_GC = pause
+
 class UtilTests(unittest.TestCase):
 
     def test_insert_xhtml_doctype(self):
@@ -1313,6 +3197,30 @@ class UtilTests(unittest.TestCase):
         actual = prefeed(orig)
         self.assertEqual(actual, orig)
 
+    def test_sharedlineage(self):
+        from . import sharedlineage
+        from . import _MeldElementInterface as E
+        a, b, c, d = E('a', {}), E('b', {}), E('b', {}), E('b', {})
+        a.append(b)
+        b.append(c)
+        other = E('a', {})
+        other.append(d)
+        self.assertTrue(sharedlineage(b, d))
+        self.assertFalse(sharedlineage(c, d))
+        self.assertTrue(sharedlineage(a, other))
+        self.assertFalse(sharedlineage(a, d))
+
+    def test_diffreduce(self):
+        from . import diffreduce
+        from . import _MeldElementInterface as E
+        a, b, c, d = E('a', {}), E('b', {}), E('c', {}), E('d', {})
+        a.append(b)
+        b.append(c)
+        a.append(d)
+        # only children of elements which are kept are dropped
+        self.assertEqual(diffreduce([a, b, c, d]), [a, c])
+        self.assertEqual(diffreduce([b, c, d]), [b, d])
+
 class WriterTests(unittest.TestCase):
     def _parse(self, xml):
         from . import parse_xmlstring
@@ -1765,6 +3673,288 @@ class WriterTests(unittest.TestCase):
         </root>"""
         self.assertNormalizedXMLEqual(actual, expected)
 
+    def _render_all(self, root):
+        return (root.write_htmlstring(),
+                root.write_xhtmlstring(),
+                root.write_xmlstring(),
+                root.write_xmlstring(pipeline=True),
+                root.write_htmlstring(encoding='latin-1'))
+
+    def _mutate(self, root):
+        root.findmeld('title').text = 'A & B'
+        root.findmeld('form1').attributes(action='/go')
+        for tr, data in root.findmeld('tr').repeat(['x', 'y']):
+            tr.findmeld('td1').text = data
+            tr.findmeld('td2').content('<b>%s</b>' % data, structure=True)
+        root.findmeld('content_well').tail = '\n & more'
+
+    def test_compile_output_unchanged(self):
+        for parse in (self._parse, self._parse_html):
+            root = parse(_COMPLEX_XHTML)
+            expected = self._render_all(root)
+            for method in ('html', 'xhtml', 'xml'):
+                root.compile(method)
+            root.compile('html', 'latin-1')
+            self.assertEqual(self._render_all(root), expected)
+            clone = root.clone()
+            self._mutate(clone)
+            expected = self._render_all(clone)
+            compiled = root.clone()
+            self._mutate(compiled)
+            self.assertEqual(self._render_all(compiled), expected)
+
+    def test_compile_shared_by_clones(self):
+        from . import _MELD_ID
+        root = self._parse(_COMPLEX_XHTML)
+        root.compile('html')
+        clone = root.clone()
+        title = clone.findmeld('title')
+        self.assertTrue(title._compiled is root.findmeld('title')._compiled)
+        title.text = 'changed'
+        self.assertEqual(title._compiled, None)
+        self.assertNotEqual(root.findmeld('title')._compiled, None)
+        td = clone.findmeld('td1')
+        # reading the attributes keeps what was compiled, writing them
+        # doesn't
+        attrib = td.attrib
+        self.assertEqual(attrib[_MELD_ID], 'td1')
+        self.assertEqual(attrib.get('class'), None)
+        self.assertEqual(dict(attrib), {_MELD_ID:'td1'})
+        self.assertEqual(len(attrib), 1)
+        self.assertTrue(_MELD_ID in attrib)
+        self.assertNotEqual(td._compiled, None)
+        attrib['class'] = 'x'
+        self.assertEqual(td._compiled, None)
+        self.assertEqual(td.get('class'), 'x')
+        td.compile('html')
+        del attrib['class']
+        self.assertEqual(td._compiled, None)
+        self.assertEqual(td.attrib, {_MELD_ID:'td1'})
+        self.assertRaises(KeyError, attrib.__delitem__, 'class')
+
+    def test_attrib_view_meld_ids(self):
+        from . import _MELD_ID
+        root = self._parse(_SIMPLE_XML)
+        name = root.findmeld('name')
+        name.attrib[_MELD_ID] = 'renamed'
+        self.assertTrue(root.findmeld('renamed') is name)
+        del name.attrib[_MELD_ID]
+        self.assertEqual(root.findmeld('renamed'), None)
+        other = self._parse(_SIMPLE_XML)
+        other.attrib = root.findmeld('list').attrib
+        self.assertEqual(other.attrib, {_MELD_ID:'list'})
+
+    def test_compile_writes_precomputed_chunks(self):
+        from . import _MELD_ID
+        from . import _xml_parts
+        module = sys.modules[_xml_parts.__module__]
+        root = self._parse(_SIMPLE_XML)
+        root.compile('xml')
+        clone = root.clone()
+        clone.findmeld('name').text = 'changed'
+        computed = []
+        def wrapper(node, *arg):
+            computed.append(node.get(_MELD_ID))
+            return _xml_parts(node, *arg)
+        module._xml_parts = wrapper
+        try:
+            actual = clone.write_xmlstring(fragment=True)
+        finally:
+            module._xml_parts = _xml_parts
+        self.assertEqual(computed, ['name'])
+        self.assertTrue(b'<name>changed</name>' in actual)
+
+    def test_compile_skips_namespaced_nodes(self):
+        root = self._parse(_COMPLEX_XHTML)
+        root.compile('xhtml')
+        for node in root.iter():
+            if node.tag == '{http://www.w3.org/1999/xhtml}div':
+                if node.get('{http://foo/bar}baz'):
+                    self.assertEqual(node._compiled, None)
+                else:
+                    self.assertNotEqual(node._compiled, None)
+        # as plain XML, XHTML elements need a namespace prefix
+        root.compile('xml')
+        self.assertEqual(root._compiled.get(('xml', 'utf-8')), None)
+
+    def test_compile_bad_method(self):
+        root = self._parse(_SIMPLE_XML)
+        self.assertRaises(ValueError, root.compile, 'text')
+
+    def test_compile_collapses_static_subtrees(self):
+        root = self._parse(_COMPLEX_XHTML)
+        root.compile('html')
+        key = ('html', 'utf8')
+        head = root[0]
+        self.assertEqual(head._rendered, None)
+        script = head[2]
+        self.assertEqual(script._rendered[key],
+                         b"<script>this won't be escaped in html output: &"
+                         b"</script>\n    ")
+        # only the outermost static subtrees are serialized
+        for node in root.iter():
+            if node._rendered is not None:
+                self.assertEqual(node.findmelds(), [])
+                for child in node:
+                    self.assertEqual(child._rendered, None)
+        self.assertEqual(root.findmeld('tr')._rendered, None)
+        self.assertEqual(root.findmeld('td1')._rendered, None)
+
+    def test_compile_writes_static_subtrees_at_once(self):
+        from . import _write_html
+        root = self._parse('<html><head><meta a="b"/><link/></head>'
+                           '<body meld:id="body" xmlns:meld="%s">'
+                           '<p>a<b>b</b></p></body></html>' %
+                           'http://www.plope.com/software/meld3')
+        expected = root.write_htmlstring(fragment=True)
+        root.compile('html')
+        written = []
+        _write_html(written.append, root, 'utf8', {})
+        self.assertEqual(b''.join(written), expected)
+        self.assertTrue(b'<head><meta a="b"><link></head>' in written)
+        self.assertTrue(b'<p>a<b>b</b></p>' in written)
+        written = list(root.iter_html(fragment=True, chunksize=1))
+        self.assertEqual(b''.join(written), expected)
+        self.assertTrue(b'<head><meta a="b"><link></head>' in written)
+        self.assertTrue(b'<p>a<b>b</b></p>' in written)
+
+    def test_compile_static_subtree_changes(self):
+        from . import _BLANK
+        for method in ('html', 'xhtml', 'xml'):
+            root = self._parse(_COMPLEX_XHTML)
+            root.compile(method)
+            expected = root.clone()
+            changed = root.clone()
+            for clone in expected, changed:
+                head = clone[0]
+                head[0].set('content', 'text/plain')
+                head[2].text = 'alert(1)'
+                head[2].tail = None
+                head[4].append(clone.makeelement('span', {}))
+                clone.findmeld('form1')[0].attributes(src='bar.gif')
+            for node in expected.iter():
+                node._rendered = node._compiled = None
+            self.assertEqual(self._render_all(changed),
+                             self._render_all(expected))
+            self.assertEqual(_BLANK.join(changed.iter_html()),
+                             expected.write_htmlstring())
+            # the template is untouched
+            if method != 'xml':
+                self.assertNotEqual(root[0][2]._rendered, None)
+
+    def test_memoize_output_unchanged(self):
+        for parse in (self._parse, self._parse_html):
+            root = parse(_COMPLEX_XHTML)
+            expected = self._render_all(root)
+            root.memoize()
+            self.assertEqual(self._render_all(root), expected)
+            self.assertEqual(self._render_all(root), expected)
+            self._mutate(root)
+            expected = self._render_all(root.clone())
+            self.assertEqual(self._render_all(root), expected)
+            self.assertEqual(self._render_all(root), expected)
+
+    def test_memoize_rewrites_changed_paths(self):
+        root = self._parse_html(_COMPLEX_XHTML)
+        root.memoize()
+        root.write_htmlstring()
+        key = ('html', 'utf8')
+        head, body = root[0], root[2]
+        self.assertEqual(root._rendered[key], root.write_htmlstring(
+            fragment=True))
+        td1 = root.findmeld('td1')
+        td1.text = 'changed'
+        # the bytes of the changed element's ancestors are gone, those of
+        # everything else are still there
+        node = td1
+        while node is not None:
+            self.assertEqual(node._rendered, None)
+            node = node.parent
+        headbytes = head._rendered[key]
+        written = root.write_htmlstring(fragment=True)
+        self.assertTrue(b'changed' in written)
+        self.assertEqual(root._rendered[key], written)
+        self.assertTrue(head._rendered[key] is headbytes)
+
+    def test_memoize_namespaced_nodes(self):
+        root = self._parse(_COMPLEX_XHTML)
+        root.memoize()
+        self._render_all(root)
+        # HTML output drops namespaced attributes, XML output needs a
+        # prefix for them
+        div = root.findmeld('content_well').parent[0]
+        for node in root, div.parent:
+            self.assertTrue(('html', 'utf8') in node._rendered)
+            self.assertFalse(('xhtml', 'utf-8') in node._rendered)
+        self.assertTrue(('xhtml', 'utf-8') in root[0]._rendered)
+        root[0].insert(0, root.makeelement('{http://foo/bar}x', {}))
+        self.assertEqual(self._render_all(root),
+                         self._render_all(root.clone()))
+        self.assertEqual(root[0]._rendered, None)
+
+    def test_memoize_streamrepeat(self):
+        from . import _MeldElementInterface
+        root = _MeldElementInterface('ul', {})
+        li = _MeldElementInterface('li', {})
+        root.append(li)
+        root.memoize()
+        rows = [1, 2]
+        def fill(element, item):
+            element.text = str(item)
+        li.streamrepeat(rows, fill)
+        self.assertEqual(root.write_htmlstring(fragment=True),
+                         b'<ul><li>1</li><li>2</li></ul>')
+        rows.append(3)
+        self.assertEqual(root.write_htmlstring(fragment=True),
+                         b'<ul><li>1</li><li>2</li><li>3</li></ul>')
+        self.assertEqual(b''.join(root.iter_html(fragment=True)),
+                         b'<ul><li>1</li><li>2</li><li>3</li></ul>')
+        self.assertEqual(root._rendered, None)
+
+    def test_iter_output_matches_write(self):
+        from . import _BLANK
+        for parse in (self._parse, self._parse_html):
+            root = parse(_COMPLEX_XHTML)
+            self._mutate(root)
+            for kw in ({}, {'fragment':True}, {'encoding':'latin-1'}):
+                self.assertEqual(_BLANK.join(root.iter_html(**kw)),
+                                 root.write_htmlstring(**kw))
+            for kw in ({}, {'pipeline':True}, {'declaration':True},
+                       {'encoding':'latin-1'}):
+                self.assertEqual(_BLANK.join(root.iter_xhtml(**kw)),
+                                 root.write_xhtmlstring(**kw))
+            for kw in ({}, {'pipeline':True}, {'fragment':True},
+                       {'doctype':('a', 'b', 'c')}):
+                self.assertEqual(_BLANK.join(root.iter_xml(**kw)),
+                                 root.write_xmlstring(**kw))
+            root.compile('html')
+            self.assertEqual(_BLANK.join(root.iter_html()),
+                             root.write_htmlstring())
+
+    def test_iter_chunksize(self):
+        from . import _BLANK
+        root = self._parse(_COMPLEX_XHTML)
+        expected = root.write_htmlstring()
+        chunks = list(root.iter_html(chunksize=100))
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assertTrue(len(chunk) >= 100)
+        self.assertTrue(0 < len(chunks[-1]))
+        self.assertEqual(_BLANK.join(chunks), expected)
+        chunks = list(root.iter_html(chunksize=len(expected) * 2))
+        self.assertEqual(chunks, [expected])
+
+    def test_iter_is_lazy(self):
+        from . import _BLANK
+        from ._compat import _b
+        root = self._parse(_SIMPLE_XML)
+        chunks = root.iter_xml(chunksize=1)
+        first = next(chunks)
+        self.assertEqual(first, _b('<?xml version="1.0"?>\n<root'))
+        # nothing below the root has been serialized yet
+        root.findmeld('name').text = 'later'
+        self.assertTrue(_b('<name>later</name>') in _BLANK.join(chunks))
+
     def test_escape_cdata(self):
         from ._compat import _b
         from . import _escape_cdata
@@ -1,4 +1,6 @@
 from setuptools import setup
+import os
+import re
 import sys
 
 py_version = sys.version_info[:2]
@@ -8,6 +10,13 @@ if py_version < (2, 7):
 elif (3, 0) < py_version < (3, 4):
     raise RuntimeError('On Python 3, meld3 requires Python 3.4 or later')
 
+here = os.path.abspath(os.path.dirname(__file__))
+f = open(os.path.join(here, 'meld3', '__init__.py'))
+try:
+    version = re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
+finally:
+    f.close()
+
 install_requires = []
 
 CLASSIFIERS = [
@@ -37,7 +46,7 @@ UNMAINTAINED = """
 
 setup(
     name = 'meld3',
-    version = '2.0.1',
+    version = version,
     description = 'Unmaintained templating system used by old versions of Supervisor',
     long_description = UNMAINTAINED,
     classifiers = CLASSIFIERS,